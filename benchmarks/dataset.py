@@ -0,0 +1,97 @@
+# ./benchmarks/dataset.py
+"""Synthetic users for the benchmarks and ``manage.py generate_users``"""
+import random
+import time
+import zlib
+
+from sqlalchemy import func
+
+from service.api.extensions import db, hasher
+from service.api.importer import insert_rows
+from service.api.models import User, backfill_roles
+
+
+FIRST_NAMES = (
+    'james', 'mary', 'robert', 'patricia', 'john', 'jennifer', 'michael',
+    'linda', 'david', 'elizabeth', 'william', 'barbara', 'richard', 'susan',
+    'joseph', 'jessica', 'thomas', 'sarah', 'carlos', 'maria', 'wei', 'yuki',
+    'ahmed', 'fatima', 'olga', 'ivan', 'priya', 'arjun', 'chloe', 'lucas',
+    )
+LAST_NAMES = (
+    'smith', 'johnson', 'williams', 'brown', 'jones', 'garcia', 'miller',
+    'davis', 'rodriguez', 'martinez', 'hernandez', 'lopez', 'gonzalez',
+    'wilson', 'anderson', 'thomas', 'taylor', 'moore', 'jackson', 'martin',
+    'lee', 'nguyen', 'kim', 'chen', 'singh', 'kowalski', 'muller', 'rossi',
+    )
+DOMAINS = (
+    ('gmail.com', 40), ('yahoo.com', 15), ('outlook.com', 15),
+    ('icloud.com', 10), ('example.com', 10), ('corp.example.org', 10),
+    )
+# (roles, admin, weight), most users have none
+ROLES = (
+    (None, False, 940), ('viewer', False, 40), ('editor', False, 15),
+    ('admin', True, 5),
+    )
+
+
+def dataset_password(username, passwords=16):
+    """The plaintext password ``generate_users`` gave ``username``"""
+    return f'dataset-{zlib.crc32(username.encode()) % passwords}'
+
+
+def generate_users(count, batch_size=10000, seed=0, passwords=16,
+                   start=None):
+    """Insert ``count`` synthetic users for scale testing
+
+    Names, email domains and roles follow a rough real world spread.  Hashing
+    millions of passwords would take hours, so only ``passwords`` distinct
+    passwords are hashed (with the current settings) and shared out,
+    ``dataset_password`` tells which one a user got.  Rows go in through the
+    bulk importer's insert path and roles are assigned at the end.
+
+    Usernames are numbered from ``start``, by default after the highest user
+    id, so the generator can be run again to grow a dataset.
+    """
+    started = time.perf_counter()
+    rng = random.Random(seed)
+    plaintexts = [f'dataset-{i}' for i in range(passwords)]
+    hashes = dict(zip(plaintexts, hasher.hash_many(plaintexts)))
+    if start is None:
+        start = (db.session.query(func.max(User.id)).scalar() or 0) + 1
+    domains, domain_weights = zip(*DOMAINS)
+    roles = [(role, admin) for role, admin, _ in ROLES]
+    role_weights = [weight for _, _, weight in ROLES]
+
+    inserted = failed = 0
+    batch = []
+    for number in range(start, start + count):
+        first = rng.choice(FIRST_NAMES)
+        last = rng.choice(LAST_NAMES)
+        username = f'{first}.{last}{number}'
+        role, admin = rng.choices(roles, role_weights)[0]
+        batch.append((number, {
+            'username': username,
+            'email': '{}.{}.{}@{}'.format(
+                first, last, number, rng.choices(domains, domain_weights)[0]),
+            'password': hashes[dataset_password(username, passwords)],
+            'admin': admin,
+            'roles': role,
+            # users with roles are left for backfill_roles
+            'role_mask': None if role else 0,
+            }))
+        if len(batch) >= batch_size:
+            failures = insert_rows(batch)
+            inserted += len(batch) - len(failures)
+            failed += len(failures)
+            batch = []
+    if batch:
+        failures = insert_rows(batch)
+        inserted += len(batch) - len(failures)
+        failed += len(failures)
+    backfill_roles(batch_size)
+    return {
+        'inserted': inserted,
+        'failed': failed,
+        'first': start,
+        'seconds': round(time.perf_counter() - started, 3),
+        }
@@ -0,0 +1,82 @@
+# ./benchmarks/entrypoints.py
+"""Compare the dev (manage.py) and production (wsgi.py) entry points
+
+Each entry point is imported in a fresh interpreter so that coverage tracing
+started by manage.py cannot leak into the other measurement.  For each one we
+record the time it takes to import the module (build the app) and the number
+of requests per second served for ``/api/users/ping`` through the test
+client.
+
+Usage ::
+    python -m benchmarks.entrypoints --requests 5000
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+ENTRYPOINTS = ('manage', 'wsgi')
+
+_RUNNER = """
+import json
+import sys
+import time
+
+start = time.perf_counter()
+module = __import__(sys.argv[1])
+startup = time.perf_counter() - start
+
+client = module.app.test_client()
+requests = int(sys.argv[2])
+# warm up the url map and any lazy imports before timing
+for _ in range(50):
+    client.get('/api/users/ping')
+start = time.perf_counter()
+for _ in range(requests):
+    client.get('/api/users/ping')
+elapsed = time.perf_counter() - start
+
+print(json.dumps({
+    'entrypoint': sys.argv[1],
+    'debug': module.app.debug,
+    'tracing': sys.gettrace() is not None,
+    'startup_seconds': round(startup, 4),
+    'requests_per_second': round(requests / elapsed, 1),
+}))
+"""
+
+
+def run(entrypoint, requests, env):
+    """Run a single entry point in a subprocess and return its results"""
+    output = subprocess.check_output(
+        [sys.executable, '-c', _RUNNER, entrypoint, str(requests)],
+        env=env,
+        )
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ)
+    env.setdefault('APP_SETTINGS', 'service.config.ProductionConfig')
+    env.setdefault('SECRET_KEY', 'benchmark-only')
+    env.setdefault('DATABASE_URL', 'sqlite://')
+
+    results = [run(name, args.requests, env) for name in ENTRYPOINTS]
+    for result in results:
+        print('{entrypoint:10s} debug={debug!s:5s} tracing={tracing!s:5s} '
+              'startup={startup_seconds:.3f}s '
+              '{requests_per_second:>10.1f} req/s'.format(**result))
+    baseline, candidate = results
+    print('speedup: {:.2f}x'.format(
+        candidate['requests_per_second'] / baseline['requests_per_second']))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+# ./benchmarks/gunicorn_profiles.py
+"""Load test the gunicorn profiles of gunicorn_config.py
+
+Each profile is started as a real gunicorn server on a local port and hit by
+``--clients`` keep-alive connections for ``--seconds`` per endpoint.  The
+authenticated endpoints wait on the database, so run this against Postgres
+(``--database-url``) to see what the worker class buys; on the default sqlite
+file the queries are too quick to block anything.  Profiles whose worker
+class isn't installed (gevent) are skipped.
+
+Usage ::
+    python -m benchmarks.gunicorn_profiles --clients 32 --seconds 10
+    python -m benchmarks.gunicorn_profiles --database-url postgres://...
+"""
+import argparse
+import http.client
+import importlib
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import pendulum
+
+PROFILES = ('sync', 'gthread', 'gevent')
+WORKER_MODULES = {'gevent': ('gevent', 'psycogreen')}
+
+
+def prepare(env):
+    """Create the schema and a user, returning a long lived token for it"""
+    from service import create_app, db
+    from service.api.extensions import guard
+    from service.api.models import User
+
+    os.environ.update(env)
+    app = create_app(app_settings='service.config.ProductionConfig')
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User.insert(
+            username='bench', email='bench@example.com', password='bench')
+        return user.id, guard.encode_jwt_token(
+            user, override_access_lifespan=pendulum.Duration(hours=1),
+            override_refresh_lifespan=pendulum.Duration(hours=1))
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'gunicorn did not listen on {port}')
+
+
+def load(port, path, token, clients, seconds):
+    """Keep ``clients`` connections busy on ``path``, return the timings"""
+    timings, errors = [], []
+    deadline = time.monotonic() + seconds
+    headers = {'Authorization': f'Bearer {token}'}
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors.append(response.status)
+            except (OSError, http.client.HTTPException) as e:
+                errors.append(type(e).__name__)
+                conn.close()
+                conn = http.client.HTTPConnection(
+                    '127.0.0.1', port, timeout=30)
+                continue
+            timings.append((time.perf_counter() - start) * 1000)
+        conn.close()
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    timings.sort()
+    return {
+        'path': path,
+        'requests_per_second': round(len(timings) / seconds, 1),
+        'p50_ms': round(statistics.median(timings), 2) if timings else None,
+        'p95_ms': round(timings[int(len(timings) * 0.95) - 1], 2)
+        if timings else None,
+        'errors': len(errors),
+        }
+
+
+def run(profile, paths, token, args, env):
+    port = args.port
+    env = dict(env, GUNICORN_PROFILE=profile,
+               GUNICORN_BIND=f'127.0.0.1:{port}')
+    if args.workers:
+        env['WEB_CONCURRENCY'] = str(args.workers)
+    server = subprocess.Popen(
+        # gunicorn 19 has no __main__ module
+        [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+         '-c', 'gunicorn_config.py', '--access-logfile', '/dev/null',
+         'wsgi:app'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+    try:
+        wait_for_port(port)
+        return [dict(load(port, path, token, args.clients, args.seconds),
+                     profile=profile)
+                for path in paths]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='WEB_CONCURRENCY, defaults to the profile')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--database-url', default=None)
+    parser.add_argument('--profile', dest='profiles', action='append',
+                        choices=PROFILES)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    database_url = args.database_url or 'sqlite:///{}'.format(
+        os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    env = dict(os.environ, DATABASE_URL=database_url,
+               SECRET_KEY=os.environ.get('SECRET_KEY', 'benchmark-only'),
+               APP_SETTINGS='service.config.ProductionConfig',
+               RATE_LIMIT_SEGMENT=os.path.join(
+                   tempfile.mkdtemp(), 'ratelimit'))
+    user_id, token = prepare(env)
+    paths = ['/api/users/ping', '/api/auth/status', f'/api/users/{user_id}']
+
+    results = []
+    for profile in args.profiles or PROFILES:
+        try:
+            for module in WORKER_MODULES.get(profile, ()):
+                importlib.import_module(module)
+        except ImportError as e:
+            print(f'skipping {profile}: {e}', file=sys.stderr)
+            continue
+        results.extend(run(profile, paths, token, args, env))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    for result in results:
+        print('{profile:8s} {path:22s} {requests_per_second:>9.1f} req/s '
+              'p50={p50_ms}ms p95={p95_ms}ms errors={errors}'.format(
+                  **result))
+    return results
+
+
+if __name__ == '__main__':
+    main()
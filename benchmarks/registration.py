@@ -0,0 +1,95 @@
+# ./benchmarks/registration.py
+"""Compare round trips and latency of the two registration paths
+
+``legacy`` is the old Register.post flow, a SELECT for the username and one
+for the email before the INSERT, plus the reload when the token reads the
+id.  ``insert`` is ``User.insert``, a single INSERT relying on the unique
+constraints.  Both paths hash the password, so the hash cost is pinned low
+to keep the database cost visible.
+
+Usage ::
+    python -m benchmarks.registration --users 500
+    python -m benchmarks.registration --database-url postgres://...
+"""
+import argparse
+import statistics
+import time
+
+from sqlalchemy import event
+
+from service import create_app, db
+from service.api.extensions import guard, hasher
+from service.api.models import User
+
+
+def legacy_register(username, email, password):
+    if User.query.filter_by(username=username).first():
+        return None
+    if User.query.filter_by(email=email).first():
+        return None
+    user = User.create(username=username, email=email, password=password)
+    guard.encode_jwt_token(user, email=user.email, username=user.username)
+    return user
+
+
+def insert_register(username, email, password):
+    user = User.insert(username=username, email=email, password=password)
+    guard.encode_jwt_token(user, email=user.email, username=user.username)
+    return user
+
+
+PATHS = {'legacy': legacy_register, 'insert': insert_register}
+
+
+def run(path, users):
+    """Register ``users`` new users, returning statements and timings"""
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    db.drop_all()
+    db.create_all()
+    event.listen(db.engine, 'before_cursor_execute', count)
+    timings = []
+    try:
+        for i in range(users):
+            start = time.perf_counter()
+            PATHS[path](f'{path}{i}', f'{path}{i}@example.com', 'benchmark')
+            timings.append((time.perf_counter() - start) * 1000)
+            db.session.remove()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    timings.sort()
+    return {
+        'path': path,
+        'statements_per_registration': len(statements) / users,
+        'p50_ms': round(statistics.median(timings), 3),
+        'p95_ms': round(timings[int(len(timings) * 0.95) - 1], 3),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--database-url', default=None)
+    args = parser.parse_args(argv)
+
+    app = create_app(app_settings='service.config.TestingConfig')
+    if args.database_url:
+        app.config['SQLALCHEMY_DATABASE_URI'] = args.database_url
+    results = []
+    with app.app_context():
+        hasher.apply_settings(
+            {'scheme': 'pbkdf2_sha512', 'settings': {'rounds': 1000}})
+        for path in PATHS:
+            results.append(run(path, args.users))
+        db.drop_all()
+    for result in results:
+        print('{path:8s} {statements_per_registration:>5.1f} statements '
+              'p50={p50_ms:.3f}ms p95={p95_ms:.3f}ms'.format(**result))
+    return results
+
+
+if __name__ == '__main__':
+    main()
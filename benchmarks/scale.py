@@ -0,0 +1,265 @@
+# ./benchmarks/scale.py
+"""Replay the hot endpoints against a large dataset
+
+The unit tests run against a handful of rows, so plans that only go wrong on
+a big table never show there.  This fills a database with ``--generate``
+synthetic users (``manage.py generate_users`` does the same on its own) and
+replays login, status, single user lookups, the first and a deep page of the
+users list and the ndjson stream through the test client.
+
+For each endpoint it records latency, the SQL statements issued per request,
+the rows they touched, the plan of every distinct statement (``EXPLAIN`` on
+Postgres, ``EXPLAIN QUERY PLAN`` on sqlite, flagged when it reads a table
+without an index, which is fine under a small LIMIT and not otherwise) and
+the process' peak RSS.  The dataset is kept between runs, leave out
+``--generate`` to replay against what is there.
+
+Usage ::
+    python -m benchmarks.scale --generate 1000000 --output scale.json
+    python -m benchmarks.scale --database-url postgres://... --requests 500
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import tempfile
+import time
+from collections import OrderedDict
+
+import pendulum
+from sqlalchemy import event, func
+
+from benchmarks.suite import create_bench_app, percentile
+
+
+def explain(connection, dialect, statement, parameters):
+    """Plan of one statement and whether it reads a table without an index"""
+    cursor = connection.cursor()
+    try:
+        if dialect == 'postgresql':
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {statement}', parameters)
+            plan = cursor.fetchone()[0][0]['Plan']
+            nodes, table_scan = [plan], False
+            while nodes:
+                node = nodes.pop()
+                table_scan |= node['Node Type'] == 'Seq Scan'
+                nodes.extend(node.get('Plans', ()))
+            return {'plan': plan, 'estimated_rows': plan['Plan Rows'],
+                    'table_scan': table_scan}
+        cursor.execute(f'EXPLAIN QUERY PLAN {statement}', parameters)
+        plan = [row[-1] for row in cursor.fetchall()]
+        return {'plan': plan, 'table_scan': any(
+            step.startswith('SCAN') and ' USING ' not in step
+            for step in plan)}
+    finally:
+        cursor.close()
+
+
+class StatementRecorder(object):
+    """Collects the statements an engine runs while ``current`` is set"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.current = None
+        event.listen(engine, 'before_cursor_execute', self.before)
+        event.listen(engine, 'after_cursor_execute', self.after)
+
+    def before(self, conn, cursor, statement, parameters, context,
+               executemany):
+        if self.current is not None:
+            entry = self.current.setdefault(statement, {
+                'count': 0, 'rows': 0, 'parameters': parameters})
+            entry['count'] += 1
+
+    def after(self, conn, cursor, statement, parameters, context,
+              executemany):
+        # rowcount is -1 for SELECTs on sqlite, rows affected otherwise
+        if self.current is not None and cursor.rowcount > 0:
+            self.current[statement]['rows'] += cursor.rowcount
+
+    def close(self):
+        event.remove(self.engine, 'before_cursor_execute', self.before)
+        event.remove(self.engine, 'after_cursor_execute', self.after)
+
+
+def endpoints(fixture, args):
+    """name -> (builds the next request, requests to send)"""
+    rng = random.Random(args.seed)
+
+    def login():
+        user = rng.choice(fixture['sample'])
+        return 'POST', '/api/auth/login', {
+            'email': user['email'], 'password': user['password']}, None
+
+    def users_get():
+        user = rng.choice(fixture['sample'])
+        return 'GET', f"/api/users/{user['id']}", None, fixture['token']
+
+    stream = '/api/users/?format=ndjson&limit={}'.format(args.stream_limit)
+    return OrderedDict([
+        ('login', (login, args.requests)),
+        ('status', (lambda: ('GET', '/api/auth/status', None,
+                             fixture['token']), args.requests)),
+        ('users_get', (users_get, args.requests)),
+        ('users_list', (lambda: ('GET', '/api/users/', None,
+                                 fixture['token']), args.requests)),
+        ('users_list_deep', (lambda: ('GET', fixture['deep_page'], None,
+                                      fixture['token']), args.requests)),
+        ('users_stream', (lambda: ('GET', stream, None, fixture['token']),
+                          max(1, args.requests // 50))),
+        ])
+
+
+def prepare(args):
+    """Sample users to log in as, a token and the deep page's url"""
+    from benchmarks.dataset import dataset_password
+    from service.api.extensions import guard
+    from service.api.models import User
+    from service.api.users import encode_cursor
+
+    low, high = User.query.with_entities(
+        func.min(User.id), func.max(User.id)).one()
+    rng = random.Random(args.seed)
+    ids = [rng.randint(low, high) for _ in range(args.sample)]
+    users = User.query.filter(User.id.in_(ids)).all()
+    token = guard.encode_jwt_token(
+        users[0], override_access_lifespan=pendulum.Duration(hours=1),
+        override_refresh_lifespan=pendulum.Duration(hours=2))
+    return {
+        'sample': [{'id': user.id, 'email': user.email,
+                    'password': dataset_password(user.username,
+                                                 args.passwords)}
+                   for user in users],
+        'token': token,
+        'deep_page': '/api/users/?cursor={}'.format(
+            encode_cursor(max(low, high - 200))),
+        }
+
+
+def table_counts():
+    from service.api.extensions import db
+
+    return {table.name: db.session.query(func.count()).select_from(
+        table).scalar() for table in db.metadata.sorted_tables}
+
+
+def replay(app, build, requests, recorder):
+    client = app.test_client()
+    statements = OrderedDict()
+    timings, errors = [], []
+    peak_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    recorder.current = statements
+    try:
+        for _ in range(requests):
+            method, path, body, token = build()
+            headers = {'Authorization': f'Bearer {token}'} if token else {}
+            start = time.perf_counter()
+            response = client.open(
+                path, method=method, json=body, headers=headers)
+            response.get_data()
+            elapsed = (time.perf_counter() - start) * 1000
+            if response.status_code == 200:
+                timings.append(elapsed)
+            else:
+                errors.append(response.status_code)
+    finally:
+        recorder.current = None
+    peak_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    connection = recorder.engine.raw_connection()
+    try:
+        plans = []
+        for statement, entry in statements.items():
+            plan = {'statement': statement,
+                    'per_request': round(entry['count'] / requests, 2),
+                    'rows': entry['rows']}
+            if statement.lstrip().upper().startswith(
+                    ('SELECT', 'UPDATE', 'DELETE', 'INSERT')):
+                plan.update(explain(
+                    connection, recorder.engine.dialect.name, statement,
+                    entry['parameters']))
+            plans.append(plan)
+    finally:
+        connection.close()
+
+    timings.sort()
+    return {
+        'requests': requests,
+        'errors': len(errors),
+        'p50_ms': round(statistics.median(timings), 3) if timings else None,
+        'p95_ms': percentile(timings, 95),
+        'statements_per_request': round(
+            sum(e['count'] for e in statements.values()) / requests, 2),
+        'table_scans': [
+            p['statement'] for p in plans if p.get('table_scan')],
+        'statements': plans,
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_kb': peak_after,
+        'peak_rss_growth_kb': peak_after - peak_before,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default=os.environ.get(
+        'SCALE_DATABASE_URL', 'sqlite:///{}'.format(os.path.join(
+            tempfile.gettempdir(), 'flask-auth-scale.db'))))
+    parser.add_argument('--generate', type=int, default=0,
+                        help='synthetic users to add before replaying')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--passwords', type=int, default=16)
+    parser.add_argument('--hash-rounds', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--sample', type=int, default=100,
+                        help='users picked at random to look up and log in')
+    parser.add_argument('--stream-limit', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--endpoint', dest='endpoints', action='append')
+    parser.add_argument('--output', default=None,
+                        help='write the full report as JSON')
+    args = parser.parse_args(argv)
+
+    from benchmarks.dataset import generate_users
+    from service.api.extensions import db
+
+    app = create_bench_app(args.database_url, args)
+    with app.app_context():
+        db.create_all()
+        if args.generate:
+            print(json.dumps(generate_users(
+                args.generate, batch_size=args.batch_size, seed=args.seed,
+                passwords=args.passwords)))
+        report = {
+            'database': db.engine.dialect.name,
+            'created': pendulum.now('UTC').to_iso8601_string(),
+            'tables': table_counts(),
+            'endpoints': OrderedDict(),
+            }
+        fixture = prepare(args)
+        db.session.remove()
+        recorder = StatementRecorder(db.engine)
+        try:
+            for name, (build, requests) in endpoints(fixture, args).items():
+                if args.endpoints and name not in args.endpoints:
+                    continue
+                result = replay(app, build, requests, recorder)
+                report['endpoints'][name] = result
+                print('{:16s} p50={p50_ms}ms p95={p95_ms}ms '
+                      '{statements_per_request} statements/request '
+                      'peak_rss={peak_rss_kb}KiB errors={errors}'.format(
+                          name, **result))
+                for statement in result['table_scans']:
+                    print(f'  table scan: {" ".join(statement.split())}')
+        finally:
+            recorder.close()
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2, default=str)
+    return report
+
+
+if __name__ == '__main__':
+    main()
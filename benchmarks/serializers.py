@@ -0,0 +1,81 @@
+# ./benchmarks/serializers.py
+"""Compare marshal_list_with against the compiled serializers
+
+Loads ``--users`` synthetic users (10k by default) from an in-memory sqlite
+database once, then times building the users list response both ways, the
+dicts alone and the dicts encoded to JSON (the stdlib encoder restplus falls
+back on against orjson, when it is installed).  The outputs are compared
+before anything is timed.
+
+Usage ::
+    python -m benchmarks.serializers --users 10000 --repeat 20
+"""
+import argparse
+import json
+import statistics
+import time
+
+from benchmarks.suite import create_bench_app
+
+
+def timed(func, repeat):
+    """Median and best milliseconds of ``repeat`` calls"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'median_ms': round(statistics.median(timings), 3),
+            'best_ms': round(min(timings), 3)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--hash-rounds', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    from benchmarks.dataset import generate_users
+    from service.api.extensions import db
+    from service.api.models import User
+    from service.api.serializers import dumps, orjson, serialize_with
+    from service.api.users import ns, user_fields
+
+    @ns.marshal_list_with(user_fields)
+    def marshalled(users):
+        return users
+
+    @serialize_with(user_fields, as_list=True)
+    def serialized(users):
+        return users
+
+    app = create_bench_app('sqlite://', args)
+    with app.test_request_context('/api/users/'):
+        db.create_all()
+        generate_users(args.users)
+        users = User.query.order_by(User.id).all()
+        if marshalled(users) != serialized(users):
+            raise SystemExit('serializer output differs from marshal')
+
+        results = {
+            'marshal_list_with': timed(lambda: marshalled(users),
+                                       args.repeat),
+            'serializer': timed(lambda: serialized(users), args.repeat),
+            'marshal_list_with+json': timed(
+                lambda: json.dumps(marshalled(users)) + '\n', args.repeat),
+            'serializer+{}'.format('orjson' if orjson else 'json'): timed(
+                lambda: dumps(serialized(users)), args.repeat),
+            }
+
+    baseline = results['marshal_list_with']['median_ms']
+    for name, result in results.items():
+        print('{:24s} median={median_ms:.3f}ms best={best_ms:.3f}ms'.format(
+            name, **result))
+    print('serializer speedup: {:.1f}x'.format(
+        baseline / results['serializer']['median_ms']))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,7 @@ done
 echo "PostgreSQL started"
 
 if [[ "${FLASK_ENV}" == 'production' ]] ; then
-  gunicorn -b 0.0.0.0:5000 manage:app
+  gunicorn -c gunicorn_config.py wsgi:app
 else
   python manage.py run -h 0.0.0.0 --debugger
 fi
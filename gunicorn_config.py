@@ -0,0 +1,96 @@
+# ./gunicorn_config.py
+"""gunicorn settings, ``gunicorn -c gunicorn_config.py wsgi:app``
+
+GUNICORN_PROFILE picks the worker class:
+
+``sync``
+    one request per process, 2 * cores + 1 processes.  Any wait on Postgres
+    holds the whole process.
+``gthread`` (default)
+    ``cores + 1`` processes of GUNICORN_THREADS (4) threads, a thread waiting
+    on the database lets the others run.  Hashing already happens off the
+    request worker.
+``gevent``
+    one process per core serving up to GUNICORN_WORKER_CONNECTIONS (500)
+    greenlets.  psycopg2 is made cooperative with psycogreen, both come with
+    the ``gevent`` extra.
+
+WEB_CONCURRENCY overrides the number of workers, GUNICORN_BIND the address.
+Workers are recycled after about ``max_requests`` requests, jittered so they
+don't all restart together.
+
+Each worker writes its Prometheus metrics to PROMETHEUS_MULTIPROC_DIR and
+``/api/metrics`` merges them.  Unless it is set a fresh directory is made per
+start, one that is set should be emptied before starting.
+"""
+import multiprocessing
+import os
+import tempfile
+
+
+cores = multiprocessing.cpu_count()
+
+PROFILES = {
+    'sync': {
+        'worker_class': 'sync',
+        'workers': cores * 2 + 1,
+        'threads': 1,
+        'preload_app': True,
+        },
+    'gthread': {
+        'worker_class': 'gthread',
+        'workers': cores + 1,
+        'threads': int(os.environ.get('GUNICORN_THREADS', 4)),
+        'preload_app': True,
+        },
+    'gevent': {
+        'worker_class': 'gevent',
+        'workers': cores,
+        'worker_connections': int(
+            os.environ.get('GUNICORN_WORKER_CONNECTIONS', 500)),
+        # the app has to be imported after gevent patched the worker
+        'preload_app': False,
+        },
+    }
+
+profile = os.environ.get('GUNICORN_PROFILE', 'gthread')
+if profile not in PROFILES:
+    raise RuntimeError(
+        f"GUNICORN_PROFILE must be one of {', '.join(PROFILES)}")
+settings = PROFILES[profile]
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+worker_class = settings['worker_class']
+workers = int(os.environ.get('WEB_CONCURRENCY', settings['workers']))
+threads = settings.get('threads', 1)
+worker_connections = settings.get('worker_connections', 1000)
+preload_app = settings['preload_app']
+# above the load balancer's idle timeout, sync workers ignore it
+keepalive = 75
+timeout = 30
+graceful_timeout = 30
+max_requests = 2000
+max_requests_jitter = 200
+accesslog = '-'
+
+# set before the app (and prometheus_client) is imported
+if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(
+        prefix='flask-auth-metrics-')
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    if preload_app:
+        # never share connections the master may have opened
+        from service import db
+        with server.app.wsgi().app_context():
+            db.engine.dispose()
+
+
+def child_exit(server, worker):
+    # drop the worker from the live gauges
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,12 +1,17 @@
 import sys
+import json
 import unittest
+from datetime import datetime
 
+import click
 import operator
 import coverage
 from flask.cli import FlaskGroup
 
 from service import create_app, db
-from service.api.models import User
+from service.api.hashing import calibrate
+from service.api.importer import import_users
+from service.api.models import User, backfill_roles
 
 
 COV = coverage.coverage(
@@ -19,7 +24,8 @@ COV = coverage.coverage(
 )
 COV.start()
 
-app = create_app()
+# FLASK_APP=manage.py picks this app, `flask db` needs Flask-Migrate on it
+app = create_app(migrate=True)
 cli = FlaskGroup(create_app=create_app)
 
 
@@ -54,6 +60,70 @@ def seed_db():
     db.session.commit()
 
 
+@cli.command('calibrate_hash')
+@click.option('--target-ms', default=250.0, show_default=True,
+              help='Minimum time a single hash should take.')
+@click.option('--samples', default=3, show_default=True,
+              help='Hashes timed per candidate, the median is used.')
+@click.option('--scheme', 'schemes', multiple=True,
+              help='Only try these schemes (repeatable).')
+@click.option('--output', default=None,
+              help='Defaults to the PASSWORD_HASH_SETTINGS config value.')
+def calibrate_hash(target_ms, samples, schemes, output):
+    """Pick the cheapest hash settings that still meet --target-ms"""
+    results, choice = calibrate(target_ms, samples, schemes)
+    for result in results:
+        print('{:15s} {:40s} {:>10.2f}ms'.format(
+            result['scheme'], json.dumps(result['settings']), result['ms']))
+    if choice is None:
+        sys.exit('No hash scheme backends are available')
+
+    output = output or app.config['PASSWORD_HASH_SETTINGS'] \
+        or 'password_hash.json'
+    with open(output, 'w') as fh:
+        json.dump({
+            'scheme': choice['scheme'],
+            'settings': choice['settings'],
+            'measured_ms': choice['ms'],
+            'target_ms': target_ms,
+            'calibrated_at': datetime.utcnow().isoformat(),
+            }, fh, indent=2)
+    print(f"Wrote {choice['scheme']} {choice['settings']} to {output}")
+
+
+@cli.command('bulk_import')
+@click.argument('source', type=click.File('r'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Defaults to csv for .csv files, jsonl otherwise.')
+@click.option('--batch-size', default=1000, show_default=True)
+def bulk_import(source, fmt, batch_size):
+    """Import users from a csv or jsonl file ('-' for stdin)"""
+    fmt = fmt or ('csv' if source.name.endswith('.csv') else 'jsonl')
+    report = import_users(source, fmt, batch_size=batch_size)
+    print(json.dumps(report.to_json(), indent=2))
+
+
+@cli.command('backfill_roles')
+@click.option('--batch-size', default=1000, show_default=True)
+def backfill_roles_command(batch_size):
+    """Fill the roles tables and masks from the users' roles strings"""
+    print(f'Backfilled {backfill_roles(batch_size)} users')
+
+
+@cli.command('generate_users')
+@click.argument('count', type=int)
+@click.option('--batch-size', default=10000, show_default=True)
+@click.option('--seed', default=0, show_default=True)
+@click.option('--passwords', default=16, show_default=True,
+              help='Distinct passwords hashed and shared by the users.')
+def generate_users_command(count, batch_size, seed, passwords):
+    """Insert COUNT synthetic users for scale testing"""
+    from benchmarks.dataset import generate_users
+    report = generate_users(
+        count, batch_size=batch_size, seed=seed, passwords=passwords)
+    print(json.dumps(report, indent=2))
+
+
 @cli.command()
 def test():
     """Runs the tests without code coverage"""
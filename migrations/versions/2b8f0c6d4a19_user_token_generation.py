@@ -0,0 +1,26 @@
+"""user token generation
+
+Revision ID: 2b8f0c6d4a19
+Revises: 9d4e7b2a61c0
+Create Date: 2026-10-18 10:41:09.206318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2b8f0c6d4a19'
+down_revision = '9d4e7b2a61c0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column(
+        'token_generation', sa.Integer(), server_default='0',
+        nullable=False))
+
+
+def downgrade():
+    op.drop_column('users', 'token_generation')
@@ -0,0 +1,28 @@
+"""case insensitive email index
+
+Revision ID: 5f2a9c1d7e3b
+Revises: bc28ad671b4e
+Create Date: 2026-10-18 09:12:41.118231
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f2a9c1d7e3b'
+down_revision = 'bc28ad671b4e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Fails if two existing emails only differ by case, those have to be
+    # merged by hand first.
+    op.create_index(
+        'ix_users_email_lower', 'users', [sa.text('lower(email)')],
+        unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_users_email_lower', table_name='users')
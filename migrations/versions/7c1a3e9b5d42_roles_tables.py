@@ -0,0 +1,117 @@
+"""roles tables and user role mask
+
+Revision ID: 7c1a3e9b5d42
+Revises: 2b8f0c6d4a19
+Create Date: 2026-10-18 11:26:54.873120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1a3e9b5d42'
+down_revision = '2b8f0c6d4a19'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+# users.role_mask is a signed 64 bit integer
+MAX_ROLES = 63
+
+users = sa.table(
+    'users',
+    sa.column('id', sa.Integer),
+    sa.column('roles', sa.String),
+    sa.column('role_mask', sa.BigInteger),
+    )
+roles = sa.table(
+    'roles',
+    sa.column('id', sa.Integer),
+    sa.column('name', sa.String),
+    sa.column('bit', sa.Integer),
+    )
+user_roles = sa.table(
+    'user_roles',
+    sa.column('user_id', sa.Integer),
+    sa.column('role_id', sa.Integer),
+    )
+
+
+def upgrade():
+    op.create_table(
+        'roles',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.Column('bit', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('name'),
+        sa.UniqueConstraint('bit'),
+        )
+    op.create_table(
+        'user_roles',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('role_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(
+            ['role_id'], ['roles.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_id', 'role_id'),
+        )
+    op.create_index(
+        'ix_user_roles_role_id', 'user_roles', ['role_id'], unique=False)
+    op.add_column(
+        'users', sa.Column('role_mask', sa.BigInteger(), nullable=True))
+    backfill()
+
+
+def backfill():
+    """Derive the roles tables and masks from users.roles, in batches"""
+    bind = op.get_bind()
+    known = {}  # name -> (id, bit)
+    last_id = 0
+    while True:
+        batch = bind.execute(
+            sa.select([users.c.id, users.c.roles])
+            .where(users.c.id > last_id)
+            .order_by(users.c.id)
+            .limit(BATCH_SIZE)
+            ).fetchall()
+        if not batch:
+            return
+        assignments, masks = [], []
+        for user_id, user_roles_string in batch:
+            mask = 0
+            for name in sorted({name.strip() for name
+                                in (user_roles_string or '').split(',')
+                                if name.strip()}):
+                if name not in known:
+                    bit = len(known)
+                    if bit >= MAX_ROLES:
+                        raise RuntimeError(
+                            f'users.roles names more than {MAX_ROLES} '
+                            f'roles, role_mask has no bit for {name!r}')
+                    bind.execute(roles.insert().values(name=name, bit=bit))
+                    role_id = bind.execute(
+                        sa.select([roles.c.id]).where(roles.c.name == name)
+                        ).scalar()
+                    known[name] = (role_id, bit)
+                role_id, bit = known[name]
+                assignments.append({'user_id': user_id, 'role_id': role_id})
+                mask |= 1 << bit
+            masks.append({'user': user_id, 'mask': mask})
+        if assignments:
+            bind.execute(user_roles.insert(), assignments)
+        bind.execute(
+            users.update()
+            .where(users.c.id == sa.bindparam('user'))
+            .values(role_mask=sa.bindparam('mask')),
+            masks)
+        last_id = batch[-1][0]
+
+
+def downgrade():
+    op.drop_column('users', 'role_mask')
+    op.drop_index('ix_user_roles_role_id', table_name='user_roles')
+    op.drop_table('user_roles')
+    op.drop_table('roles')
@@ -0,0 +1,36 @@
+"""revoked tokens
+
+Revision ID: 9d4e7b2a61c0
+Revises: 5f2a9c1d7e3b
+Create Date: 2026-10-18 10:03:27.540912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4e7b2a61c0'
+down_revision = '5f2a9c1d7e3b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'revoked_tokens',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('jti', sa.String(length=36), nullable=False),
+        sa.Column('expires_at', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('jti'),
+        )
+    op.create_index(
+        op.f('ix_revoked_tokens_expires_at'), 'revoked_tokens',
+        ['expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(
+        op.f('ix_revoked_tokens_expires_at'), table_name='revoked_tokens')
+    op.drop_table('revoked_tokens')
@@ -0,0 +1,25 @@
+"""user row version
+
+Revision ID: e8a3d5f1b760
+Revises: 7c1a3e9b5d42
+Create Date: 2026-10-18 16:12:48.301527
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8a3d5f1b760'
+down_revision = '7c1a3e9b5d42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column(
+        'version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('users', 'version')
@@ -4,38 +4,66 @@ import os
 from flask import Flask, Blueprint
 from flask_restplus import Api
 from flask_praetorian import PraetorianError
-from service.api.extensions import db, migrate, cors, toolbar, guard
-from service.api.models import User
+from service.api.extensions import db, cors, guard, hasher, limiter, \
+    metrics, pool_metrics, profiler, query_tracker
+from service.api.models import User, identity_cache, revocations
+from service.api.serializers import output_json
 
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 rp_api = Api(api_bp)
+rp_api.representation('application/json')(output_json)
 # flask-praetorian is not compatible with flask-restplus errors without this
 PraetorianError.register_error_handler_with_flask_restplus(rp_api)
+_praetorian_error = PraetorianError.build_error_handler_for_flask_restplus()
 
 
-def create_app(script_info=None):
+@rp_api.errorhandler(PraetorianError)
+def praetorian_error(error):
+    """flask-buzz's restplus handler, which drops the error's headers"""
+    data, code = _praetorian_error(error)
+    return data, code, error.headers or {}
+
+
+def create_app(script_info=None, app_settings=None, migrate=False):
 
     # instantiate the app
     app = Flask(__name__)
-    app.debug = True
 
-    # set config
-    app_settings = os.getenv('APP_SETTINGS', 'service.config.TestingConfig')
+    # set config, debug mode is driven by the config object's DEBUG
+    if app_settings is None:
+        app_settings = os.getenv(
+            'APP_SETTINGS', 'service.config.TestingConfig')
     app.config.from_object(app_settings)
 
     # set up extensions
     cors.init_app(app)
-    guard.init_app(app, User)
+    guard.init_app(app, User, is_blacklisted=revocations.is_revoked)
+    hasher.init_app(app, guard)
+    limiter.init_app(app)
     db.init_app(app)
-    migrate.init_app(app, db)
+    pool_metrics.init_app(app, db)
+    query_tracker.init_app(app)
+    profiler.init_app(app)
+    metrics.init_app(app, rp_api, pool_metrics)
+    identity_cache.init_app(app)
+    revocations.init_app(app)
+
+    # Flask-Migrate pulls in alembic, only the cli (`db` commands) needs it:
+    # apps built by the FlaskGroup or manage.py, or with MIGRATE_ENABLED
+    if migrate or script_info is not None or app.config['MIGRATE_ENABLED']:
+        from flask_migrate import Migrate
+        Migrate(app, db)
 
+    # flask-debugtoolbar is a dev dependency, only import it when enabled
     if app.config['DEBUG_TB_ENABLED']:
-        toolbar.init_app(app)
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
 
     # register blueprints
     from service.api.users import ns as users
     from service.api.auth import ns as auth
+    from service.api.monitoring import ns as monitoring
 
     if app.config['SENTRY_URL']:
         import sentry_sdk
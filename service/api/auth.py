@@ -1,10 +1,16 @@
 import flask_praetorian
-from sqlalchemy import exc
+from flask import current_app, request
+from flask_praetorian.utilities import get_jwt_data_from_app_context
+from sqlalchemy import exc, func
+from sqlalchemy.orm.exc import StaleDataError
 from flask_restplus import Resource, fields
 from service import rp_api
-from service.api.extensions import guard, db
-from service.api.models import User as UserModel
-from service.api.users import user_fields, user_input_fields
+from service.api.extensions import guard, hasher, limiter
+from service.api.models import User as UserModel, revocations, \
+    unique_violation
+from service.api.serializers import serialize_with
+from service.api.users import user_fields, user_input_fields, \
+    user_response
 
 
 ns = rp_api.namespace('auth', path='/auth')
@@ -14,6 +20,12 @@ user_login_fields = rp_api.model('UserLogin', {
     'password': fields.String(required=True, description='password'),
     })
 
+user_disable_fields = rp_api.model('UserDisable', {
+    'email': fields.String(required=True, description='email'),
+    'version': fields.Integer(
+        description='only disable this version of the user'),
+    })
+
 user_register_fields = rp_api.model('UserRegister', {
     'id': fields.Integer(readOnly=True, description='User Id'),
     'username': fields.String(required=True, description='username'),
@@ -48,39 +60,43 @@ class Register(Resource):
             }
         )
     # Return the registration model to the user
-    @ns.marshal_with(user_register_fields, code=201)
+    @serialize_with(user_register_fields, code=201)
     def post(self):  # On a Post Request
         try:
-            # We need these to return None to ensure entries are unique
-            username = UserModel.query.filter_by(
-                username=rp_api.payload['username']).first()
-            email = UserModel.query.filter_by(
-                email=rp_api.payload['email']).first()
-            if not (username or email):
-                user = UserModel.create(**rp_api.payload)
-                # If we want to override the access key or refresh key lifespan
-                access_lifespan = rp_api.payload.get('access_lifespan', None)
-                refresh_lifespan = rp_api.payload.get('refresh_lifespan', None)
-                auth_token = guard.encode_jwt_token(
-                    user,
-                    override_access_lifespan=access_lifespan,
-                    override_refresh_lifespan=refresh_lifespan,
-                    email=user.email,
-                    username=user.username,
-                    )
-                user.auth_token = auth_token
-                return user, 201
-            if email:
+            # A single INSERT, the unique constraints on users catch
+            # existing emails and usernames
+            user = UserModel.insert(
+                username=rp_api.payload['username'],
+                email=rp_api.payload['email'],
+                password=rp_api.payload['password'],
+                )
+        except exc.IntegrityError as e:
+            column = UserModel.conflicting_column(
+                unique_violation(e), rp_api.payload['email'])
+            if column == 'email':
                 rp_api.abort(
-                    409, f"Email already exists: {email.email}"
+                    409, f"Email already exists: {rp_api.payload['email']}"
                     )
-            if username:
+            if column == 'username':
                 rp_api.abort(
-                    409, f"Username already exists: {username.username}"
+                    409,
+                    f"Username already exists: {rp_api.payload['username']}"
                     )
-        except (exc.IntegrityError, ValueError) as e:
-            db.session.rollback()
             rp_api.abort(400, e)
+        except ValueError as e:
+            rp_api.abort(400, e)
+        # If we want to override the access key or refresh key lifespan
+        access_lifespan = rp_api.payload.get('access_lifespan', None)
+        refresh_lifespan = rp_api.payload.get('refresh_lifespan', None)
+        auth_token = guard.encode_jwt_token(
+            user,
+            override_access_lifespan=access_lifespan,
+            override_refresh_lifespan=refresh_lifespan,
+            email=user.email,
+            username=user.username,
+            )
+        user.auth_token = auth_token
+        return user, 201
 
 
 @ns.route('/login')
@@ -93,23 +109,38 @@ class Login(Resource):
     - 200 status code for valid login
     - 400 status code for invalid input
     - 401 status code for invalid login
+    - 429 status code for too many attempts for the email or address
     """
     # Validate email and password were provided
     @ns.expect(user_login_fields, validate=True)
     @ns.doc(
         body=user_login_fields,
-        responses={401: 'Invalid Authentication', 200: 'Successful Login'}
+        responses={
+            401: 'Invalid Authentication',
+            200: 'Successful Login',
+            429: 'Too Many Attempts',
+            }
         )
     # Return with the user model
-    @ns.marshal_with(user_register_fields, code=200)
+    @serialize_with(user_register_fields, code=200)
     def post(self):  # On a Post Request
         try:
             email = rp_api.payload['email']
             password = rp_api.payload['password']
             access_lifespan = rp_api.payload.get('access_lifespan', None)
             refresh_lifespan = rp_api.payload.get('refresh_lifespan', None)
-            # Return User model if valid
-            user = guard.authenticate(email, password)
+            # Turn credential stuffing away before paying for a hash
+            limiter.limit(
+                f'login:ip:{request.remote_addr}',
+                current_app.config['LOGIN_RATE_LIMIT_IP'],
+                )
+            limiter.limit(
+                f'login:email:{email.lower()}',
+                current_app.config['LOGIN_RATE_LIMIT_EMAIL'],
+                )
+            # Return User model if valid, the password is verified on the
+            # hashing pool
+            user = hasher.authenticate(email, password)
             # If this user is valid, generate a new jwt token.
             if user:
                 auth_token = guard.encode_jwt_token(
@@ -149,6 +180,9 @@ class Refresh(Resource):
 class Logout(Resource):
     """ Log out as the currently authenticated user
 
+    The token's jti is revoked until its refresh window closes, so neither it
+    nor a token refreshed from it is accepted again.
+
     Returns:
     - 200 status code for successful logout
     """
@@ -158,6 +192,8 @@ class Logout(Resource):
         )
     def get(self):  # On a Get Request
         try:
+            data = get_jwt_data_from_app_context()
+            revocations.revoke(data['jti'], data['rf_exp'])
             response_object = {'message': 'Successfully logged out.'}
             return response_object, 200
         except Exception as e:
@@ -169,25 +205,39 @@ class Disable(Resource):
     """ Disable a user
 
     With elevated priviledges, the user is disabled and restricted from logging
-    in.
+    in.  A single UPDATE, when the payload has the ``version`` of the user the
+    admin looked at, it only applies to that version.
 
     Returns:
     - 201 status code for successfully disabled
+    - 400 when the email is missing or the version not an integer
     - 401 for invalid authentication
+    - 404 when there is no user with that email
+    - 409 when the user changed since ``version``
     """
     @flask_praetorian.roles_required('admin')
     @flask_praetorian.auth_required
+    @ns.expect(user_disable_fields, validate=True)
     @ns.doc(
         responses={
             201: 'Successfully Disabled User',
-            401: 'Invalid Authentication'
+            401: 'Invalid Authentication',
+            404: 'User not found',
+            409: 'User changed since version',
             }
         )
     def patch(self):  # On a Patch Request
-        user = UserModel.query.filter_by(
-            email=rp_api.payload['email']).one()
-        user.update(is_active=False)
-        return {f'message': 'disabled user {user.username}'}
+        email = rp_api.payload['email']
+        version = rp_api.payload.get('version')
+        try:
+            user = UserModel.update_one(
+                func.lower(UserModel.email) == func.lower(email),
+                version=version, returning=('username',), is_active=False)
+        except StaleDataError:
+            rp_api.abort(409, f'User changed since version {version}: {email}')
+        if user is None:
+            rp_api.abort(404, f'User Not Found by email {email}')
+        return {'message': f'disabled user {user.username}'}
 
 
 @ns.route('/status')
@@ -199,16 +249,20 @@ class Status(Resource):
 
     Returns:
     - 200 status code with user model
+    - 304 not modified, the If-None-Match ETag is current
     """
     @flask_praetorian.auth_required
     @ns.doc(
-        responses={200: 'Pong'}
+        responses={200: 'Pong', 304: 'Not Modified'}
         )
-    @ns.marshal_with(user_fields, code=200)
+    @serialize_with(user_fields, code=200)
     def get(self):  # On a Get Request
         try:
-            user = UserModel.get_by_id(
-                record_id=flask_praetorian.current_user().id)
-            return user, 200
+            # the id claim is enough, identify serves the row from the
+            # identity cache when it can
+            response = user_response(flask_praetorian.current_user_id())
+            if response is None:
+                return None, 200
+            return response
         except Exception as e:
             rp_api.abort(400, e)
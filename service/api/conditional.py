@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Strong ETags and conditional GETs for versioned rows
+
+A row's representation is named by the serializer's tag, the row id and its
+``version`` (bumped by every UPDATE, see ``User.version``), so checking
+``If-None-Match`` needs neither the body nor, when the row comes from the
+identity cache, a query.  A page is named by a digest of its rows' ids and
+versions.
+"""
+import hashlib
+
+from flask import current_app, request
+from werkzeug.http import quote_etag
+
+
+def _etag(serializer, value):
+    mask = request.headers.get(current_app.config['RESTPLUS_MASK_HEADER'])
+    if mask:
+        # a fields mask is another representation of the same rows
+        value += '-' + hashlib.sha1(mask.encode()).hexdigest()[:8]
+    return f'{serializer.tag}-{value}'
+
+
+def row_etag(serializer, row):
+    """ETag of a row's representation"""
+    return _etag(serializer, f'{row.id}-{row.version}')
+
+
+def page_etag(serializer, rows, *extra):
+    """ETag of a page of rows, ``extra`` being whatever else the response
+    says, the next page's cursor for instance
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for row in rows:
+        digest.update(b'%d.%d,' % (row.id, row.version))
+    for value in extra:
+        digest.update(repr(value).encode())
+    return _etag(serializer, digest.hexdigest())
+
+
+def fresh(etag):
+    """Whether the client's copy, named by If-None-Match, is current"""
+    # If-None-Match uses the weak comparison
+    return request.if_none_match.contains_weak(etag)
+
+
+def not_modified(etag):
+    """A 304, without a body"""
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def etag_headers(etag, headers=None):
+    """Response headers carrying ``etag``"""
+    headers = dict(headers or {})
+    headers['ETag'] = quote_etag(etag)
+    return headers
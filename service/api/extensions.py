@@ -1,17 +1,28 @@
 from flask_cors import CORS
-from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
-from flask_debugtoolbar import DebugToolbarExtension
-from flask_praetorian import Praetorian
+from service.api.hashing import HashingExecutor
+from service.api.metrics import RequestMetrics
+from service.api.pool import PoolMetrics
+from service.api.profiler import RequestProfiler
+from service.api.queries import QueryTracker
+from service.api.ratelimit import RateLimiter
+from service.api.tokens import CachingPraetorian
 
 # Give us an ORM to work with
 db = SQLAlchemy()
-# Migrating database models for SQL Alchemy
-migrate = Migrate()
+# Connection pool gauges
+pool_metrics = PoolMetrics()
+# SQL statements per request, Server-Timing and N+1 warnings
+query_tracker = QueryTracker()
+# Prometheus request, SQL and pool metrics
+metrics = RequestMetrics()
+# Stack samples of requests an admin asked to profile
+profiler = RequestProfiler()
 # To allow services to communicate with this
 cors = CORS()
-# User Security
-guard = Praetorian()
-# Debugging Toolbar...(might be unneeded now that we don't use flask's
-# frontend)
-toolbar = DebugToolbarExtension()
+# User Security, verified tokens are cached per worker
+guard = CachingPraetorian()
+# Password hashing off the request worker
+hasher = HashingExecutor()
+# Login attempt budgets shared by the workers of a node
+limiter = RateLimiter()
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+import time
+from concurrent.futures import TimeoutError
+from functools import lru_cache, partial
+
+from flask_praetorian.exceptions import (
+    AuthenticationError,
+    MissingUserError,
+    PraetorianError,
+    )
+from passlib.context import CryptContext
+from passlib.exc import MissingBackendError
+
+from service.api.metrics import HASH_SECONDS
+
+
+class HashingUnavailable(PraetorianError):
+    """The hashing pool is saturated or a hash did not finish in time"""
+    status_code = 503
+
+
+# These run inside the pool's worker processes.  The password context is
+# shipped as its serialized policy and rebuilt once per process.
+@lru_cache(maxsize=8)
+def _context(policy):
+    return CryptContext.from_string(policy)
+
+
+def _hash(policy, raw_password):
+    return _context(policy).hash(raw_password)
+
+
+def _hash_many(policy, raw_passwords):
+    return [_context(policy).hash(raw) for raw in raw_passwords]
+
+
+def _verify(policy, raw_password, hashed_password):
+    return _context(policy).verify(raw_password, hashed_password)
+
+
+def _verify_and_update(policy, raw_password, hashed_password):
+    return _context(policy).verify_and_update(raw_password, hashed_password)
+
+
+# Costs tried by ``calibrate``, argon2 settings are (time_cost, memory KiB)
+CALIBRATION_CANDIDATES = (
+    [('pbkdf2_sha512', {'rounds': rounds})
+     for rounds in (25000, 50000, 100000, 200000, 400000)]
+    + [('bcrypt', {'rounds': rounds}) for rounds in range(10, 15)]
+    + [('argon2', {'rounds': rounds, 'memory_cost': memory})
+       for rounds, memory in ((2, 19456), (2, 65536), (3, 65536),
+                              (4, 131072))]
+    )
+
+
+def policy_options(scheme, settings):
+    """CryptContext options that pin ``scheme`` to exactly ``settings``
+
+    Pinning the min and max rounds to the default makes ``needs_update`` flag
+    any stored hash made with another cost, in either direction, so it gets
+    rehashed on the next login.
+    """
+    options = {}
+    for key, value in settings.items():
+        if key == 'rounds':
+            for bound in ('default_rounds', 'min_rounds', 'max_rounds'):
+                options[f'{scheme}__{bound}'] = value
+        else:
+            options[f'{scheme}__{key}'] = value
+    return options
+
+
+def calibrate(target_ms, samples=3, schemes=None,
+              candidates=CALIBRATION_CANDIDATES):
+    """Time each candidate scheme and cost on this machine
+
+    Returns every measurement and the cheapest candidate that still takes at
+    least ``target_ms`` per hash (or the slowest one if none do).  Schemes
+    without an installed backend are skipped.
+    """
+    results = []
+    for scheme, settings in candidates:
+        if schemes and scheme not in schemes:
+            continue
+        ctx = CryptContext(
+            schemes=[scheme], **policy_options(scheme, settings))
+        timings = []
+        try:
+            for _ in range(samples):
+                start = time.perf_counter()
+                ctx.hash('calibration-password')
+                timings.append((time.perf_counter() - start) * 1000)
+        except MissingBackendError:
+            continue
+        results.append({
+            'scheme': scheme,
+            'settings': settings,
+            'ms': round(sorted(timings)[len(timings) // 2], 2),
+            })
+
+    if not results:
+        return results, None
+    meets_target = [r for r in results if r['ms'] >= target_ms]
+    if meets_target:
+        return results, min(meets_target, key=lambda r: r['ms'])
+    return results, max(results, key=lambda r: r['ms'])
+
+
+class HashingExecutor(object):
+    """Runs password hashing and verification on a bounded process pool
+
+    The KDF behind ``guard.hash_password`` is deliberately slow, running it on
+    the request worker blocks every other request that worker could serve.
+    Calls are handed to a pool of processes instead, at most ``max_pending``
+    may be queued or running at once and each waits at most ``timeout``
+    seconds.  Anything over those limits raises ``HashingUnavailable`` (503).
+
+    A pool size of 0 hashes inline, which is what the test configs use.
+    """
+
+    def __init__(self):
+        self.guard = None
+        self.workers = 0
+        self.max_pending = 0
+        self.timeout = None
+        self._pool = None
+        self._pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def init_app(self, app, guard):
+        self.shutdown()
+        self.guard = guard
+        self.workers = app.config.get('HASHING_POOL_SIZE')
+        if self.workers is None:
+            self.workers = os.cpu_count() or 1
+        self.max_pending = app.config.get('HASHING_MAX_PENDING') \
+            or max(self.workers, 1) * 4
+        self.timeout = app.config.get('HASHING_TIMEOUT', 10)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._reset_stats()
+
+        settings_path = app.config.get('PASSWORD_HASH_SETTINGS')
+        if settings_path and os.path.exists(settings_path):
+            with open(settings_path) as fh:
+                self.apply_settings(json.load(fh))
+
+    def apply_settings(self, settings):
+        """Make a calibrated scheme and cost the default for new hashes
+
+        Every other scheme is deprecated, so existing hashes are upgraded
+        (or downgraded) on login.
+        """
+        scheme = settings['scheme']
+        self.guard.pwd_ctx.update(
+            default=scheme,
+            deprecated='auto',
+            **policy_options(scheme, settings['settings'])
+            )
+
+    def _reset_stats(self):
+        self.pending = 0
+        self.rejected = 0
+        self.timeouts = 0
+        # hash_many counts chunks
+        self.calls = {'hash': 0, 'hash_many': 0, 'verify': 0}
+        self.seconds = {'hash': 0.0, 'hash_many': 0.0, 'verify': 0.0}
+        self.max_seconds = {'hash': 0.0, 'hash_many': 0.0, 'verify': 0.0}
+
+    @property
+    def pool(self):
+        """The process pool, created lazily so each forked worker owns one"""
+        if self._pid != os.getpid():
+            # not imported up front, the test configs never start a pool
+            from concurrent.futures import ProcessPoolExecutor
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            self._pid = os.getpid()
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.shutdown()
+        self._pool = None
+        self._pid = None
+
+    def _run(self, operation, func, *args):
+        PraetorianError.require_condition(
+            self.guard is not None,
+            "HashingExecutor must be initialized before it is used",
+            )
+        policy = self.guard.pwd_ctx.to_string()
+        # one deadline for the wait for a slot and the wait for the result
+        deadline = None if self.timeout is None \
+            else time.monotonic() + self.timeout
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.rejected += 1
+            raise HashingUnavailable('Password hashing is over capacity')
+        with self._lock:
+            self.pending += 1
+        start = time.perf_counter()
+        try:
+            if not self.workers:
+                try:
+                    return func(policy, *args)
+                finally:
+                    self._release()
+            try:
+                future = self.pool.submit(func, policy, *args)
+            except Exception:
+                self._release()
+                raise
+            # a task that timed out keeps running and keeps its slot until
+            # it is done, so max_pending bounds the work the pool really has
+            future.add_done_callback(self._release)
+            remaining = None if deadline is None \
+                else max(deadline - time.monotonic(), 0)
+            try:
+                return future.result(timeout=remaining)
+            except TimeoutError:
+                future.cancel()
+                with self._lock:
+                    self.timeouts += 1
+                raise HashingUnavailable('Password hashing timed out')
+        finally:
+            elapsed = time.perf_counter() - start
+            HASH_SECONDS.labels(operation).observe(elapsed)
+            with self._lock:
+                self.calls[operation] += 1
+                self.seconds[operation] += elapsed
+                self.max_seconds[operation] = max(
+                    self.max_seconds[operation], elapsed)
+
+    def _release(self, future=None):
+        """Give back a slot, once its task is done"""
+        self._slots.release()
+        with self._lock:
+            self.pending -= 1
+
+    def hash(self, raw_password):
+        """Hash a plaintext password with the guard's password context"""
+        return self._run('hash', _hash, raw_password)
+
+    def hash_many(self, raw_passwords, chunk_size=16):
+        """Hash a batch of passwords, on at most half the pool
+
+        Meant for bulk imports.  The batch is hashed in chunks of
+        ``chunk_size``, each taking a slot like a single hash does and at
+        most half the pool's processes at once, so logins keep the rest.
+        """
+        if not self.workers:
+            return self._run('hash_many', _hash_many, raw_passwords)
+        # not imported up front, like the process pool
+        from concurrent.futures import ThreadPoolExecutor
+        chunks = [raw_passwords[i:i + chunk_size]
+                  for i in range(0, len(raw_passwords), chunk_size)]
+        with ThreadPoolExecutor(
+                max_workers=max(1, self.workers // 2)) as threads:
+            return [hashed for hashes in threads.map(
+                partial(self._run, 'hash_many', _hash_many), chunks)
+                for hashed in hashes]
+
+    def verify(self, raw_password, hashed_password):
+        """Verify a plaintext password against a stored hash"""
+        return self._run('verify', _verify, raw_password, hashed_password)
+
+    def authenticate(self, username, password):
+        """Pool backed equivalent of ``guard.authenticate``
+
+        Looks the user up and verifies the password, raising the same
+        flask-praetorian errors.  A password stored with outdated hash
+        settings is rehashed with the current ones and saved.
+        """
+        user = self.guard.user_class.lookup(username)
+        MissingUserError.require_condition(
+            user is not None,
+            'Could not find the requested user',
+            )
+        valid, new_hash = self._run(
+            'verify', _verify_and_update, password, user.password)
+        AuthenticationError.require_condition(
+            valid,
+            'The password is incorrect',
+            )
+        if new_hash:
+            user.update(password=new_hash)
+        return user
+
+    def stats(self):
+        """Queue depth and hash latency counters"""
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'pending': self.pending,
+                'max_pending': self.max_pending,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'calls': dict(self.calls),
+                'seconds_total': dict(self.seconds),
+                'seconds_max': dict(self.max_seconds),
+                }
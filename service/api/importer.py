@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import json
+import tempfile
+import time
+
+from sqlalchemy import exc
+
+from service.api.extensions import db, guard, hasher
+from service.api.models import User, backfill_roles, unique_violation
+
+
+INSERT_COLUMNS = (
+    'username', 'email', 'password', 'admin', 'roles', 'role_mask')
+# Text fields of a record and the users column each one is stored in
+TEXT_FIELDS = {
+    'username': 'username',
+    'email': 'email',
+    'password': None,
+    'password_hash': 'password',
+    'roles': 'roles',
+    }
+
+
+class ImportReport(object):
+    """Outcome of a bulk import, failures are reported per input row"""
+
+    def __init__(self, max_errors=1000):
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        self.max_errors = max_errors
+        self.started = time.perf_counter()
+
+    def fail(self, row, error):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'row': row, 'error': str(error)})
+
+    def to_json(self):
+        return {
+            'imported': self.imported,
+            'failed': self.failed,
+            'errors': self.errors,
+            'seconds': round(time.perf_counter() - self.started, 3),
+            }
+
+
+def read_rows(stream, fmt):
+    """Yield ``(row number, record or exception)`` from a csv/jsonl stream"""
+    if fmt == 'csv':
+        for number, record in enumerate(csv.DictReader(stream), start=2):
+            yield number, record
+    elif fmt == 'jsonl':
+        for number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield number, json.loads(line)
+            except ValueError as e:
+                yield number, e
+    else:
+        raise ValueError(f'Unsupported import format: {fmt}')
+
+
+def spool(stream, fmt, max_rows, max_memory=8 * 1024 * 1024):
+    """Copy an upload to a temporary file, counting its rows on the way
+
+    Returns the file, rewound, or None when it has more than ``max_rows``
+    rows so nothing of it is imported.  Lines are counted (less the csv
+    header), a quoted newline in a csv counts as another row.
+    """
+    spooled = tempfile.SpooledTemporaryFile(
+        max_size=max_memory, mode='w+', encoding='utf-8', newline='')
+    start = 0 if fmt == 'csv' else 1
+    for rows, line in enumerate(stream, start=start):
+        if rows > max_rows:
+            spooled.close()
+            return None
+        spooled.write(line)
+    spooled.seek(0)
+    return spooled
+
+
+def _as_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 't', 'yes', 'y')
+    return bool(value)
+
+
+def _check_text(record):
+    """Text fields must be strings that fit their column
+
+    Checked before the insert, so a bad value fails its row and not the
+    whole batch (a COPY stops at the first value too long).
+    """
+    for field, column in TEXT_FIELDS.items():
+        value = record.get(field)
+        if value is None:
+            continue
+        if not isinstance(value, str):
+            raise ValueError(f"'{field}' must be a string")
+        length = column and User.__table__.c[column].type.length
+        if length and len(value) > length:
+            raise ValueError(
+                f"'{field}' is longer than {length} characters")
+
+
+def _clean(record):
+    """Validate a raw record, returning the row to insert
+
+    Records carry username, email, optional admin and roles, and either a
+    password or a password_hash.  A hash the password context recognises
+    (e.g. from a legacy directory) is stored as is and upgraded on the next
+    login.
+    """
+    if isinstance(record, Exception):
+        raise record
+    if not isinstance(record, dict):
+        raise ValueError('Row must be an object')
+    for column in ('username', 'email'):
+        if not record.get(column):
+            raise ValueError(f"'{column}' is a required property")
+    _check_text(record)
+    row = {
+        'username': record['username'],
+        'email': record['email'],
+        'admin': _as_bool(record.get('admin') or False),
+        'roles': record.get('roles') or None,
+        # users with roles are left for backfill_roles
+        'role_mask': None if record.get('roles') else 0,
+        'password': None,
+        }
+    if record.get('password_hash'):
+        if not guard.pwd_ctx.identify(record['password_hash']):
+            raise ValueError('Unrecognised password_hash scheme')
+        row['password'] = record['password_hash']
+    elif record.get('password'):
+        row['raw_password'] = record['password']
+    else:
+        raise ValueError("'password' is a required property")
+    return row
+
+
+def _insert_copy(rows):
+    """Postgres fast path, COPY into a temp table and insert what's new
+
+    Each staged row carries its row number, the rows that come back from
+    the INSERT name the numbers inserted.  Rows of a batch never share a
+    username (see ``_duplicates``), so the join back is unambiguous.
+
+    Returns the rows that were not inserted because they already exist.
+    """
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute(
+        'CREATE TEMP TABLE IF NOT EXISTS users_import '
+        '(ordinal integer, username varchar(128), email varchar(128), '
+        'password varchar(255), admin boolean, roles varchar, '
+        'role_mask bigint) ON COMMIT DELETE ROWS')
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for number, row in rows:
+        writer.writerow([number] + [
+            '\\N' if row[column] is None else row[column]
+            for column in INSERT_COLUMNS])
+    buffer.seek(0)
+    columns = ', '.join(INSERT_COLUMNS)
+    cursor.copy_expert(
+        f"COPY users_import (ordinal, {columns}) FROM STDIN "
+        f"WITH (FORMAT csv, NULL '\\N')", buffer)
+    cursor.execute(
+        f'WITH inserted AS ('
+        f'INSERT INTO users ({columns}) SELECT {columns} FROM users_import '
+        f'ORDER BY ordinal ON CONFLICT DO NOTHING RETURNING username) '
+        f'SELECT staged.ordinal FROM inserted '
+        f'JOIN users_import AS staged USING (username)')
+    inserted = {ordinal for (ordinal,) in cursor.fetchall()}
+    return [(n, row) for n, row in rows if n not in inserted]
+
+
+def _insert_many(rows):
+    """Portable path, one executemany, row by row only if it conflicts
+
+    Returns ``(row number, row, error)`` for every row not inserted.
+    """
+    table = User.__table__
+    try:
+        db.session.execute(table.insert(), [row for _, row in rows])
+        db.session.commit()
+        return []
+    except exc.IntegrityError:
+        db.session.rollback()
+    failures = []
+    for number, row in rows:
+        try:
+            db.session.execute(table.insert(), row)
+            db.session.commit()
+        except exc.IntegrityError as e:
+            db.session.rollback()
+            failures.append((number, row, e))
+    return failures
+
+
+def _duplicates(rows):
+    """Split off rows repeating a username or email of an earlier row
+
+    Returns the rows to insert and ``(row number, error)`` for the others.
+    Emails are unique regardless of case.
+    """
+    seen = {'username': set(), 'email': set()}
+    unique, failures = [], []
+    for number, row in rows:
+        keys = {'username': row['username'], 'email': row['email'].lower()}
+        column = next((c for c in keys if keys[c] in seen[c]), None)
+        if column is not None:
+            failures.append((number, f"{column.capitalize()} already "
+                                     f"exists: {row[column]}"))
+            continue
+        for c in keys:
+            seen[c].add(keys[c])
+        unique.append((number, row))
+    return unique, failures
+
+
+def insert_rows(rows):
+    """Insert ``(row number, row)`` pairs of INSERT_COLUMNS and commit
+
+    COPY on postgres, executemany elsewhere.  Returns ``(row number, error)``
+    for the rows that already exist, in the table or earlier in ``rows``.
+    """
+    rows, failures = _duplicates(rows)
+    if rows and db.session.get_bind().dialect.name == 'postgresql':
+        failures += [
+            (number, f"Username or email already exists: {row['username']}")
+            for number, row in _insert_copy(rows)]
+    elif rows:
+        for number, row, e in _insert_many(rows):
+            column = unique_violation(e)
+            failures.append((number, e if column is None else
+                             f"{column.capitalize()} already exists: "
+                             f"{row[column]}"))
+    db.session.commit()
+    return sorted(failures, key=lambda failure: failure[0])
+
+
+def _flush_batch(batch, report):
+    to_hash = [row for _, row in batch if 'raw_password' in row]
+    hashes = hasher.hash_many([row.pop('raw_password') for row in to_hash])
+    for row, hashed in zip(to_hash, hashes):
+        row['password'] = hashed
+
+    failures = insert_rows(batch)
+    for number, error in failures:
+        report.fail(number, error)
+    report.imported += len(batch) - len(failures)
+
+
+def import_users(stream, fmt, batch_size=1000, max_errors=1000):
+    """Stream users from a csv or jsonl file into the users table
+
+    Rows are validated one at a time, passwords of a batch are hashed across
+    the hashing pool and each batch is inserted in one go (COPY on postgres,
+    executemany elsewhere) and committed.  Invalid and duplicate rows are
+    skipped and reported, they do not abort the import.  Roles are assigned
+    once every batch is in.
+    """
+    report = ImportReport(max_errors=max_errors)
+    batch = []
+    for number, record in read_rows(stream, fmt):
+        try:
+            batch.append((number, _clean(record)))
+        except ValueError as e:
+            report.fail(number, e)
+        if len(batch) >= batch_size:
+            _flush_batch(batch, report)
+            batch = []
+    if batch:
+        _flush_batch(batch, report)
+    backfill_roles(batch_size)
+    return report
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import hmac
+import os
+import time
+
+from flask import Response, abort, current_app, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    )
+
+from service.api.queries import QueryTracker
+
+
+# Everything is declared once per process, prometheus_client keeps the values
+# in per-process files when PROMETHEUS_MULTIPROC_DIR is set, see
+# gunicorn_config.py
+REQUEST_SECONDS = Histogram(
+    'flask_auth_request_duration_seconds', 'Time to build a response',
+    ('namespace', 'route', 'method'),
+    )
+REQUESTS = Counter(
+    'flask_auth_requests_total', 'Responses by status code',
+    ('namespace', 'route', 'method', 'status'),
+    )
+REQUEST_QUERIES = Histogram(
+    'flask_auth_request_db_queries', 'SQL statements run by a request',
+    ('namespace', 'route'),
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100),
+    )
+REQUEST_DB_SECONDS = Histogram(
+    'flask_auth_request_db_seconds', 'Time a request spent in SQL',
+    ('namespace', 'route'),
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1),
+    )
+HASH_SECONDS = Histogram(
+    'flask_auth_password_hash_seconds', 'Password hash and verify time',
+    ('operation',),
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+    )
+JWT_SECONDS = Histogram(
+    'flask_auth_jwt_seconds', 'JWT encode and decode time',
+    ('operation',),
+    buckets=(.00005, .0001, .00025, .0005, .001, .0025, .005, .01),
+    )
+POOL_CONNECTIONS = Gauge(
+    'flask_auth_db_pool_connections', 'Connections of the worker pools',
+    ('state',), multiprocess_mode='livesum',
+    )
+POOL_EVENTS = Counter(
+    'flask_auth_db_pool_events_total', 'Connection pool events',
+    ('event',),
+    )
+
+
+class RequestMetrics(object):
+    """Request, SQL and pool metrics for the Prometheus ``/metrics`` view
+
+    Every request is timed and counted under its restplus namespace and url
+    rule (never the raw path, ids would blow up the label sets).  SQL counts
+    and time come from the ``QueryTracker``.  Pool gauges are read off this
+    worker's pool after each request.
+    """
+
+    def __init__(self):
+        self.api = None
+        self.pool_metrics = None
+        self.enabled = False
+        self._namespaces = {}
+
+    def init_app(self, app, api, pool_metrics):
+        self.api = api
+        self.pool_metrics = pool_metrics
+        self.enabled = app.config.get('METRICS_ENABLED', True)
+        self._namespaces = {}
+        if not self.enabled:
+            return
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def namespace(self, rule):
+        """Name of the restplus namespace serving a url rule"""
+        if rule not in self._namespaces:
+            prefix = self.api.blueprint.url_prefix or ''
+            matches = [ns for ns in self.api.namespaces if ns.path
+                       and rule.startswith(prefix + ns.path)]
+            self._namespaces[rule] = max(
+                matches, key=lambda ns: len(ns.path)).name \
+                if matches else 'none'
+        return self._namespaces[rule]
+
+    @staticmethod
+    def _before_request():
+        g.metrics_start = time.perf_counter()
+
+    def _after_request(self, response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        namespace = self.namespace(route)
+        REQUEST_SECONDS.labels(namespace, route, request.method).observe(
+            time.perf_counter() - start)
+        REQUESTS.labels(
+            namespace, route, request.method, response.status_code).inc()
+        queries = QueryTracker.current()
+        if queries is not None:
+            REQUEST_QUERIES.labels(namespace, route).observe(queries.count)
+            REQUEST_DB_SECONDS.labels(namespace, route).observe(
+                queries.seconds)
+        self.update_pool()
+        return response
+
+    def update_pool(self):
+        stats = self.pool_metrics.stats()
+        for state in ('size', 'checkedin', 'checkedout', 'overflow'):
+            if state in stats:
+                POOL_CONNECTIONS.labels(state).set(stats[state])
+
+    def view(self):
+        """Everything collected, from every worker in multiprocess mode
+
+        Only served to scrapers sending ``METRICS_TOKEN`` as a bearer token,
+        without one configured the endpoint is not there.
+        """
+        expected = current_app.config.get('METRICS_TOKEN')
+        if not current_app.config.get('METRICS_ENABLED', True) \
+                or not expected:
+            abort(404)
+        scheme, _, token = request.headers.get(
+            'Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(
+                token.encode(), expected.encode()):
+            abort(401)
+        self.update_pool()
+        registry = REGISTRY
+        if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
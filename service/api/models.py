@@ -1,5 +1,232 @@
 # -*- coding: utf-8 -*-
-from service.api.extensions import guard, db
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import exc, func, inspect
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import load_only, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.orm.util import identity_key
+
+from service.api.extensions import db, hasher
+
+
+class IdentityCache(object):
+    """Per-worker LRU cache of loaded rows, keyed by identity, with a TTL.
+
+    Only a snapshot of the loaded column values is kept, never the instance
+    itself, so nothing is shared between sessions.  A hit is merged into the
+    current session without emitting a query, which also means later
+    ``query.get`` calls for the same row are served from the identity map.
+    Writes going through ``CRUDMixin`` invalidate the entry, anything else is
+    bounded by the TTL.
+    """
+
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.maxsize = app.config.get('IDENTITY_CACHE_MAXSIZE', self.maxsize)
+        self.ttl = app.config.get('IDENTITY_CACHE_TTL', self.ttl)
+        self.clear()
+
+    def load(self, model, ident):
+        """Return a session bound instance of a cached row, or None"""
+        key = identity_key(model, ident)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            snapshot = entry[1]
+
+        instance = model.__mapper__.class_manager.new_instance()
+        # committed values, no attribute events (e.g. validators) fire
+        for attr, value in snapshot.items():
+            set_committed_value(instance, attr, value)
+        make_transient_to_detached(instance)
+        return db.session.merge(instance, load=False)
+
+    def store(self, instance):
+        """Snapshot the loaded columns of a persistent instance"""
+        state = inspect(instance)
+        if not self.maxsize or state.key is None:
+            return instance
+        snapshot = {
+            attr: state.dict[attr]
+            for attr in state.mapper.column_attrs.keys()
+            if attr in state.dict
+            }
+        with self._lock:
+            self._entries[state.key] = (time.monotonic() + self.ttl, snapshot)
+            self._entries.move_to_end(state.key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return instance
+
+    def invalidate(self, key):
+        """Drop a cached row by its identity key"""
+        if key is not None:
+            with self._lock:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Hit/miss counters and current size"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                }
+
+
+# Rows loaded by User.identify on every authenticated request
+identity_cache = IdentityCache()
+
+
+class RevocationList(object):
+    """Per-worker copy of the revoked token ids, checked on every request.
+
+    flask-praetorian asks ``is_revoked`` for the jti of every token it
+    decodes, that is a single dict lookup and never a query.  Revocations are
+    persisted in ``revoked_tokens`` and every worker pulls the rows added
+    since its last sync on a background thread, so a logout reaches the other
+    workers and nodes within ``sync_interval`` seconds.  Entries are dropped
+    once the token they revoke could no longer be used anyway, and expired
+    rows are deleted every ``prune_interval`` seconds.
+
+    A sync interval of 0 disables the thread, the tests call ``sync``.
+    """
+
+    # Ids are handed out before commit, so a slow transaction can commit an
+    # id lower than one we've already seen.  Each sync rereads this many.
+    overlap = 100
+
+    def __init__(self, sync_interval=5, prune_interval=3600):
+        self.sync_interval = sync_interval
+        self.prune_interval = prune_interval
+        self.app = None
+        self._revoked = {}
+        self._last_id = 0
+        self._next_prune = 0
+        self._pid = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self._stop.set()
+        self.app = app
+        self.sync_interval = app.config.get(
+            'TOKEN_REVOCATION_SYNC_INTERVAL', self.sync_interval)
+        self.prune_interval = app.config.get(
+            'TOKEN_REVOCATION_PRUNE_INTERVAL', self.prune_interval)
+        self._pid = None
+        self.clear()
+
+    def is_revoked(self, jti):
+        """flask-praetorian's ``is_blacklisted`` callback"""
+        if self._pid != os.getpid():
+            self._start()
+        return jti in self._revoked
+
+    def _start(self):
+        """Load the list and start syncing, once per (forked) worker"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+        self.sync()
+        if self.sync_interval:
+            threading.Thread(
+                target=self._run, args=(self._stop,),
+                name='token-revocation-sync', daemon=True,
+                ).start()
+
+    def _run(self, stop):
+        while not stop.wait(self.sync_interval):
+            with self.app.app_context():
+                try:
+                    self.sync()
+                    if time.monotonic() >= self._next_prune:
+                        self.prune()
+                except Exception:
+                    self.app.logger.exception('Token revocation sync failed')
+                finally:
+                    db.session.remove()
+
+    def revoke(self, jti, expires_at):
+        """Revoke a token id until ``expires_at`` (a unix timestamp)"""
+        try:
+            RevokedToken.insert(jti=jti, expires_at=int(expires_at))
+        except exc.IntegrityError:
+            # already revoked, by a concurrent request
+            pass
+        with self._lock:
+            self._revoked[jti] = int(expires_at)
+
+    def sync(self):
+        """Pull the revocations recorded since the last sync"""
+        now = int(time.time())
+        rows = db.session.query(
+            RevokedToken.id, RevokedToken.jti, RevokedToken.expires_at,
+            ).filter(
+            RevokedToken.id > self._last_id - self.overlap,
+            RevokedToken.expires_at > now,
+            ).all()
+        with self._lock:
+            for row_id, jti, expires_at in rows:
+                self._revoked[jti] = expires_at
+                self._last_id = max(self._last_id, row_id)
+            for jti in [jti for jti, expires_at in self._revoked.items()
+                        if expires_at <= now]:
+                del self._revoked[jti]
+        return len(rows)
+
+    def prune(self):
+        """Delete the rows of tokens that have expired"""
+        self._next_prune = time.monotonic() + self.prune_interval
+        deleted = RevokedToken.query.filter(
+            RevokedToken.expires_at <= int(time.time()),
+            ).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+    def clear(self):
+        with self._lock:
+            self._revoked.clear()
+            self._last_id = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._revoked),
+                'last_id': self._last_id,
+                'sync_interval': self.sync_interval,
+                }
+
+
+# Revoked jtis, checked by flask-praetorian on every authenticated request
+revocations = RevocationList()
 
 
 class CRUDMixin(object):
@@ -16,23 +243,121 @@ class CRUDMixin(object):
         except Exception as e:
             return e
 
+    @classmethod
+    def query_only(cls, *columns):
+        """Query that only loads the given columns, the rest are deferred"""
+        return cls.query.options(load_only(*columns))
+
+    @classmethod
+    def insert(cls, **kwargs):
+        """Create a new record with a single INSERT.
+
+        Unlike ``create`` errors are raised (after a rollback), so unique
+        constraint violations can be reported.  The flushed values are kept
+        across the commit, reading them back does not reload the row.
+        """
+        instance = cls(**kwargs)
+        state = inspect(instance)
+        db.session.add(instance)
+        try:
+            db.session.flush()
+            # columns left unset without a server default were inserted NULL
+            flushed = {
+                prop.key: state.dict.get(prop.key)
+                for prop in state.mapper.column_attrs
+                if prop.key in state.dict
+                or prop.columns[0].server_default is None
+                }
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        for attr, value in flushed.items():
+            set_committed_value(instance, attr, value)
+        return instance
+
+    @classmethod
+    def update_one(cls, where, version=None, returning=(), commit=True,
+                   **values):
+        """Update the row ``where`` picks with a single UPDATE
+
+        ``where`` must pick at most one row by a unique key, and not on the
+        columns being set.  Nothing is loaded first.  A versioned model's
+        ``version_id_col`` is bumped by the same statement, and with
+        ``version`` only that version of the row is updated, a row found at
+        another version raises ``StaleDataError`` (after a rollback) like a
+        conflicting flush would.
+
+        Returns the primary key and ``returning`` columns of the updated
+        row, read by the UPDATE's RETURNING on Postgres and by a SELECT on
+        databases without it.  None when no row matched.
+        """
+        table = cls.__table__
+        columns = list(cls.__mapper__.primary_key) + [
+            table.c[name] for name in returning]
+        version_col = cls.__mapper__.version_id_col
+        statement = table.update().where(where).values(**values)
+        if version_col is not None:
+            statement = statement.values({version_col: version_col + 1})
+            if version is not None:
+                statement = statement.where(version_col == version)
+
+        try:
+            row = cls._execute_update(statement, columns, where)
+            # the one extra lookup is on the failure path
+            if row is None and version is not None and db.session.query(
+                    cls.query.filter(where).exists()).scalar():
+                raise StaleDataError(
+                    f'{cls.__name__} changed since version {version}')
+            if commit:
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        if row is not None:
+            key = identity_key(
+                cls, tuple(row[:len(cls.__mapper__.primary_key)]))
+            identity_cache.invalidate(key)
+            instance = db.session.identity_map.get(key)
+            if instance is not None:
+                db.session.expire(instance)
+        return row
+
+    @staticmethod
+    def _execute_update(statement, columns, where):
+        """Run an UPDATE, returning the updated row's ``columns`` or None"""
+        if db.session.get_bind().dialect.implicit_returning:
+            return db.session.execute(statement.returning(*columns)).first()
+        if db.session.execute(statement).rowcount:
+            # sqlite, the where clause still picks the row
+            return db.session.query(*columns).filter(where).first()
+        return None
+
     def update(self, commit=True, **kwargs):
         """Update specific fields of a record."""
         for attr, value in kwargs.items():
             setattr(self, attr, value)
+        identity_cache.invalidate(inspect(self).key)
         return commit and self.save() or self
 
     def save(self, commit=True):
         """Save the record."""
+        # grab the key first, reading it after a commit would reload the row
+        key = inspect(self).key
         db.session.add(self)
         if commit:
             db.session.commit()
+        identity_cache.invalidate(key)
         return self
 
     def delete(self, commit=True):
         """Remove the record from the database."""
+        key = inspect(self).key
         db.session.delete(self)
-        return commit and db.session.commit()
+        result = commit and db.session.commit()
+        identity_cache.invalidate(key)
+        return result
 
 
 class Model(CRUDMixin, db.Model):
@@ -52,13 +377,37 @@ class SurrogatePK(object):
     id = db.Column(db.Integer, primary_key=True)
 
     @classmethod
-    def get_by_id(cls, record_id):
-        """Get record by ID."""
+    def get_by_id(cls, record_id, query=None):
+        """Get record by ID, optionally through a projected query."""
         if any((isinstance(record_id, (str, bytes)) and record_id.isdigit(),
                 isinstance(record_id, (int, float)))):
-            return cls.query.get(int(record_id))
+            return (query or cls.query).get(int(record_id))
         return None
 
+    @classmethod
+    def update_by_id(cls, record_id, version=None, returning=(), **values):
+        """Update a record by ID with a single UPDATE, see ``update_one``"""
+        return cls.update_one(
+            cls.id == record_id, version=version, returning=returning,
+            **values)
+
+
+def unique_violation(error):
+    """Name the column whose unique constraint an IntegrityError violated
+
+    Understands the sqlite error message and the postgres constraint name.
+    Returns None for any other integrity error.
+    """
+    orig = getattr(error, 'orig', error)
+    constraint = getattr(
+        getattr(orig, 'diag', None), 'constraint_name', None) or ''
+    message = str(orig)
+    for column in ('email', 'username'):
+        if f'_{column}_' in constraint or f'.{column}' in message \
+                or f'_{column}_' in message:
+            return column
+    return None
+
 
 def reference_col(
         tablename, nullable=False, pk_name="id",
@@ -80,6 +429,114 @@ def reference_col(
         )
 
 
+def split_roles(roles):
+    """Role names of a comma separated roles string"""
+    return [name.strip() for name in (roles or '').split(',') if name.strip()]
+
+
+user_roles = db.Table(
+    'user_roles',
+    db.Column('user_id', db.Integer,
+              db.ForeignKey('users.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Column('role_id', db.Integer,
+              db.ForeignKey('roles.id', ondelete='CASCADE'),
+              primary_key=True),
+    # the primary key covers user -> roles, this one role -> users
+    db.Index('ix_user_roles_role_id', 'role_id'),
+    )
+
+
+class Role(Model, SurrogatePK):
+    """A named role, each owns one bit of ``User.role_mask``
+
+    The name <-> bit mapping is kept per worker, roles are few and rarely
+    added, so checking or listing a user's roles never needs a query.
+    """
+
+    __tablename__ = 'roles'
+
+    name = db.Column(db.String(64), unique=True, nullable=False)
+    bit = db.Column(db.Integer, unique=True, nullable=False)
+
+    # role_mask is a signed 64 bit integer
+    max_roles = 63
+    _bits = {}
+    _names = {}
+
+    @classmethod
+    def load(cls):
+        """(Re)load the name <-> bit mapping"""
+        cls._bits = dict(db.session.query(cls.name, cls.bit).all())
+        cls._names = {bit: name for name, bit in cls._bits.items()}
+
+    @classmethod
+    def clear(cls):
+        cls._bits = {}
+        cls._names = {}
+
+    @classmethod
+    def get_or_create(cls, names):
+        """The roles with these names, adding the ones that don't exist"""
+        names = set(names)
+        if not names:
+            return []
+        roles = {role.name: role
+                 for role in cls.query.filter(cls.name.in_(names))}
+        missing = sorted(names - roles.keys())
+        if missing:
+            cls._lock_bits()
+            # added by another worker while this one waited for the lock
+            roles.update(
+                (role.name, role)
+                for role in cls.query.filter(cls.name.in_(missing)))
+            missing = sorted(names - roles.keys())
+            cls.load()
+            bit = max(cls._bits.values(), default=-1)
+            for name in missing:
+                bit += 1
+                if bit >= cls.max_roles:
+                    raise ValueError(f'No bit left for role: {name}')
+                roles[name] = cls(name=name, bit=bit)
+                db.session.add(roles[name])
+            # flushed right away so the next lookup in this transaction,
+            # autoflush or not, sees them
+            db.session.flush([roles[name] for name in missing])
+        for role in roles.values():
+            cls._bits[role.name] = role.bit
+            cls._names[role.bit] = role.name
+        return list(roles.values())
+
+    @staticmethod
+    def _lock_bits():
+        """Serialize adding roles, the next bit is the highest one plus one
+
+        Held until the transaction ends.  sqlite only has one writer.
+        """
+        if db.session.get_bind().dialect.name == 'postgresql':
+            db.session.execute('LOCK TABLE roles IN SHARE ROW EXCLUSIVE MODE')
+
+    @classmethod
+    def mask_for(cls, names):
+        """Bitmask of the named roles, None if one of them doesn't exist"""
+        if not set(names) <= cls._bits.keys():
+            cls.load()
+        mask = 0
+        for name in names:
+            if name not in cls._bits:
+                return None
+            mask |= 1 << cls._bits[name]
+        return mask
+
+    @classmethod
+    def names_for(cls, mask):
+        """Names of the roles set in a bitmask, in bit order"""
+        bits = [bit for bit in range(cls.max_roles) if mask >> bit & 1]
+        if not set(bits) <= cls._names.keys():
+            cls.load()
+        return [cls._names[bit] for bit in bits if bit in cls._names]
+
+
 class User(Model, SurrogatePK):
     """Base User model
 
@@ -94,38 +551,150 @@ class User(Model, SurrogatePK):
     password = db.Column(db.String(255), nullable=False)
     admin = db.Column(db.Boolean, default=False, nullable=False)
 
-    # flask-praetorian requirements
-    roles = db.Column(db.String)
+    # flask-praetorian requirements, roles is a comma separated list kept
+    # for compatibility, role_mask and assigned_roles are derived from it.
+    # Read only, set_roles writes the three together.
+    _roles = db.Column('roles', db.String)
+    # NULL until backfilled, see backfill_roles
+    role_mask = db.Column(db.BigInteger, default=0)
+    assigned_roles = db.relationship(
+        'Role', secondary=user_roles,
+        backref=db.backref('users', lazy='dynamic'))
     is_active = db.Column(
         db.Boolean(), default=True, server_default='true')
+    # Bumped whenever the access a token grants changes
+    token_generation = db.Column(
+        db.Integer, default=0, server_default='0', nullable=False)
+    # Bumped by every UPDATE of the row, the ETag of its representations
+    version = db.Column(db.Integer, server_default='1', nullable=False)
+
+    __mapper_args__ = {'version_id_col': version}
+
+    # What the API returns (users.user_fields) and its version, never the
+    # password hash
+    public_columns = ('id', 'username', 'email', 'admin', 'is_active',
+                      'version')
+    # What flask-praetorian needs to authorize a request
+    identity_columns = public_columns + (
+        '_roles', 'role_mask', 'token_generation')
+    # Changing any of these invalidates the tokens already issued
+    token_claim_columns = ('roles', 'is_active')
 
     def __init__(self, username, email, password):
         self.username = username
         self.email = email
-        self.password = guard.hash_password(password)
+        self.password = hasher.hash(password)
+
+    @hybrid_property
+    def roles(self):
+        """The roles string, set through ``set_roles``"""
+        return self._roles
+
+    def set_roles(self, roles):
+        """Set the roles string, with assigned_roles and role_mask
+
+        Roles that don't exist yet are added.  The tokens already issued to
+        a stored user no longer authorize, they carry the old roles.
+        """
+        names = split_roles(roles)
+        with db.session.no_autoflush:
+            self.assigned_roles = Role.get_or_create(names)
+        self.role_mask = Role.mask_for(names)
+        self._roles = roles
+        if inspect(self).persistent:
+            self.token_generation = User.token_generation + 1
 
     @property
     def rolenames(self):
-        """Explode role names on comma
+        """Role names, consumed by praetorian for the token's rls claim
 
-        self.roles is a string that contains a comma deliminated list of roles.
-        This returns a list, which get's consumed by a praetorian decorator to
-        parse.
+        Decoded from role_mask, rows not backfilled yet fall back to
+        exploding the roles string on comma.
         """
-        try:
-            return self.roles.split(',')
-        except Exception:
-            return []
+        if self.role_mask is None:
+            return split_roles(self.roles)
+        return Role.names_for(self.role_mask)
+
+    def has_roles(self, *names):
+        """Does the user hold all these roles, a bitwise check"""
+        mask = Role.mask_for(names)
+        if mask is None or self.role_mask is None:
+            return set(names) <= set(self.rolenames)
+        return self.role_mask & mask == mask
+
+    @classmethod
+    def query_by_role(cls, name):
+        """Users holding a role, through the ix_user_roles_role_id index"""
+        return cls.query.join(cls.assigned_roles).filter(Role.name == name)
+
+    def update(self, commit=True, **kwargs):
+        """Update specific fields, bumping the token generation when the
+        user's roles or status change.
+        """
+        if 'roles' in kwargs:
+            self.set_roles(kwargs.pop('roles'))
+        elif any(column in kwargs for column in self.token_claim_columns):
+            kwargs.setdefault(
+                'token_generation', User.token_generation + 1)
+        return super().update(commit=commit, **kwargs)
+
+    @classmethod
+    def update_one(cls, where, version=None, returning=(), commit=True,
+                   **values):
+        """``CRUDMixin.update_one``, bumping the token generation like
+        ``update``
+
+        Not for roles, the UPDATE would leave user_roles and role_mask
+        behind, they go through ``set_roles``.
+        """
+        if 'roles' in values:
+            raise ValueError('roles are set through User.set_roles')
+        if any(column in values for column in cls.token_claim_columns):
+            values.setdefault('token_generation', cls.token_generation + 1)
+        return super().update_one(
+            where, version=version, returning=returning, commit=commit,
+            **values)
+
+    @classmethod
+    def query_public(cls):
+        """Query for read endpoints, loads only the public columns"""
+        return cls.query_only(*cls.public_columns)
 
     @classmethod
     def lookup(cls, email):
-        """Lookup user by email"""
-        return cls.query.filter_by(email=email).one_or_none()
+        """Lookup user by email, ignoring case
+
+        Both sides go through the database's lower() so the comparison
+        matches the ix_users_email_lower index.
+        """
+        return cls.query.filter(
+            func.lower(cls.email) == func.lower(email)).one_or_none()
+
+    @classmethod
+    def conflicting_column(cls, column, email):
+        """Report email conflicts ahead of username conflicts
+
+        A failed INSERT only names the first unique constraint the database
+        checked.  When that was the username, one extra lookup on the failure
+        path tells us whether the email is taken too.
+        """
+        if column == 'username' and cls.lookup(email) is not None:
+            return 'email'
+        return column
 
     @classmethod
     def identify(cls, user_id):
-        """Get User by id"""
-        return cls.query.get(user_id)
+        """Get User by id
+
+        Called by flask-praetorian for every authenticated request, so the row
+        is served from the identity cache when possible.
+        """
+        user = identity_cache.load(cls, user_id)
+        if user is None:
+            user = cls.query_only(*cls.identity_columns).get(user_id)
+            if user is not None:
+                identity_cache.store(user)
+        return user
 
     @property
     def identity(self):
@@ -147,5 +716,54 @@ class User(Model, SurrogatePK):
             'email': self.email,
             'roles': self.roles,
             'is_active': self.is_active,
-            'admin': self.admin
+            'admin': self.admin,
+            'token_generation': self.token_generation,
+            'version': self.version,
             }
+
+
+class RevokedToken(Model, SurrogatePK):
+    """A token id revoked by a logout
+
+    Kept until the token's refresh window closes, a refreshed token keeps
+    its jti.
+    """
+
+    __tablename__ = 'revoked_tokens'
+
+    jti = db.Column(db.String(36), unique=True, nullable=False)
+    # unix timestamp, comparable with the token's rf_exp claim
+    expires_at = db.Column(db.Integer, nullable=False, index=True)
+
+
+def backfill_roles(batch_size=1000):
+    """Derive role_mask and user_roles from the roles string
+
+    For users whose role_mask is NULL, i.e. rows from before the roles table
+    or written without the ORM (bulk imports).  Works through them in id
+    order, committing every ``batch_size`` users.  Returns the number of
+    users backfilled.
+    """
+    backfilled, last_id = 0, 0
+    while True:
+        users = User.query.filter(
+            User.role_mask.is_(None), User.id > last_id,
+            ).order_by(User.id).limit(batch_size).all()
+        if not users:
+            return backfilled
+        with db.session.no_autoflush:
+            roles = {role.name: role for role in Role.get_or_create(
+                {name for user in users for name in split_roles(user.roles)})}
+        for user in users:
+            names = split_roles(user.roles)
+            # nothing is assigned yet, don't load the empty collection
+            set_committed_value(user, 'assigned_roles', [])
+            user.assigned_roles = [roles[name] for name in names]
+            user.role_mask = Role.mask_for(names)
+        db.session.commit()
+        backfilled += len(users)
+        last_id = users[-1].id
+
+
+# Emails are unique regardless of case, lookups go through this index
+db.Index('ix_users_email_lower', func.lower(User.email), unique=True)
@@ -0,0 +1,59 @@
+import flask_praetorian
+from flask import Response
+from flask_restplus import Resource
+from service import api_bp, rp_api
+from service.api.extensions import metrics, pool_metrics, profiler
+
+
+ns = rp_api.namespace('monitoring', path='/monitoring')
+# Prometheus scrapes /api/metrics, plain text rather than a restplus resource
+api_bp.add_url_rule('/metrics', 'metrics', metrics.view)
+
+
+@ns.route('/pool')
+class Pool(Resource):
+    """ Database connection pool of the worker serving the request
+
+    Returns:
+    - 200 status code with the pool gauges and counters
+    """
+    @ns.doc(responses={200: 'Pool Gauges'})
+    @flask_praetorian.roles_required('admin')
+    def get(self):  # On a Get Request
+        return pool_metrics.stats(), 200
+
+
+@ns.route('/profiles')
+class Profiles(Resource):
+    """ Request profiles saved on this node, newest first
+
+    Requests are profiled when PROFILING_ENABLED is set and they carry an
+    admin token in the X-Profile header.
+
+    Returns:
+    - 200 status code with the profiles, without their stacks
+    """
+    @ns.doc(responses={200: 'Saved Profiles'})
+    @flask_praetorian.roles_required('admin')
+    def get(self):  # On a Get Request
+        return profiler.summaries(), 200
+
+
+@ns.route('/profiles/<string:profile_id>')
+@ns.doc(params={'profile_id': 'The X-Profile-Id of the response'})
+class Profile(Resource):
+    """ A request's stack samples in collapsed stack format
+
+    Feed it to flamegraph.pl or speedscope.
+
+    Returns:
+    - 200 status code with one ``frame;frame;... count`` line per stack
+    - 404 status code for an unknown or expired profile
+    """
+    @ns.doc(responses={200: 'Collapsed Stacks', 404: 'Profile not found'})
+    @flask_praetorian.roles_required('admin')
+    def get(self, profile_id):  # On a Get Request
+        profile = profiler.load(profile_id)
+        if profile is None:
+            rp_api.abort(404, f'Profile Not Found by Id {profile_id}')
+        return Response(profile['stacks'], mimetype='text/plain')
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+from service.api.metrics import POOL_EVENTS
+
+
+class PoolMetrics(object):
+    """Connection pool gauges and counters for this worker
+
+    Gauges are read off the engine's pool when asked for, counters are kept
+    by pool event listeners.  Pools without a queue (NullPool, the sqlite
+    pools) only report the counters.
+    """
+
+    counters = ('connects', 'checkouts', 'checkins', 'invalidations')
+
+    def __init__(self):
+        self.db = None
+        self._counts = dict.fromkeys(self.counters, 0)
+        self._lock = threading.Lock()
+        self._listening = False
+
+    def init_app(self, app, db):
+        self.db = db
+        if not self._listening:
+            # on the Pool class, so engines created later are covered
+            event.listen(Pool, 'connect', self._counter('connects'))
+            event.listen(Pool, 'checkout', self._counter('checkouts'))
+            event.listen(Pool, 'checkin', self._counter('checkins'))
+            event.listen(Pool, 'invalidate', self._counter('invalidations'))
+            self._listening = True
+
+    def _counter(self, name):
+        events = POOL_EVENTS.labels(name)
+
+        def count(*args):
+            with self._lock:
+                self._counts[name] += 1
+            events.inc()
+        return count
+
+    def gauges(self):
+        """Pool size, checked in/out and overflow connections right now"""
+        pool = self.db.engine.pool
+        gauges = {'pool': type(pool).__name__}
+        for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+            method = getattr(pool, name, None)
+            if method is not None:
+                gauges[name] = method()
+        return gauges
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+        stats.update(self.gauges())
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self._counts = dict.fromkeys(self.counters, 0)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, g, request
+from flask_praetorian.exceptions import PraetorianError
+
+
+class StackSampler(threading.Thread):
+    """Samples one thread's stack every ``interval`` seconds
+
+    Stacks are kept in collapsed form, ``outer;...;inner`` frames with a
+    count, which flamegraph.pl and speedscope read as is.
+    """
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='stack-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._done = threading.Event()
+
+    @staticmethod
+    def frame_name(frame):
+        code = frame.f_code
+        module = os.path.join(
+            os.path.basename(os.path.dirname(code.co_filename)),
+            os.path.basename(code.co_filename))
+        return f'{module}:{code.co_name}'
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self.frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n'
+                       for stack, count in self.stacks.most_common())
+
+
+class RequestProfiler(object):
+    """Samples the stack of requests an admin asks to profile
+
+    Off unless ``PROFILING_ENABLED`` is set.  Then a request carrying an admin
+    token in the ``X-Profile`` header (any request, login included, the
+    header is separate from the request's own Authorization) is sampled every
+    ``PROFILE_INTERVAL`` seconds by a thread for as long as the view runs.
+    The collapsed stacks are written to ``PROFILE_DIR``, which keeps the
+    ``PROFILE_RING_SIZE`` most recent profiles of every worker on the node,
+    and the response names the profile in ``X-Profile-Id``.  Admins fetch
+    them from ``/api/monitoring/profiles``.
+
+    Under gevent the sampling thread is a greenlet and sees nothing useful.
+    """
+
+    header = 'X-Profile'
+    profile_id = re.compile(r'^\d+-\d+$')
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    @staticmethod
+    def authorized(token):
+        """Whether ``token`` is a valid token of an admin"""
+        guard = current_app.extensions['praetorian']
+        try:
+            data = guard.extract_jwt_token(token)
+        except PraetorianError:
+            return False
+        return 'admin' in (data.get('rls') or '').split(',')
+
+    def _before_request(self):
+        if not current_app.config.get('PROFILING_ENABLED'):
+            return
+        token = request.headers.get(self.header)
+        if not token or not self.authorized(token):
+            return
+        g.profile_started = time.perf_counter()
+        g.profiler = StackSampler(
+            threading.get_ident(), current_app.config['PROFILE_INTERVAL'])
+        g.profiler.start()
+
+    def _after_request(self, response):
+        sampler = g.pop('profiler', None)
+        if sampler is None:
+            return response
+        sampler.stop()
+        profile_id = self.save({
+            'method': request.method,
+            'path': request.path,
+            'route': request.url_rule.rule if request.url_rule else None,
+            'status': response.status_code,
+            'duration_ms': round(
+                (time.perf_counter() - g.profile_started) * 1000, 3),
+            'interval': sampler.interval,
+            'samples': sampler.samples,
+            'stacks': sampler.collapsed(),
+            })
+        response.headers['X-Profile-Id'] = profile_id
+        return response
+
+    @staticmethod
+    def _teardown_request(exc):
+        # the view raised past after_request, nothing worth keeping
+        sampler = g.pop('profiler', None)
+        if sampler is not None:
+            sampler.stop()
+
+    @property
+    def directory(self):
+        return current_app.config['PROFILE_DIR']
+
+    def save(self, profile):
+        """Write a profile and drop the oldest beyond the ring size"""
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        profile_id = f'{time.time_ns()}-{os.getpid()}'
+        profile.update(id=profile_id, created=time.time())
+        path = os.path.join(self.directory, f'{profile_id}.json')
+        with open(path + '.tmp', 'w') as fh:
+            json.dump(profile, fh)
+        os.replace(path + '.tmp', path)
+
+        ring = self._ids()
+        # ring[:-0] would be nothing, a size of 0 keeps no profile
+        keep = current_app.config['PROFILE_RING_SIZE']
+        for stale in ring[:max(len(ring) - keep, 0)]:
+            try:
+                os.remove(os.path.join(self.directory, f'{stale}.json'))
+            except FileNotFoundError:
+                # another worker got to it first
+                pass
+        return profile_id
+
+    def _ids(self):
+        """Profile ids on disk, oldest first"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        ids = [name[:-5] for name in names if name.endswith('.json')
+               and self.profile_id.match(name[:-5])]
+        return sorted(ids, key=lambda i: int(i.split('-')[0]))
+
+    def load(self, profile_id):
+        """A saved profile, or None if there is no such profile"""
+        if not self.profile_id.match(profile_id):
+            return None
+        try:
+            with open(os.path.join(
+                    self.directory, f'{profile_id}.json')) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return None
+
+    def summaries(self):
+        """Everything but the stacks of the saved profiles, newest first"""
+        profiles = []
+        for profile_id in reversed(self._ids()):
+            profile = self.load(profile_id)
+            if profile is not None:
+                profile.pop('stacks')
+                profiles.append(profile)
+        return profiles
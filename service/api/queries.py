@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class RequestQueries(object):
+    """The SQL statements a request ran, with their count and time"""
+
+    __slots__ = ('started', 'count', 'seconds', 'statements')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+    def repeated(self, threshold):
+        """Statements run at least ``threshold`` times, most repeated first
+
+        The same SELECT run once per row of another is an N+1, run with the
+        same parameters it is a duplicate load.  Either way it shows up here.
+        """
+        return [(statement, count)
+                for statement, count in self.statements.most_common()
+                if count >= threshold]
+
+
+class QueryTracker(object):
+    """Counts and times the SQL statements of every request
+
+    Engine listeners add each statement to the request's ``RequestQueries``
+    (``g.queries``).  When the response goes out the totals are added as a
+    ``Server-Timing`` header (``db`` for SQL, ``app`` for the whole request,
+    readable in the browser's network panel) and logged as one JSON line.
+    Requests that ran the same statement ``SQL_REPEAT_THRESHOLD`` times or
+    more are logged as warnings, otherwise the line is logged at debug.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.server_timing = False
+        self.repeat_threshold = 2
+        self._listening = False
+
+    def init_app(self, app):
+        self.enabled = app.config.get('SQL_INSTRUMENTATION', True)
+        self.server_timing = app.config.get('SERVER_TIMING', True)
+        self.repeat_threshold = app.config.get(
+            'SQL_REPEAT_THRESHOLD', self.repeat_threshold)
+        if not self.enabled:
+            return
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        if not self._listening:
+            # on the Engine class, so engines created later are covered
+            event.listen(Engine, 'before_cursor_execute', self._before_query)
+            event.listen(Engine, 'after_cursor_execute', self._after_query)
+            self._listening = True
+
+    @staticmethod
+    def current():
+        """This request's ``RequestQueries``, None outside of one"""
+        if has_request_context():
+            return g.get('queries')
+        return None
+
+    @staticmethod
+    def _before_request():
+        g.queries = RequestQueries()
+
+    @staticmethod
+    def _before_query(conn, cursor, statement, parameters, context,
+                      executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def _after_query(self, conn, cursor, statement, parameters, context,
+                     executemany):
+        started = conn.info.get('query_start')
+        if not started:
+            return
+        elapsed = time.perf_counter() - started.pop()
+        queries = self.current()
+        if queries is not None:
+            queries.count += 1
+            queries.seconds += elapsed
+            queries.statements[statement] += 1
+
+    def _after_request(self, response):
+        queries = self.current()
+        if queries is None:
+            return response
+        elapsed = time.perf_counter() - queries.started
+        if self.server_timing:
+            response.headers.add(
+                'Server-Timing',
+                'db;dur={:.2f};desc="{} queries", app;dur={:.2f}'.format(
+                    queries.seconds * 1000, queries.count, elapsed * 1000))
+
+        repeated = queries.repeated(self.repeat_threshold)
+        level = logging.WARNING if repeated else logging.DEBUG
+        logger = current_app.logger
+        if logger.isEnabledFor(level):
+            logger.log(level, json.dumps({
+                'event': 'sql',
+                'method': request.method,
+                'route': request.url_rule.rule if request.url_rule
+                else request.path,
+                'status': response.status_code,
+                'queries': queries.count,
+                'db_ms': round(queries.seconds * 1000, 3),
+                'total_ms': round(elapsed * 1000, 3),
+                'repeated': [{'statement': ' '.join(statement.split()),
+                              'count': count}
+                             for statement, count in repeated],
+                }))
+        return response
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from flask_praetorian.exceptions import PraetorianError
+
+
+class RateLimited(PraetorianError):
+    """Too many attempts for the same key, retry later
+
+    Sent with a Retry-After header of the seconds until the bucket has a
+    token again.
+    """
+    status_code = 429
+
+    def __init__(self, retry_after):
+        self.retry_after = math.ceil(retry_after)
+        super().__init__(
+            f'Too many attempts, retry in {self.retry_after} seconds')
+        self.headers = {'Retry-After': str(self.retry_after)}
+
+
+class RateLimiter(object):
+    """Token buckets shared by every worker on the node through mmap
+
+    The buckets live in a fixed size file mapped by every process, laid out
+    as a set-associative table: a key hashes to a set of ``ways`` slots.
+    Each slot is ``(key hash, tokens, updated, full at)``.  A key that is not
+    there yet only takes the slot of a bucket that refilled, which is the
+    same as no bucket.  When every bucket of the set is still refilling the
+    new key is turned away, flooding a set with keys must not hand a
+    limited key a fresh bucket.  Threads of a worker take a lock, workers
+    take an fcntl lock on the first byte of the set, so no bucket is updated
+    by two of them at once while unrelated keys don't contend across workers.
+
+    A limit is ``(attempts, seconds)``, the bucket holds ``attempts`` tokens
+    and refills at ``attempts / seconds`` per second.  Without a segment path
+    the table is anonymous memory, only shared with processes forked after it
+    was first used, which is what the tests use.
+    """
+
+    slot = struct.Struct('<Qddd')
+
+    def __init__(self):
+        self.path = None
+        self.slots = 0
+        self.ways = 8
+        self._map = None
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def init_app(self, app):
+        self.close()
+        self.path = app.config.get('RATE_LIMIT_SEGMENT')
+        self.ways = app.config.get('RATE_LIMIT_WAYS', self.ways)
+        # round up to a whole number of sets
+        self.slots = -(-app.config.get('RATE_LIMIT_SLOTS', 65536)
+                       // self.ways) * self.ways
+        self.rejected = 0
+
+    @property
+    def segment(self):
+        """The mapped table, opened lazily so each forked worker maps it"""
+        if self._pid != os.getpid():
+            size = self.slots * self.slot.size
+            if self.path:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                if os.fstat(self._fd).st_size != size:
+                    # left by another layout or size, start from empty
+                    os.ftruncate(self._fd, 0)
+                    os.ftruncate(self._fd, size)
+                self._map = mmap.mmap(self._fd, size)
+            elif self._map is None:
+                self._map = mmap.mmap(-1, size)
+            self._pid = os.getpid()
+        return self._map
+
+    def close(self):
+        if self._pid == os.getpid():
+            if self._map is not None:
+                self._map.close()
+            if self._fd is not None:
+                os.close(self._fd)
+        self._map = None
+        self._fd = None
+        self._pid = None
+
+    @staticmethod
+    def _hash(key):
+        digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+        # 0 marks an empty slot
+        return int.from_bytes(digest, 'little') or 1
+
+    def hit(self, key, limit):
+        """Take a token from ``key``'s bucket
+
+        Returns 0 when the attempt is allowed, otherwise the number of
+        seconds until the bucket has a token again, or for a new key until a
+        bucket of its set refilled.  Nothing is taken from a bucket that is
+        empty.
+        """
+        attempts, seconds = limit
+        rate = attempts / seconds
+        hashed = self._hash(key)
+        segment = self.segment
+        first = (hashed % (self.slots // self.ways)) * self.ways
+        with self._lock:
+            if self._fd is not None:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX, 1,
+                            first * self.slot.size)
+            try:
+                now = time.time()
+                victim, idle_at = first, math.inf
+                for index in range(first, first + self.ways):
+                    offset = index * self.slot.size
+                    slot_key, tokens, updated, full_at = \
+                        self.slot.unpack_from(segment, offset)
+                    if slot_key == hashed:
+                        tokens = min(
+                            attempts, tokens + (now - updated) * rate)
+                        break
+                    if full_at < idle_at:
+                        victim, idle_at = index, full_at
+                else:
+                    if idle_at > now:
+                        self.rejected += 1
+                        return idle_at - now
+                    offset = victim * self.slot.size
+                    tokens = attempts
+                allowed = tokens >= 1
+                if allowed:
+                    tokens -= 1
+                self.slot.pack_into(
+                    segment, offset, hashed, tokens, now,
+                    now + (attempts - tokens) / rate)
+                if allowed:
+                    return 0
+                self.rejected += 1
+                return (1 - tokens) / rate
+            finally:
+                if self._fd is not None:
+                    fcntl.lockf(self._fd, fcntl.LOCK_UN, 1,
+                                first * self.slot.size)
+
+    def limit(self, key, limit):
+        """Take a token from ``key``'s bucket or raise ``RateLimited``"""
+        if not limit:
+            return
+        retry_after = self.hit(key, limit)
+        if retry_after:
+            raise RateLimited(retry_after)
+
+    def clear(self):
+        """Empty every bucket"""
+        with self._lock:
+            self.segment[:] = bytes(len(self.segment))
+            self.rejected = 0
+
+    def stats(self):
+        return {
+            'slots': self.slots,
+            'ways': self.ways,
+            'segment': self.path,
+            'rejected': self.rejected,
+            }
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Response models compiled into plain functions
+
+``marshal`` walks the fields of a model for every object it serializes,
+looking each field up, instantiating class fields and going through
+``Raw.output``.  ``Serializer`` does that walk once and generates a function
+reading the attributes straight off the object, which gives the same dict.
+Fields it does not know how to inline keep going through their own
+``output``.
+"""
+import hashlib
+import json
+from functools import partial, wraps
+
+from flask import current_app, make_response, request
+from flask_restplus import fields, marshal
+from flask_restplus.inputs import boolean
+from flask_restplus.representations import output_json as restplus_json
+from flask_restplus.utils import merge, unpack
+from werkzeug.wrappers import BaseResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# How each field type formats a value that is not None, matching format()
+FORMATS = {
+    fields.Raw: '{}',
+    fields.String: 'str({})',
+    fields.Integer: 'int({})',
+    fields.Boolean: '{0} if {0}.__class__ is bool else _boolean({0})',
+    }
+
+
+def _inlined(field):
+    """Whether ``field``'s output can be generated"""
+    attribute = field.attribute
+    return (type(field) in FORMATS
+            and field.default is None
+            and field.mask is None
+            and (attribute is None
+                 or isinstance(attribute, str) and '.' not in attribute))
+
+
+def compile_model(model):
+    """A function equivalent to ``marshal(obj, model)`` for a single object"""
+    namespace = {
+        '_boolean': boolean,
+        '_getattr': getattr,
+        '_indexable': fields.is_indexable_but_not_string,
+        '_marshal': marshal,
+        '_model': model,
+        }
+    reads, items = [], []
+    for i, (key, field) in enumerate(
+            getattr(model, 'resolved', model).items()):
+        if isinstance(field, type):
+            field = field()
+        if _inlined(field):
+            reads.append(f'    v{i} = _getattr(obj, '
+                         f'{field.attribute or key!r}, None)')
+            value = FORMATS[type(field)].format(f'v{i}')
+            items.append(f'        {key!r}: None if v{i} is None '
+                         f'else {value},')
+        else:
+            namespace[f'_f{i}'] = field
+            items.append(f'        {key!r}: _f{i}.output({key!r}, obj),')
+    source = '\n'.join([
+        'def serialize(obj):',
+        # dicts and other mappings are rare, marshal knows them
+        '    if _indexable(obj):',
+        '        return _marshal(obj, _model)',
+        *reads,
+        '    return {',
+        *items,
+        '        }',
+        ])
+    filename = "<serializer {}>".format(getattr(model, 'name', ''))
+    exec(compile(source, filename, 'exec'), namespace)
+    serialize = namespace['serialize']
+    serialize.__source__ = source
+    return serialize
+
+
+class Serializer(object):
+    """Serializes objects, or lists of them, as ``marshal`` would"""
+
+    _compiled = {}
+
+    def __init__(self, model):
+        self.model = model
+        self.one = compile_model(model)
+        # changes with the fields, so ETags of older representations don't
+        # match after a deploy
+        self.tag = hashlib.sha1(
+            self.one.__source__.encode()).hexdigest()[:8]
+
+    @classmethod
+    def for_model(cls, model):
+        """The serializer of ``model``, compiled on first use"""
+        if id(model) not in cls._compiled:
+            cls._compiled[id(model)] = cls(model)
+        return cls._compiled[id(model)]
+
+    def __call__(self, data):
+        if isinstance(data, (list, tuple)):
+            return self.many(data)
+        return self.one(data)
+
+    def many(self, objs):
+        one = self.one
+        return [one(obj) for obj in objs]
+
+
+def serialize_with(model, code=200, description=None, as_list=False):
+    """``Namespace.marshal_with`` on a compiled ``Serializer``
+
+    The swagger document is the same.  Requests carrying a fields mask
+    (``X-Fields``) are still marshalled, the mask changes the fields.
+    """
+    serializer = Serializer.for_model(model)
+
+    def wrapper(func):
+        doc = {
+            'responses': {
+                code: (description, [model]) if as_list
+                else (description, model)
+                },
+            '__mask__': True,
+            }
+        func.__apidoc__ = merge(getattr(func, '__apidoc__', {}), doc)
+
+        @wraps(func)
+        def view(*args, **kwargs):
+            resp = func(*args, **kwargs)
+            if isinstance(resp, BaseResponse):
+                # a 304, nothing to serialize
+                return resp
+            serialize = serializer
+            mask = request.headers.get(
+                current_app.config['RESTPLUS_MASK_HEADER'])
+            if mask:
+                serialize = partial(marshal, fields=model, mask=mask)
+            if isinstance(resp, tuple):
+                data, status, headers = unpack(resp)
+                return serialize(data), status, headers
+            return serialize(resp)
+        return view
+    return wrapper
+
+
+def dumps(data):
+    """``data`` as JSON bytes ending with a new line"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+        except TypeError:
+            pass
+    return (json.dumps(data) + '\n').encode()
+
+
+def output_json(data, code, headers=None):
+    """restplus' ``output_json`` encoding with orjson when it is installed
+
+    Debug mode (indented output), ``RESTPLUS_JSON`` settings and anything
+    orjson cannot encode go through restplus' encoder.
+    """
+    if orjson is None or current_app.debug \
+            or current_app.config.get('RESTPLUS_JSON'):
+        return restplus_json(data, code, headers)
+    try:
+        dumped = orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+    except TypeError:
+        return restplus_json(data, code, headers)
+    resp = make_response(dumped, code)
+    resp.headers.extend(headers or {})
+    return resp
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask_praetorian import Praetorian
+from flask_praetorian.constants import AccessType, REFRESH_EXPIRATION_CLAIM
+from flask_praetorian.exceptions import InvalidUserError, MissingClaimError
+
+from service.api.metrics import JWT_SECONDS
+
+
+class CachingPraetorian(Praetorian):
+    """Praetorian that remembers the claims of tokens it already verified
+
+    Clients send the same bearer token until it expires, decoding it means
+    parsing, base64 decoding and checking the HMAC every time.  Verified
+    claims are kept in a per-worker LRU keyed by the token's sha256, until the
+    token's refresh window (the longest it can be used for) closes.
+
+    Only the signature check is skipped on a hit, the claims are validated
+    again, so expiry and revocation are checked on every request.
+
+    With ``AUTH_STATELESS`` tokens also carry the user's status (``act``) and
+    token generation (``gen``), and a token is only accepted while its
+    generation is the user's current one.  Disabling a user or changing their
+    roles bumps the generation, so authorization can go by the claims alone.
+    The current generation comes from ``identify``, which is served from the
+    identity cache.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.stateless = False
+        self.jwt_cache_maxsize = 4096
+        self.jwt_cache_hits = 0
+        self.jwt_cache_misses = 0
+        self._jwt_cache = OrderedDict()
+        self._jwt_cache_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def init_app(self, app, user_class, is_blacklisted=None):
+        self.stateless = app.config.get('AUTH_STATELESS', False)
+        self.jwt_cache_maxsize = app.config.get(
+            'JWT_CACHE_MAXSIZE', self.jwt_cache_maxsize)
+        self.clear_jwt_cache()
+        return super().init_app(app, user_class, is_blacklisted)
+
+    def encode_jwt_token(self, user, *args, **custom_claims):
+        if self.stateless:
+            custom_claims.setdefault('act', bool(user.is_active))
+            custom_claims.setdefault('gen', user.token_generation)
+        with JWT_SECONDS.labels('encode').time():
+            return super().encode_jwt_token(user, *args, **custom_claims)
+
+    def _validate_jwt_data(self, data, access_type):
+        super()._validate_jwt_data(data, access_type)
+        if not self.stateless:
+            return
+        MissingClaimError.require_condition(
+            'act' in data and 'gen' in data,
+            'Token is missing the act and gen claims',
+            )
+        InvalidUserError.require_condition(
+            data['act'],
+            'The user is not valid or has had access revoked',
+            )
+        user = self.user_class.identify(data['id'])
+        InvalidUserError.require_condition(
+            user is not None and user.token_generation == data['gen'],
+            "The user's access has changed since the token was issued",
+            )
+
+    def extract_jwt_token(self, token, access_type=AccessType.access):
+        if not self.jwt_cache_maxsize:
+            with JWT_SECONDS.labels('decode').time():
+                return super().extract_jwt_token(
+                    token, access_type=access_type)
+
+        key = hashlib.sha256(token.encode()).digest()
+        with self._jwt_cache_lock:
+            entry = self._jwt_cache.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self._jwt_cache[key]
+                entry = None
+            if entry is None:
+                self.jwt_cache_misses += 1
+            else:
+                self._jwt_cache.move_to_end(key)
+                self.jwt_cache_hits += 1
+
+        if entry is None:
+            with JWT_SECONDS.labels('decode').time():
+                data = super().extract_jwt_token(
+                    token, access_type=access_type)
+            with self._jwt_cache_lock:
+                self._jwt_cache[key] = (
+                    data[REFRESH_EXPIRATION_CLAIM], dict(data))
+                while len(self._jwt_cache) > self.jwt_cache_maxsize:
+                    self._jwt_cache.popitem(last=False)
+            return data
+
+        data = dict(entry[1])
+        with JWT_SECONDS.labels('decode_cached').time():
+            self._validate_jwt_data(data, access_type=access_type)
+        return data
+
+    def clear_jwt_cache(self):
+        with self._jwt_cache_lock:
+            self._jwt_cache.clear()
+            self.jwt_cache_hits = 0
+            self.jwt_cache_misses = 0
+
+    def jwt_cache_stats(self):
+        """Hit/miss counters and current size"""
+        with self._jwt_cache_lock:
+            return {
+                'hits': self.jwt_cache_hits,
+                'misses': self.jwt_cache_misses,
+                'size': len(self._jwt_cache),
+                'maxsize': self.jwt_cache_maxsize,
+                }
@@ -1,8 +1,16 @@
+import base64
+import io
+
 import flask_praetorian
+from flask import Response, current_app, request, stream_with_context
 from sqlalchemy import exc
-from flask_restplus import Resource, fields
-from service import db, rp_api
-from service.api.models import User as UserModel
+from flask_restplus import Resource, fields, inputs, reqparse
+from service import rp_api
+from service.api.conditional import etag_headers, fresh, not_modified, \
+    page_etag, row_etag
+from service.api.importer import import_users, spool
+from service.api.models import User as UserModel, unique_violation
+from service.api.serializers import Serializer, dumps, serialize_with
 
 ns = rp_api.namespace('users', path='/users')
 
@@ -18,7 +26,54 @@ user_fields = rp_api.model('User', {
     'email': fields.String(required=True, description='email'),
     'admin': fields.Boolean(description='admin'),
     'is_active': fields.Boolean(description='is_active'),
+    'version': fields.Integer(
+        readOnly=True, description='Row version, bumped by every update'),
     })
+user_serializer = Serializer.for_model(user_fields)
+
+user_list_parser = reqparse.RequestParser()
+user_list_parser.add_argument(
+    'limit', type=inputs.positive, location='args',
+    help='Page size, capped by the server')
+user_list_parser.add_argument(
+    'cursor', location='args',
+    help='X-Next-Cursor value of the previous page')
+user_list_parser.add_argument(
+    'format', choices=('json', 'ndjson'), default='json', location='args',
+    help='ndjson streams every user after the cursor')
+
+
+def encode_cursor(last_id):
+    """Opaque keyset cursor for the page after ``last_id``"""
+    token = base64.urlsafe_b64encode(str(last_id).encode()).decode()
+    return token.rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor, raises ValueError for bad cursors"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except ValueError as e:
+        raise ValueError(f'Invalid cursor: {cursor}') from e
+
+
+def user_response(user_id):
+    """A user with its ETag, or a 304 when the client's copy is current
+
+    The user is loaded through ``User.identify``, so a conditional request
+    for a user in the identity cache costs no query, and is as fresh as the
+    cache.  None when there is no such user.
+    """
+    if not str(user_id).isdigit():
+        return None
+    user = UserModel.identify(int(user_id))
+    if user is None:
+        return None
+    etag = row_etag(user_serializer, user)
+    if fresh(etag):
+        return not_modified(etag)
+    return user, 200, etag_headers(etag)
 
 
 @ns.route('/ping')
@@ -40,54 +95,152 @@ class User(Resource):
       user_id :: User.id of a user to look up
     Returns:
     - 200 success
+    - 304 not modified, the If-None-Match ETag is current
     - 404 not found
     """
-    @ns.doc(body=user_fields)
-    @ns.marshal_with(user_fields)
+    @ns.doc(body=user_fields, responses={304: 'Not Modified'})
+    @serialize_with(user_fields)
     @flask_praetorian.auth_required
     def get(self, user_id):
         """Get single user details"""
         try:
-            user = UserModel.get_by_id(record_id=user_id)
-            if not user:
+            response = user_response(user_id)
+            if response is None:
                 rp_api.abort(404, f"User Not Found by Id {user_id}")
-            return user, 200
+            return response
         except (exc.IntegrityError, ValueError):
             rp_api.abort(400)
 
 
 @ns.route('/')
 class List(Resource):
-    """List's all Users"""
-    @ns.doc(body=user_fields)
-    @ns.marshal_list_with(user_fields)
+    """List's all Users
+
+    Users are paged by id (keyset pagination).  When there are more, the
+    X-Next-Cursor and Link headers point at the next page.  Pages carry an
+    ETag, a current If-None-Match gets a 304.  format=ndjson streams one user
+    per line from a server side cursor instead.
+    """
+    @ns.doc(body=user_fields, responses={304: 'Not Modified'})
+    @ns.expect(user_list_parser)
+    @serialize_with(user_fields, description='Success', as_list=True)
     @flask_praetorian.auth_required
     def get(self):
-        """Get all users"""
-        return UserModel.query.all()
+        """Get a page of users"""
+        args = user_list_parser.parse_args()
+        query = UserModel.query_public().order_by(UserModel.id)
+        if args['cursor']:
+            try:
+                query = query.filter(
+                    UserModel.id > decode_cursor(args['cursor']))
+            except ValueError as e:
+                rp_api.abort(400, str(e))
+
+        if args['format'] == 'ndjson':
+            if args['limit']:
+                query = query.limit(args['limit'])
+            return self.stream(query)
+
+        limit = min(
+            args['limit'] or current_app.config['USERS_PAGE_DEFAULT_LIMIT'],
+            current_app.config['USERS_PAGE_MAX_LIMIT'])
+        # one extra row tells us whether there is a next page
+        users = query.limit(limit + 1).all()
+        headers = {}
+        if len(users) > limit:
+            users = users[:limit]
+            cursor = encode_cursor(users[-1].id)
+            headers['X-Next-Cursor'] = cursor
+            headers['Link'] = '<{}>; rel="next"'.format(rp_api.url_for(
+                List, cursor=cursor, limit=limit, _external=True))
+        etag = page_etag(user_serializer, users, headers.get('X-Next-Cursor'))
+        if fresh(etag):
+            return not_modified(etag)
+        return users, 200, etag_headers(etag, headers)
+
+    @staticmethod
+    def stream(query):
+        """Stream a query as ndjson without holding the result in memory"""
+        def generate():
+            rows = query.execution_options(stream_results=True) \
+                .yield_per(current_app.config['USERS_STREAM_BATCH_SIZE'])
+            for user in rows:
+                yield dumps(user_serializer(user))
+        return Response(
+            stream_with_context(generate()), mimetype='application/x-ndjson')
 
     @ns.expect(user_input_fields, validate=True)
     @rp_api.doc(body=user_fields, responses={409: 'Email address in use'})
-    @ns.marshal_with(user_fields, code=201)
+    @serialize_with(user_fields, code=201)
     @flask_praetorian.auth_required
     def post(self):
         try:
-            username = UserModel.query.filter_by(
-                username=rp_api.payload['username']).first()
-            email = UserModel.query.filter_by(
-                email=rp_api.payload['email']).first()
-            if not (username or email):
-                user = UserModel.create(**rp_api.payload)
-                return user, 201
-            if email:
+            # A single INSERT, uniqueness is left to the database
+            user = UserModel.insert(
+                username=rp_api.payload['username'],
+                email=rp_api.payload['email'],
+                password=rp_api.payload['password'],
+                )
+            return user, 201
+        except exc.IntegrityError as e:
+            column = UserModel.conflicting_column(
+                unique_violation(e), rp_api.payload['email'])
+            if column == 'email':
                 rp_api.abort(
                     409, f"Email already in use: {rp_api.payload['email']}")
-            if username:
+            if column == 'username':
                 rp_api.abort(
                     409,
                     f"Username already in use: {rp_api.payload['username']}"
                     )
-            rp_api.abort(409, "Invalid fields")
-        except (exc.IntegrityError, ValueError) as e:
-            db.session.rollback()
             rp_api.abort(400, e)
+        except ValueError as e:
+            rp_api.abort(400, e)
+
+
+@ns.route('/import')
+class Import(Resource):
+    """ Bulk import users
+
+    The request body is streamed as csv (text/csv) or json lines
+    (application/x-ndjson), see service.api.importer for the columns.
+    Invalid or duplicate rows are skipped and listed in the report.  The
+    import runs inside the request, so files are capped at
+    BULK_IMPORT_MAX_ROWS rows.
+
+    Returns:
+    - 200 status code with the import report
+    - 413 status code for a file with too many rows, nothing is imported
+    - 415 status code for an unsupported content type
+    """
+    formats = {
+        'text/csv': 'csv',
+        'application/x-ndjson': 'jsonl',
+        'application/jsonl': 'jsonl',
+        }
+
+    @ns.doc(responses={
+        200: 'Import Report',
+        413: 'Too Many Rows',
+        415: 'Unsupported Media Type',
+        })
+    @flask_praetorian.roles_required('admin')
+    def post(self):
+        fmt = self.formats.get(request.mimetype)
+        if fmt is None:
+            rp_api.abort(415, f"Expected one of: {', '.join(self.formats)}")
+        max_rows = current_app.config['BULK_IMPORT_MAX_ROWS']
+        # counted before anything is imported, a rejected file leaves no rows
+        source = spool(
+            io.TextIOWrapper(request.stream, encoding='utf-8', newline=''),
+            fmt, max_rows)
+        if source is None:
+            rp_api.abort(
+                413, f'More than {max_rows} rows, use manage.py bulk_import')
+        with source:
+            report = import_users(
+                source,
+                fmt,
+                batch_size=current_app.config['BULK_IMPORT_BATCH_SIZE'],
+                )
+        return report.to_json(), 200
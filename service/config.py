@@ -1,4 +1,53 @@
 import os
+import tempfile
+
+from sqlalchemy.pool import NullPool
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return default if value in (None, '') else int(value)
+
+
+def _env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value in (None, ''):
+        return default
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def engine_options(database_url, pool_size, max_overflow, pool_timeout=10,
+                   pool_recycle=1800):
+    """SQLALCHEMY_ENGINE_OPTIONS for a pool profile
+
+    Every gunicorn worker has its own pool, so a node opens up to
+    workers * (pool_size + max_overflow) connections.  The DB_POOL_SIZE,
+    DB_MAX_OVERFLOW, DB_POOL_TIMEOUT and DB_POOL_RECYCLE environment variables
+    override the profile.
+
+    DB_PGBOUNCER=1 is for running behind PgBouncer in transaction pooling
+    mode.  PgBouncer owns the pooling, so connections are not kept here
+    (NullPool, set DB_NULL_POOL=0 to keep a small pool anyway) and are not
+    pre pinged.  psycopg2 never uses server side prepared statements and
+    nothing here relies on session state outliving a transaction.
+
+    sqlite gets Flask-SQLAlchemy's defaults, its pools take none of these.
+    """
+    if (database_url or '').startswith('sqlite'):
+        return {}
+    if _env_flag('DB_PGBOUNCER'):
+        if _env_flag('DB_NULL_POOL', True):
+            return {'poolclass': NullPool}
+        pool_pre_ping = False
+    else:
+        pool_pre_ping = _env_flag('DB_POOL_PRE_PING', True)
+    return {
+        'pool_size': _env_int('DB_POOL_SIZE', pool_size),
+        'max_overflow': _env_int('DB_MAX_OVERFLOW', max_overflow),
+        'pool_timeout': _env_int('DB_POOL_TIMEOUT', pool_timeout),
+        'pool_recycle': _env_int('DB_POOL_RECYCLE', pool_recycle),
+        'pool_pre_ping': pool_pre_ping,
+        }
 
 
 class BaseConfig:
@@ -6,18 +55,81 @@ class BaseConfig:
     DEBUG = False
     TESTING = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(
+        os.environ.get('DATABASE_URL'), pool_size=5, max_overflow=5)
     SECRET_KEY = os.environ.get('SECRET_KEY')
     DEBUG_TB_ENABLED = False
     DEBUG_TB_INTERCEPT_REDIRECTS = False
+    # Flask-Migrate is set up for the cli (manage.py, `flask db` with
+    # FLASK_APP=manage.py), this adds it to apps built elsewhere, wsgi.py
+    MIGRATE_ENABLED = _env_flag('MIGRATE_ENABLED')
     JWT_ACCESS_LIFESPAN = {'seconds': 0}
     JWT_REFRESH_LIFESPAN = {'minutes': 15}
     SENTRY_URL = os.environ.get('SENTRY_URL')
     SENTRY_ENVIRONMENT = os.environ.get('SENTRY_ENVIRONMENT', 'base_config')
+    # Prometheus metrics at /api/metrics, set PROMETHEUS_MULTIPROC_DIR when
+    # running more than one worker
+    METRICS_ENABLED = _env_flag('METRICS_ENABLED', True)
+    # The endpoint is only served to scrapers sending this as a bearer
+    # token, unset it answers 404 (the metrics are still collected)
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # Count and time the SQL of each request, sent back in a Server-Timing
+    # header.  Statements run this many times in one request are logged.
+    SQL_INSTRUMENTATION = True
+    SERVER_TIMING = _env_flag('SERVER_TIMING', True)
+    SQL_REPEAT_THRESHOLD = 2
+    # Requests sent with an admin token in X-Profile are stack sampled every
+    # PROFILE_INTERVAL seconds, the last PROFILE_RING_SIZE are kept on disk
+    PROFILING_ENABLED = _env_flag('PROFILING_ENABLED')
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(
+        tempfile.gettempdir(), 'flask-auth-profiles'))
+    PROFILE_INTERVAL = 0.005
+    PROFILE_RING_SIZE = 50
+    # Per-worker cache of users loaded on authenticated requests, 0 disables
+    IDENTITY_CACHE_MAXSIZE = 1024
+    IDENTITY_CACHE_TTL = 30
+    # Authorize from the token's claims, see CachingPraetorian
+    AUTH_STATELESS = _env_flag('AUTH_STATELESS')
+    # Per-worker cache of verified token claims, 0 disables
+    JWT_CACHE_MAXSIZE = 4096
+    # Password hashing process pool, defaults to one process per core
+    HASHING_POOL_SIZE = int(
+        os.environ.get('HASHING_POOL_SIZE', os.cpu_count() or 1))
+    HASHING_MAX_PENDING = None
+    HASHING_TIMEOUT = 10
+    BULK_IMPORT_BATCH_SIZE = 1000
+    # Rows accepted by POST /api/users/import, the import runs inside the
+    # request and has to finish well within the worker timeout.  Bigger
+    # files go through `manage.py bulk_import`.
+    BULK_IMPORT_MAX_ROWS = 1000
+    # Login attempts allowed per (attempts, seconds), checked before the
+    # password is verified.  The buckets live in a shared memory file.
+    LOGIN_RATE_LIMIT_EMAIL = (10, 60)
+    LOGIN_RATE_LIMIT_IP = (100, 60)
+    RATE_LIMIT_SEGMENT = os.environ.get(
+        'RATE_LIMIT_SEGMENT', '/dev/shm/flask-auth-ratelimit')
+    RATE_LIMIT_SLOTS = 65536
+    # Proxies in front of wsgi.py whose X-Forwarded-For is trusted for the
+    # client address.  0, clients connect directly, otherwise they could
+    # pick their own address and dodge the per-IP login limit.
+    PROXY_FIX_X_FOR = _env_int('PROXY_FIX_X_FOR', 0)
+    # Seconds between pulls of tokens revoked by other workers, 0 disables
+    TOKEN_REVOCATION_SYNC_INTERVAL = 5
+    TOKEN_REVOCATION_PRUNE_INTERVAL = 3600
+    # GET /users/ page sizes and the ndjson fetch size
+    USERS_PAGE_DEFAULT_LIMIT = 100
+    USERS_PAGE_MAX_LIMIT = 1000
+    USERS_STREAM_BATCH_SIZE = 1000
+    # Hash scheme and cost written by `manage.py calibrate_hash`
+    PASSWORD_HASH_SETTINGS = os.environ.get(
+        'PASSWORD_HASH_SETTINGS', 'password_hash.json')
 
 
 class DevelopmentConfig(BaseConfig):
     """Development configuration"""
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(
+        SQLALCHEMY_DATABASE_URI, pool_size=2, max_overflow=2)
     JWT_ACCESS_LIFESPAN = {'seconds': 30}
     JWT_REFRESH_LIFESPAN = {'minutes': 2}
     DEBUG = True
@@ -29,15 +141,29 @@ class TestingConfig(BaseConfig):
     """Testing configuration"""
     TESTING = True
     SECRET_KEY = 'testing-and-thats-it'
+    # a token from a login is used across several requests, 0s expires on
+    # the next second
+    JWT_ACCESS_LIFESPAN = {'minutes': 5}
     SQLALCHEMY_DATABASE_URI = "sqlite:///:memory:"
+    SQLALCHEMY_ENGINE_OPTIONS = {}
     SENTRY_ENVIRONMENT = os.environ.get('SENTRY_ENVIRONMENT', 'testing')
+    HASHING_POOL_SIZE = 0
+    PASSWORD_HASH_SETTINGS = None
+    TOKEN_REVOCATION_SYNC_INTERVAL = 0
+    RATE_LIMIT_SEGMENT = None
 
 
 class GithubTestingConfig(BaseConfig):
     """Testing configuration"""
     TESTING = True
     SECRET_KEY = 'testing-in-github-thats-it'
+    JWT_ACCESS_LIFESPAN = {'minutes': 5}
     SQLALCHEMY_DATABASE_URI = "sqlite:///:memory:"
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    HASHING_POOL_SIZE = 0
+    PASSWORD_HASH_SETTINGS = None
+    TOKEN_REVOCATION_SYNC_INTERVAL = 0
+    RATE_LIMIT_SEGMENT = None
     # heh, sorry not sorry.
     SENTRY_ENVIRONMENT = \
         f"ghpr-{os.environ.get('GITHUB_REF', 'missing-ref').replace('/', '-')}"
@@ -49,4 +175,9 @@ class ProductionConfig(BaseConfig):
     JWT_ACCESS_LIFESPAN = {'seconds': 0}
     JWT_REFRESH_LIFESPAN = {'minutes': 60}
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
+    # Workers scale out, keep each one's share of the connection ceiling
+    # small and fail fast rather than queue when it is used up
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(
+        SQLALCHEMY_DATABASE_URI, pool_size=4, max_overflow=2, pool_timeout=5,
+        pool_recycle=900)
     SENTRY_ENVIRONMENT = os.environ.get('SENTRY_ENVIRONMENT', 'production')
@@ -4,6 +4,8 @@
 from flask_testing import TestCase
 
 from service import create_app, db
+from service.api.extensions import guard, limiter
+from service.api.models import Role, identity_cache, revocations
 
 app = create_app()
 
@@ -20,3 +22,8 @@ class BaseTestCase(TestCase):
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        identity_cache.clear()
+        revocations.clear()
+        limiter.clear()
+        guard.clear_jwt_cache()
+        Role.clear()
@@ -1,12 +1,15 @@
 import json
 import unittest
+
+import pendulum
 from flask import current_app
 
 from service import db
+from service.api.extensions import guard, hasher
 from service.api.models import User
 from service.tests.base import BaseTestCase
-from service.tests.utils import add_user, get_user_token, login_user, \
-    JsonExtendEncoder
+from service.tests.utils import add_user, get_url_with_token, \
+    get_user_token, login_user, make_token, JsonExtendEncoder
 
 
 class TestAuthBlueprint(BaseTestCase):
@@ -156,6 +159,50 @@ class TestAuthBlueprint(BaseTestCase):
             self.assertTrue(response.content_type == 'application/json')
             self.assertEqual(response.status_code, 200)
 
+    def test_registered_user_login_email_case(self):
+        add_user('test', 'test@test.com', 'test')
+        with self.client:
+            data = login_user(self.client, 'TEST@test.com', 'test')
+            self.assertEqual('test', data['username'])
+            self.assertTrue(data['auth_token'])
+
+    def test_user_registration_duplicate_email_case(self):
+        add_user('test', 'test@test.com', 'test')
+        with self.client:
+            response = self.client.post(
+                '/api/auth/register',
+                data=json.dumps({
+                    'username': 'test_me',
+                    'email': 'Test@Test.com',
+                    'password': 'test'
+                    }),
+                content_type='application/json',
+                )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 409)
+            self.assertIn(
+                'Email already exists: Test@Test.com', data['message'])
+
+    def test_login_rate_limited_before_hashing(self):
+        add_user('test', 'test@test.com', 'test')
+        current_app.config['LOGIN_RATE_LIMIT_EMAIL'] = (2, 60)
+        with self.client:
+            for _ in range(2):
+                data = login_user(self.client, 'test@test.com', 'wrong')
+                self.assertEqual(data['error'], 'AuthenticationError')
+            verified = hasher.stats()['calls']['verify']
+            response = self.client.post(
+                '/api/auth/login',
+                json={'email': 'TEST@test.com', 'password': 'test'},
+                )
+            data = json.loads(response.data.decode())
+            self.assertEqual(data['status_code'], 429)
+            self.assertEqual(response.headers['Retry-After'], '30')
+            self.assertEqual(data['error'], 'RateLimited')
+            self.assertEqual(hasher.stats()['calls']['verify'], verified)
+            data = login_user(self.client, 'other@test.com', 'test')
+            self.assertEqual(data['error'], 'MissingUserError')
+
     def test_not_registered_user_login(self):
         with self.client:
             response = self.client.post(
@@ -196,6 +243,23 @@ class TestAuthBlueprint(BaseTestCase):
             self.assertTrue(data['message'] == 'Successfully logged out.')
             self.assertEqual(response.status_code, 200)
 
+    def test_logout_revokes_token(self):
+        add_user('test', 'test@test.com', 'test')
+        with self.client:
+            token = make_token(User.lookup('test@test.com'))
+            response = get_url_with_token(
+                self.client, '/api/auth/logout', token)
+            self.assertEqual(response.status_code, 200)
+            for url in ('/api/auth/status', '/api/auth/logout'):
+                response = get_url_with_token(self.client, url, token)
+                data = json.loads(response.data.decode())
+                self.assertEqual(response.status_code, 403)
+                self.assertEqual('BlacklistedError', data['error'])
+            token2 = make_token(User.lookup('test@test.com'))
+            response = get_url_with_token(
+                self.client, '/api/auth/status', token2)
+            self.assertEqual(response.status_code, 200)
+
     @unittest.skip("Not Implemented")
     def test_invalid_logout_expired_token(self):
         add_user('test', 'test@test.com', 'test')
@@ -365,6 +429,56 @@ class TestAuthBlueprint(BaseTestCase):
             self.assertEqual(401, data['status_code'])
             self.assertEqual('InvalidTokenHeader', data['error'])
 
+    def test_disable_user_version_conflict(self):
+        admin = add_user('test', 'test@test.com', 'test', 'admin')
+        user = add_user('test2', 'test2@test.com', 'test2')
+        user.update(admin=True)
+        token = guard.encode_jwt_token(
+            admin, override_access_lifespan=pendulum.Duration(hours=1))
+        with self.client:
+            for version, status in ((1, 409), (2, 200), (2, 409)):
+                response = self.client.patch(
+                    '/api/auth/disable',
+                    headers={'Authorization': f'Bearer {token}'},
+                    json={'email': 'test2@test.com', 'version': version},
+                    )
+                self.assertEqual(response.status_code, status)
+            data = json.loads(response.data.decode())
+            self.assertEqual(
+                'User changed since version 2: test2@test.com',
+                data['message'])
+
+            for version in ('2', 2.5, True, None):
+                response = self.client.patch(
+                    '/api/auth/disable',
+                    headers={'Authorization': f'Bearer {token}'},
+                    json={'email': 'test2@test.com', 'version': version},
+                    )
+                self.assertEqual(response.status_code, 400)
+
+            response = self.client.patch(
+                '/api/auth/disable',
+                headers={'Authorization': f'Bearer {token}'},
+                json={'email': 'nobody@test.com'},
+                )
+            self.assertEqual(response.status_code, 404)
+
+    def test_disable_user_email_case(self):
+        admin = add_user('test', 'test@test.com', 'test', 'admin')
+        add_user('test2', 'Test2@Test.com', 'test2')
+        token = guard.encode_jwt_token(
+            admin, override_access_lifespan=pendulum.Duration(hours=1))
+        with self.client:
+            response = self.client.patch(
+                '/api/auth/disable',
+                headers={'Authorization': f'Bearer {token}'},
+                json={'email': 'test2@TEST.com'},
+                )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data.decode()),
+                         {'message': 'disabled user test2'})
+        self.assertFalse(User.lookup('test2@test.com').is_active)
+
     def test_disable_user_no_role(self):
         add_user('test', 'test@test.com', 'test')
         add_user('test2', 'test2@test.com', 'test2')
@@ -1,8 +1,12 @@
+import importlib
 import os
 import unittest
+from unittest import mock
 from flask import current_app
 from flask_testing import TestCase
+from sqlalchemy.pool import NullPool
 from service import create_app
+from service.config import engine_options
 
 app = create_app()
 
@@ -55,5 +59,76 @@ class TestProductionConfig(TestCase):
         self.assertFalse(app.config['DEBUG_TB_ENABLED'])
 
 
+class TestAppFactory(TestCase):
+    def create_app(self):
+        return create_app(app_settings='service.config.TestingConfig')
+
+    def test_app_is_not_forced_into_debug(self):
+        self.assertFalse(self.app.debug)
+        self.assertNotIn('flask_debugtoolbar', self.app.extensions)
+
+    def test_migrate_is_loaded_for_the_cli(self):
+        self.assertNotIn('migrate', self.app.extensions)
+        cli_app = create_app(
+            app_settings='service.config.TestingConfig', migrate=True)
+        self.assertIn('migrate', cli_app.extensions)
+
+
+class TestEngineOptions(unittest.TestCase):
+    url = 'postgres://postgres:postgres@db:5432/users'
+
+    def test_profile(self):
+        with mock.patch.dict(os.environ, clear=True):
+            options = engine_options(self.url, pool_size=4, max_overflow=2)
+        self.assertEqual(options['pool_size'], 4)
+        self.assertEqual(options['max_overflow'], 2)
+        self.assertTrue(options['pool_pre_ping'])
+
+    def test_environment_overrides_profile(self):
+        with mock.patch.dict(os.environ, {
+                'DB_POOL_SIZE': '1', 'DB_POOL_RECYCLE': '60'}):
+            options = engine_options(self.url, pool_size=4, max_overflow=2)
+        self.assertEqual(options['pool_size'], 1)
+        self.assertEqual(options['pool_recycle'], 60)
+
+    def test_pgbouncer(self):
+        with mock.patch.dict(os.environ, {'DB_PGBOUNCER': '1'}):
+            self.assertEqual(
+                engine_options(self.url, pool_size=4, max_overflow=2),
+                {'poolclass': NullPool})
+        with mock.patch.dict(
+                os.environ, {'DB_PGBOUNCER': '1', 'DB_NULL_POOL': '0'}):
+            options = engine_options(self.url, pool_size=4, max_overflow=2)
+        self.assertFalse(options['pool_pre_ping'])
+        self.assertEqual(options['pool_size'], 4)
+
+    def test_sqlite_gets_defaults(self):
+        self.assertEqual(
+            engine_options('sqlite://', pool_size=4, max_overflow=2), {})
+
+
+class TestGunicornConfig(unittest.TestCase):
+
+    def load(self, **env):
+        with mock.patch.dict(os.environ, env):
+            import gunicorn_config
+            return importlib.reload(gunicorn_config)
+
+    def test_profiles(self):
+        config = self.load(GUNICORN_PROFILE='gthread')
+        self.assertEqual(config.worker_class, 'gthread')
+        self.assertEqual(config.workers, config.cores + 1)
+        self.assertTrue(config.preload_app)
+        config = self.load(GUNICORN_PROFILE='gevent', WEB_CONCURRENCY='3')
+        self.assertEqual(config.worker_class, 'gevent')
+        self.assertEqual(config.workers, 3)
+        self.assertFalse(config.preload_app)
+        self.assertEqual(
+            self.load(GUNICORN_PROFILE='sync').max_requests_jitter, 200)
+
+    def test_unknown_profile(self):
+        self.assertRaises(RuntimeError, self.load, GUNICORN_PROFILE='eventlet')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,136 @@
+import threading
+import time
+import unittest
+
+from service.api.extensions import guard, hasher
+from service.api.hashing import HashingExecutor, HashingUnavailable, \
+    calibrate
+from service.api.models import User
+from service.tests.base import BaseTestCase
+from service.tests.utils import add_user, login_user
+
+
+def _sleep(policy, seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+class TestHashingExecutor(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.executor = HashingExecutor()
+        self.executor.init_app(self.app, guard)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        super().tearDown()
+
+    def test_hash_inline(self):
+        hashed = self.executor.hash('Downf0ryourRIGHTtoParty!')
+        self.assertTrue(guard.pwd_ctx.verify(
+            'Downf0ryourRIGHTtoParty!', hashed))
+        self.assertIsNone(self.executor._pool)
+
+    def test_hash_and_verify_on_pool(self):
+        self.executor.workers = 1
+        hashed = self.executor.hash('Downf0ryourRIGHTtoParty!')
+        self.assertTrue(
+            self.executor.verify('Downf0ryourRIGHTtoParty!', hashed))
+        self.assertFalse(self.executor.verify('wrong', hashed))
+        self.assertIsNotNone(self.executor._pool)
+        stats = self.executor.stats()
+        self.assertEqual(
+            stats['calls'], {'hash': 1, 'hash_many': 0, 'verify': 2})
+        self.assertEqual(stats['pending'], 0)
+        self.assertGreater(stats['seconds_max']['hash'], 0)
+
+    def test_hash_many_in_chunks(self):
+        self.executor.workers = 2
+        passwords = [f'password{i}' for i in range(5)]
+        hashes = self.executor.hash_many(passwords, chunk_size=2)
+        for raw, hashed in zip(passwords, hashes):
+            self.assertTrue(guard.pwd_ctx.verify(raw, hashed))
+        stats = self.executor.stats()
+        self.assertEqual(stats['calls']['hash_many'], 3)
+        self.assertEqual(stats['pending'], 0)
+
+    def test_hash_many_takes_slots(self):
+        self.executor.workers = 2
+        self.executor.timeout = 0.01
+        for _ in range(self.executor.max_pending):
+            self.executor._slots.acquire()
+        self.assertRaises(
+            HashingUnavailable, self.executor.hash_many, ['a', 'b'])
+
+    def test_rejects_when_saturated(self):
+        self.executor.timeout = 0.01
+        for _ in range(self.executor.max_pending):
+            self.executor._slots.acquire()
+        self.assertRaises(HashingUnavailable, self.executor.hash, 'test')
+        self.assertEqual(self.executor.stats()['rejected'], 1)
+
+    def test_timed_out_task_keeps_its_slot(self):
+        self.executor.workers = 1
+        self.executor.timeout = 0.5
+        for _ in range(self.executor.max_pending):
+            self.executor._slots.acquire()
+        # a slot frees up part way through the deadline
+        threading.Timer(0.3, self.executor._slots.release).start()
+        start = time.monotonic()
+        self.assertRaises(
+            HashingUnavailable, self.executor._run, 'hash', _sleep, 1)
+        # the slot wait and the result wait share one deadline
+        self.assertLess(time.monotonic() - start, 0.75)
+        self.assertEqual(self.executor.stats()['timeouts'], 1)
+        # the hash is still running on the pool, and still holds the slot
+        self.assertEqual(self.executor.stats()['pending'], 1)
+        self.assertFalse(self.executor._slots.acquire(timeout=0))
+        time.sleep(1)
+        self.assertEqual(self.executor.stats()['pending'], 0)
+        self.assertTrue(self.executor._slots.acquire(timeout=0))
+
+    def test_authenticate(self):
+        add_user('test', 'test@test.com', 'test')
+        user = hasher.authenticate('test@test.com', 'test')
+        self.assertEqual(user.username, 'test')
+
+
+class TestHashCalibration(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.pwd_ctx = guard.pwd_ctx.copy()
+
+    def tearDown(self):
+        guard.pwd_ctx = self.pwd_ctx
+        super().tearDown()
+
+    def test_calibrate_picks_cheapest_meeting_target(self):
+        candidates = [
+            ('pbkdf2_sha512', {'rounds': 1000}),
+            ('pbkdf2_sha512', {'rounds': 200000}),
+            ]
+        results, choice = calibrate(0, samples=1, candidates=candidates)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(choice['settings'], {'rounds': 1000})
+        results, choice = calibrate(
+            10 ** 6, samples=1, candidates=candidates)
+        self.assertEqual(choice['settings'], {'rounds': 200000})
+
+    def test_login_rehashes_outdated_password(self):
+        hasher.apply_settings(
+            {'scheme': 'pbkdf2_sha512', 'settings': {'rounds': 1000}})
+        add_user('test', 'test@test.com', 'test')
+        hasher.apply_settings(
+            {'scheme': 'pbkdf2_sha512', 'settings': {'rounds': 2000}})
+        with self.client:
+            self.assertTrue(
+                login_user(self.client, 'test@test.com', 'test')['auth_token'])
+        user = User.query.filter_by(email='test@test.com').one()
+        self.assertTrue(user.password.startswith('$pbkdf2-sha512$2000$'))
+        self.assertFalse(guard.pwd_ctx.needs_update(user.password))
+
+
+if __name__ == '__main__':
+    unittest.main()
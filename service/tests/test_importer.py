@@ -0,0 +1,120 @@
+import io
+import json
+import unittest
+
+from benchmarks.dataset import dataset_password, generate_users
+from service.api.extensions import guard, hasher
+from service.api.importer import import_users
+from service.api.models import User
+from service.tests.base import BaseTestCase
+from service.tests.utils import add_user
+
+
+class TestBulkImport(BaseTestCase):
+
+    def test_import_csv(self):
+        add_user('taken', 'taken@test.com', 'test')
+        source = io.StringIO(
+            'username,email,password,admin\n'
+            'one,one@test.com,secret1,true\n'
+            'two,two@test.com,,\n'
+            'taken,three@test.com,secret3,\n'
+            'four,four@test.com,secret4,0\n'
+            )
+        report = import_users(source, 'csv', batch_size=2).to_json()
+        self.assertEqual(report['imported'], 2)
+        self.assertEqual(report['failed'], 2)
+        self.assertEqual(report['errors'], [
+            {'row': 3, 'error': "'password' is a required property"},
+            {'row': 4, 'error': 'Username already exists: taken'},
+            ])
+        one = User.query.filter_by(username='one').one()
+        self.assertTrue(one.admin)
+        self.assertTrue(one.is_active)
+        self.assertTrue(guard.pwd_ctx.verify('secret1', one.password))
+        self.assertFalse(User.query.filter_by(username='four').one().admin)
+
+    def test_import_jsonl_with_legacy_hash(self):
+        legacy = guard.pwd_ctx.hash('legacy', scheme='sha256_crypt')
+        source = io.StringIO('\n'.join([
+            json.dumps({'username': 'one', 'email': 'one@test.com',
+                        'password_hash': legacy}),
+            '{not json',
+            json.dumps({'username': 'two', 'email': 'two@test.com',
+                        'password_hash': 'plaintext'}),
+            ]))
+        report = import_users(source, 'jsonl').to_json()
+        self.assertEqual(report['imported'], 1)
+        self.assertEqual([e['row'] for e in report['errors']], [2, 3])
+        self.assertEqual(
+            User.query.filter_by(username='one').one().password, legacy)
+
+    def test_import_duplicates_within_a_batch(self):
+        source = io.StringIO(
+            'username,email,password\n'
+            'one,one@test.com,secret\n'
+            'two,One@Test.com,secret\n'
+            'one,three@test.com,secret\n'
+            'four,four@test.com,secret\n'
+            )
+        report = import_users(source, 'csv', batch_size=10).to_json()
+        self.assertEqual(report['imported'], 2)
+        self.assertEqual(report['failed'], 2)
+        self.assertEqual(report['errors'], [
+            {'row': 3, 'error': 'Email already exists: One@Test.com'},
+            {'row': 4, 'error': 'Username already exists: one'},
+            ])
+        self.assertEqual(
+            sorted(user.username for user in User.query), ['four', 'one'])
+
+    def test_import_rejects_values_that_dont_fit(self):
+        source = io.StringIO('\n'.join(json.dumps(record) for record in [
+            {'username': 123, 'email': 'one@test.com', 'password': 'x'},
+            {'username': 'two', 'email': ['two@test.com'], 'password': 'x'},
+            {'username': 'three', 'email': 'three@test.com', 'password': 3},
+            {'username': 'four', 'email': f"{'f' * 120}@test.com",
+             'password': 'x'},
+            {'username': 'five', 'email': 'five@test.com', 'password': 'x'},
+            ]))
+        report = import_users(source, 'jsonl').to_json()
+        self.assertEqual(report['imported'], 1)
+        self.assertEqual(report['errors'], [
+            {'row': 1, 'error': "'username' must be a string"},
+            {'row': 2, 'error': "'email' must be a string"},
+            {'row': 3, 'error': "'password' must be a string"},
+            {'row': 4, 'error': "'email' is longer than 128 characters"},
+            ])
+        self.assertEqual([user.username for user in User.query], ['five'])
+
+
+class TestGenerateUsers(BaseTestCase):
+
+    def test_generate_users(self):
+        add_user('test', 'test@test.com', 'test')
+        report = generate_users(50, batch_size=7, passwords=4)
+        self.assertEqual(report['inserted'], 50)
+        self.assertEqual(report['failed'], 0)
+        self.assertEqual(User.query.count(), 51)
+        # numbered after the existing user
+        self.assertEqual(report['first'], 2)
+        self.assertEqual(
+            len({user.password for user in User.query.all()}), 5)
+
+        user = User.query.filter(User.id == 10).one()
+        self.assertEqual(user.id, hasher.authenticate(
+            user.email, dataset_password(user.username, 4)).id)
+        self.assertEqual(
+            User.query.filter(User.role_mask.is_(None)).count(), 0)
+        for user in User.query.filter(User.roles.isnot(None)):
+            self.assertEqual(user.rolenames, [user.roles])
+
+    def test_generate_users_again(self):
+        generate_users(10, passwords=2)
+        report = generate_users(10, passwords=2, seed=1)
+        self.assertEqual(report['inserted'], 10)
+        self.assertEqual(report['first'], 11)
+        self.assertEqual(User.query.count(), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
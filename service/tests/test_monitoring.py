@@ -0,0 +1,196 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import pendulum
+from prometheus_client import REGISTRY
+
+from service.api.extensions import guard
+from service.api.models import User
+from service.tests.base import BaseTestCase
+from service.tests.utils import add_user, get_url_with_token, \
+    get_user_token, login_user, make_token
+
+
+class TestMonitoring(BaseTestCase):
+
+    def test_pool_gauges(self):
+        add_user('test', 'test@test.com', 'test', 'admin')
+        with self.client:
+            token = make_token(User.lookup('test@test.com'))
+            response = get_url_with_token(
+                self.client, '/api/monitoring/pool', token)
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['pool'], 'StaticPool')
+            self.assertGreater(data['checkouts'], 0)
+
+    def test_pool_gauges_require_admin(self):
+        add_user('test', 'test@test.com', 'test')
+        with self.client:
+            token = make_token(User.lookup('test@test.com'))
+            response = get_url_with_token(
+                self.client, '/api/monitoring/pool', token)
+            self.assertEqual(response.status_code, 403)
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class TestMetrics(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['METRICS_TOKEN'] = 'scrape'
+
+    def test_request_metrics(self):
+        route = {'namespace': 'users', 'route': '/api/users/<string:user_id>'}
+        requests = sample('flask_auth_requests_total', method='GET',
+                          status='200', **route)
+        queries = sample('flask_auth_request_db_queries_sum', **route)
+        add_user('test', 'test@test.com', 'test')
+        with self.client:
+            token = make_token(User.lookup('test@test.com'))
+            get_url_with_token(self.client, '/api/users/1', token)
+            response = get_url_with_token(
+                self.client, '/api/metrics', 'scrape')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'flask_auth_request_duration_seconds_bucket{',
+                      response.data)
+        self.assertEqual(sample('flask_auth_requests_total', method='GET',
+                                status='200', **route), requests + 1)
+        self.assertGreater(
+            sample('flask_auth_request_db_queries_sum', **route), queries)
+
+    def test_metrics_need_the_token(self):
+        self.app.config['METRICS_TOKEN'] = None
+        self.assertEqual(self.client.get('/api/metrics').status_code, 404)
+        self.app.config['METRICS_TOKEN'] = 'scrape'
+        for token in (None, 'wrong'):
+            response = self.client.get('/api/metrics', headers={
+                'Authorization': f'Bearer {token}'} if token else {})
+            self.assertEqual(response.status_code, 401)
+
+    def test_hash_and_jwt_metrics(self):
+        # minted up front, a login's token may expire before it is used
+        token = make_token(add_user('test', 'test@test.com', 'test'))
+        verifies = sample('flask_auth_password_hash_seconds_count',
+                          operation='verify')
+        encodes = sample('flask_auth_jwt_seconds_count', operation='encode')
+        decodes = sample('flask_auth_jwt_seconds_count', operation='decode')
+        with self.client:
+            self.assertTrue(login_user(
+                self.client, 'test@test.com', 'test')['auth_token'])
+            get_url_with_token(self.client, '/api/auth/status', token)
+        self.assertEqual(sample('flask_auth_password_hash_seconds_count',
+                                operation='verify'), verifies + 1)
+        self.assertEqual(sample('flask_auth_jwt_seconds_count',
+                                operation='encode'), encodes + 1)
+        self.assertEqual(sample('flask_auth_jwt_seconds_count',
+                                operation='decode'), decodes + 1)
+
+    def test_unmatched_routes_share_a_label(self):
+        labels = {'namespace': 'none', 'route': 'unmatched',
+                  'method': 'GET', 'status': '404'}
+        before = sample('flask_auth_requests_total', **labels)
+        self.client.get('/api/users/1/nothing/here')
+        self.client.get('/nowhere')
+        self.assertEqual(
+            sample('flask_auth_requests_total', **labels), before + 2)
+
+    def test_pool_events(self):
+        before = sample('flask_auth_db_pool_events_total', event='checkouts')
+        self.client.get('/api/users/ping')
+        add_user('test', 'test@test.com', 'test')
+        self.assertGreater(
+            sample('flask_auth_db_pool_events_total', event='checkouts'),
+            before)
+
+
+class TestProfiler(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.app.config.update(
+            PROFILING_ENABLED=True, PROFILE_DIR=self.directory,
+            PROFILE_INTERVAL=0.001)
+        self.admin = guard.encode_jwt_token(
+            add_user('admin', 'admin@test.com', 'test', 'admin'),
+            override_access_lifespan=pendulum.Duration(hours=1))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def test_profile_login(self):
+        add_user('test', 'test@test.com', 'test')
+        response = self.client.post(
+            '/api/auth/login', headers={'X-Profile': self.admin},
+            json={'email': 'test@test.com', 'password': 'test'})
+        self.assertEqual(response.status_code, 200)
+        profile_id = response.headers['X-Profile-Id']
+
+        response = get_url_with_token(
+            self.client, '/api/monitoring/profiles', self.admin)
+        profiles = json.loads(response.data.decode())
+        self.assertEqual([p['id'] for p in profiles], [profile_id])
+        self.assertEqual(profiles[0]['route'], '/api/auth/login')
+        self.assertGreater(profiles[0]['samples'], 0)
+
+        response = get_url_with_token(
+            self.client, f'/api/monitoring/profiles/{profile_id}',
+            self.admin)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        stacks = response.data.decode().splitlines()
+        self.assertEqual(
+            sum(int(line.rsplit(' ', 1)[1]) for line in stacks),
+            profiles[0]['samples'])
+        self.assertTrue(any('api/auth.py:post' in line for line in stacks))
+
+    def test_only_admins_profile(self):
+        user = add_user('test', 'test@test.com', 'test')
+        token = guard.encode_jwt_token(
+            user, override_access_lifespan=pendulum.Duration(hours=1))
+        for header in (token, 'not-a-token'):
+            response = self.client.get(
+                '/api/users/ping', headers={'X-Profile': header})
+            self.assertNotIn('X-Profile-Id', response.headers)
+        response = get_url_with_token(
+            self.client, '/api/monitoring/profiles', token)
+        self.assertEqual(response.status_code, 403)
+
+    def test_off_by_default(self):
+        self.app.config['PROFILING_ENABLED'] = False
+        response = self.client.get(
+            '/api/users/ping', headers={'X-Profile': self.admin})
+        self.assertNotIn('X-Profile-Id', response.headers)
+
+    def test_ring_is_bounded(self):
+        self.app.config['PROFILE_RING_SIZE'] = 2
+        ids = [self.client.get(
+            '/api/users/ping', headers={'X-Profile': self.admin},
+            ).headers['X-Profile-Id'] for _ in range(3)]
+        response = get_url_with_token(
+            self.client, '/api/monitoring/profiles', self.admin)
+        self.assertEqual(
+            [p['id'] for p in json.loads(response.data.decode())],
+            ids[:0:-1])
+        for profile_id in (ids[0], '..%2Fsecrets'):
+            response = get_url_with_token(
+                self.client, f'/api/monitoring/profiles/{profile_id}',
+                self.admin)
+            self.assertEqual(response.status_code, 404)
+
+    def test_empty_ring(self):
+        self.app.config['PROFILE_RING_SIZE'] = 0
+        self.client.get('/api/users/ping', headers={'X-Profile': self.admin})
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
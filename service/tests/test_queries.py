@@ -0,0 +1,139 @@
+import json
+import unittest
+
+import pendulum
+
+from service import db
+from service.api.extensions import guard
+from service.api.models import User
+from service.tests.base import BaseTestCase
+from service.tests.utils import add_user, get_url_with_token, make_token, \
+    query_budget
+
+
+def n_plus_one():
+    """A view loading users one SELECT each"""
+    return ','.join(User.query.get(user_id).username for user_id in (1, 2))
+
+
+class TestQueryTracker(BaseTestCase):
+
+    def test_server_timing(self):
+        token = make_token(add_user('test', 'test@test.com', 'test'))
+        db.session.remove()
+        with self.client:
+            response = get_url_with_token(
+                self.client, '/api/auth/status', token)
+        timing = response.headers['Server-Timing']
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="\d+ queries", ')
+        self.assertRegex(timing, r'app;dur=[\d.]+$')
+
+    def test_no_queries(self):
+        response = self.client.get('/api/users/ping')
+        self.assertTrue(response.headers['Server-Timing'].startswith(
+            'db;dur=0.00;desc="0 queries"'))
+
+    def test_repeated_statements_are_logged(self):
+        add_user('one', 'one@test.com', 'test')
+        add_user('two', 'two@test.com', 'test')
+        db.session.remove()
+        if 'n_plus_one' not in self.app.view_functions:
+            self.app.add_url_rule('/n-plus-one', 'n_plus_one', n_plus_one)
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            response = self.client.get('/n-plus-one')
+        self.assertRegex(response.headers['Server-Timing'],
+                         r'^db;dur=[\d.]+;desc="2 queries", ')
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['event'], 'sql')
+        self.assertEqual(record['route'], '/n-plus-one')
+        self.assertEqual(record['queries'], 2)
+        self.assertEqual(record['repeated'][0]['count'], 2)
+        self.assertIn('FROM users', record['repeated'][0]['statement'])
+
+
+class TestQueryBudgets(BaseTestCase):
+    """Most statements each endpoint may run, from a fresh session"""
+
+    def setUp(self):
+        super().setUp()
+        self.admin = make_token(
+            add_user('admin', 'admin@test.com', 'test', 'admin'))
+        self.user = add_user('test', 'test@test.com', 'test')
+        self.token = make_token(self.user)
+        # the first authenticated request pulls the revocation list
+        get_url_with_token(self.client, '/api/auth/status', self.token)
+        db.session.remove()
+
+    def headers(self, token=None):
+        return {'Authorization': f'Bearer {token or self.token}'}
+
+    def test_register(self):
+        with query_budget(1):
+            response = self.client.post('/api/auth/register', json={
+                'username': 'new', 'email': 'new@test.com',
+                'password': 'test'})
+        self.assertEqual(response.status_code, 201)
+
+    def test_login(self):
+        with query_budget(1):
+            response = self.client.post('/api/auth/login', json={
+                'email': 'test@test.com', 'password': 'test'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_status(self):
+        with query_budget(1):
+            response = self.client.get(
+                '/api/auth/status', headers=self.headers())
+        self.assertEqual(response.status_code, 200)
+
+    def test_logout(self):
+        with query_budget(1):
+            response = self.client.get(
+                '/api/auth/logout', headers=self.headers())
+        self.assertEqual(response.status_code, 200)
+
+    def test_disable(self):
+        # one UPDATE ... RETURNING on Postgres, sqlite reads the row back
+        with query_budget(2):
+            response = self.client.patch(
+                '/api/auth/disable', headers=self.headers(self.admin),
+                json={'email': 'test@test.com'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_users_list(self):
+        with query_budget(1):
+            response = self.client.get('/api/users/', headers=self.headers())
+        self.assertEqual(response.status_code, 200)
+
+    def test_users_get(self):
+        with query_budget(1):
+            response = self.client.get(
+                '/api/users/2', headers=self.headers())
+        self.assertEqual(response.status_code, 200)
+
+    def test_users_get_not_modified(self):
+        etag = self.client.get(
+            '/api/users/2', headers=self.headers()).headers['ETag']
+        db.session.remove()
+        # the user is in the identity cache now
+        with query_budget(0):
+            response = self.client.get('/api/users/2', headers=dict(
+                self.headers(), **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+
+    def test_users_post(self):
+        with query_budget(1):
+            response = self.client.post(
+                '/api/users/', headers=self.headers(), json={
+                    'username': 'new', 'email': 'new@test.com',
+                    'password': 'test'})
+        self.assertEqual(response.status_code, 201)
+
+    def test_over_budget(self):
+        with self.assertRaises(AssertionError):
+            with query_budget(0):
+                self.client.get('/api/users/', headers=self.headers())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import time
+import unittest
+
+from service.api.ratelimit import RateLimited, RateLimiter
+from service.tests.base import BaseTestCase
+
+
+class TestRateLimiter(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = tempfile.mktemp(prefix='flask-auth-ratelimit-')
+        self.app.config['RATE_LIMIT_SEGMENT'] = self.path
+        self.app.config['RATE_LIMIT_SLOTS'] = 64
+        self.limiter = RateLimiter()
+        self.limiter.init_app(self.app)
+
+    def tearDown(self):
+        self.limiter.close()
+        os.unlink(self.path)
+        super().tearDown()
+
+    def test_bucket_empties_and_refills(self):
+        for _ in range(3):
+            self.assertEqual(self.limiter.hit('key', (3, 0.3)), 0)
+        retry_after = self.limiter.hit('key', (3, 0.3))
+        self.assertGreater(retry_after, 0)
+        self.assertLessEqual(retry_after, 0.1)
+        self.assertEqual(self.limiter.hit('other', (3, 0.3)), 0)
+        time.sleep(0.11)
+        self.assertEqual(self.limiter.hit('key', (3, 0.3)), 0)
+        self.assertEqual(self.limiter.stats()['rejected'], 1)
+
+    def test_limit_raises(self):
+        self.limiter.limit('key', (1, 60))
+        with self.assertRaises(RateLimited) as ctx:
+            self.limiter.limit('key', (1, 60))
+        self.assertEqual(ctx.exception.status_code, 429)
+        self.assertIn('retry in 60 seconds', ctx.exception.message)
+        self.assertEqual(ctx.exception.headers, {'Retry-After': '60'})
+        # no limit configured
+        self.limiter.limit('key', None)
+
+    def test_only_refilled_buckets_are_evicted(self):
+        self.limiter.ways = self.limiter.slots = 2
+        self.limiter.hit('a', (1, 60))
+        self.limiter.hit('b', (1, 0.05))
+        # both buckets are refilling, the set is closed to new keys
+        retry_after = self.limiter.hit('c', (1, 60))
+        self.assertGreater(retry_after, 0)
+        self.assertLessEqual(retry_after, 0.05)
+        time.sleep(0.06)
+        # 'b' refilled, 'c' takes its slot while 'a' keeps its bucket
+        self.assertEqual(self.limiter.hit('c', (1, 60)), 0)
+        self.assertTrue(self.limiter.hit('a', (1, 60)))
+        self.assertGreater(self.limiter.hit('b', (1, 0.05)), 1)
+        self.assertEqual(self.limiter.stats()['rejected'], 3)
+
+    def test_buckets_shared_between_processes(self):
+        self.limiter.hit('key', (2, 60))
+        pid = os.fork()
+        if pid == 0:
+            limiter = RateLimiter()
+            limiter.init_app(self.app)
+            os._exit(0 if limiter.hit('key', (2, 60)) == 0 else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertGreater(self.limiter.hit('key', (2, 60)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import json
+import unittest
+from types import SimpleNamespace
+
+import pendulum
+from flask_restplus import fields, marshal
+
+from service.api.auth import user_register_fields
+from service.api.extensions import guard
+from service.api.serializers import Serializer, compile_model, output_json
+from service.api.users import user_fields
+from service.tests.base import BaseTestCase
+from service.tests.utils import add_user
+
+
+class TestSerializer(BaseTestCase):
+
+    def test_same_as_marshal(self):
+        user = add_user('test', 'test@test.com', 'test')
+        user.auth_token = 'token'
+        for model in (user_fields, user_register_fields):
+            self.assertEqual(Serializer.for_model(model)(user),
+                             marshal(user, model))
+            self.assertEqual(Serializer.for_model(model)([user, user]),
+                             marshal([user, user], model))
+
+    def test_missing_and_loose_values(self):
+        odd = SimpleNamespace(id='7', username=3, admin='true', is_active=0)
+        self.assertEqual(compile_model(user_fields)(odd),
+                         marshal(odd, user_fields))
+        self.assertEqual(compile_model(user_fields)(None),
+                         marshal(None, user_fields))
+        self.assertEqual(compile_model(user_fields)({'id': 1}),
+                         marshal({'id': 1}, user_fields))
+
+    def test_fields_that_are_not_inlined(self):
+        model = {
+            'id': fields.Integer,
+            'name': fields.String(attribute='username'),
+            'level': fields.Integer(default=3),
+            'when': fields.Raw(attribute=lambda obj: obj.id * 2),
+            }
+        obj = SimpleNamespace(id=2, username='test', level=None)
+        serialize = compile_model(model)
+        self.assertEqual(serialize(obj), marshal(obj, model))
+        self.assertIn('_f2.output', serialize.__source__)
+
+    def test_mask_header_is_honoured(self):
+        add_user('test', 'test@test.com', 'test')
+        with self.client:
+            response = self.client.post(
+                '/api/auth/login',
+                data=json.dumps({
+                    'email': 'test@test.com', 'password': 'test'}),
+                content_type='application/json',
+                headers={'X-Fields': 'id,email'},
+                )
+        self.assertEqual(json.loads(response.data.decode()),
+                         {'id': 1, 'email': 'test@test.com'})
+
+    def test_output_json(self):
+        token = guard.encode_jwt_token(
+            add_user('test', 'test@test.com', 'test'),
+            override_access_lifespan=pendulum.Duration(hours=1),
+            override_refresh_lifespan=pendulum.Duration(hours=2))
+        with self.client:
+            response = self.client.get(
+                '/api/users/1', headers={'Authorization': f'Bearer {token}'})
+        self.assertTrue(response.data.endswith(b'\n'))
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(json.loads(response.data.decode())['username'],
+                         'test')
+
+    def test_output_json_falls_back(self):
+        with self.app.test_request_context():
+            response = output_json({1: 'one'}, 200, {'X-Test': 'yes'})
+        self.assertEqual(json.loads(response.get_data()), {'1': 'one'})
+        self.assertEqual(response.headers['X-Test'], 'yes')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import subprocess
+import sys
+import unittest
+
+
+# Modules only the cli or an opt-in config may pull in
+LAZY_MODULES = ('flask_debugtoolbar', 'sentry_sdk', 'flask_migrate',
+                'alembic', 'concurrent.futures.process')
+# Generous for CI machines, IMPORT_TIME_BUDGET_MS tightens or loosens it
+IMPORT_TIME_BUDGET_MS = int(os.environ.get('IMPORT_TIME_BUDGET_MS', 2000))
+
+
+def import_time(module):
+    """Import ``module`` in a fresh interpreter under ``-X importtime``
+
+    Returns the cumulative import time of ``module`` in ms and the names of
+    every module imported.
+    """
+    env = dict(os.environ, SECRET_KEY='import-time', DATABASE_URL='sqlite://')
+    env.pop('SENTRY_URL', None)
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        env=env, stderr=subprocess.PIPE, check=True,
+        )
+    modules, cumulative = {}, None
+    for line in result.stderr.decode().splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        if not cumulative_us.strip().isdigit():
+            continue
+        modules[name.strip()] = int(cumulative_us) / 1000
+        if name.strip() == module:
+            cumulative = int(cumulative_us) / 1000
+    return cumulative, modules
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_production_import_skips_optional_extensions(self):
+        _, modules = import_time('wsgi')
+        for name in LAZY_MODULES:
+            self.assertNotIn(name, modules)
+
+    def test_import_time_budget(self):
+        # best of three, the first run also pays for cold disk caches
+        best = min(import_time('wsgi')[0] for _ in range(3))
+        self.assertLess(
+            best, IMPORT_TIME_BUDGET_MS,
+            f'importing wsgi took {best:.0f}ms, '
+            f'over the {IMPORT_TIME_BUDGET_MS}ms budget')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import json
+import unittest
+
+import pendulum
+from flask_praetorian.exceptions import BlacklistedError, \
+    ExpiredAccessError, InvalidTokenHeader, InvalidUserError, \
+    MissingClaimError
+
+from service import db
+from service.api.extensions import guard
+from service.api.models import User, revocations
+from service.tests.base import BaseTestCase
+from service.tests.utils import add_user, captured_statements, \
+    get_url_with_token, get_user_token, make_token
+
+
+class TestJWTCache(BaseTestCase):
+
+    def test_cached_token_skips_decoding(self):
+        add_user('test', 'test@test.com', 'test')
+        with self.client:
+            token = make_token(User.lookup('test@test.com'))
+            for _ in range(3):
+                response = get_url_with_token(
+                    self.client, '/api/auth/status', token)
+                self.assertEqual(response.status_code, 200)
+        stats = guard.jwt_cache_stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['size'], 1)
+
+    def test_cached_claims_are_revalidated(self):
+        user = add_user('test', 'test@test.com', 'test')
+        token = guard.encode_jwt_token(
+            user, override_access_lifespan=pendulum.Duration(seconds=60))
+        data = guard.extract_jwt_token(token)
+        self.assertEqual(guard.extract_jwt_token(token), data)
+
+        revocations.revoke(data['jti'], data['rf_exp'])
+        self.assertRaises(BlacklistedError, guard.extract_jwt_token, token)
+        revocations.clear()
+
+        guard._jwt_cache[next(iter(guard._jwt_cache))][1]['exp'] = 0
+        self.assertRaises(ExpiredAccessError, guard.extract_jwt_token, token)
+        self.assertEqual(guard.jwt_cache_stats()['hits'], 3)
+
+    def test_tampered_token_is_not_a_hit(self):
+        user = add_user('test', 'test@test.com', 'test')
+        token = guard.encode_jwt_token(user)
+        guard.extract_jwt_token(token)
+        self.assertRaises(
+            InvalidTokenHeader, guard.extract_jwt_token, token[:-2] + 'xx')
+        self.assertEqual(guard.jwt_cache_stats()['hits'], 0)
+
+
+class TestStatelessAuthorization(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        guard.stateless = True
+
+    def tearDown(self):
+        guard.stateless = False
+        super().tearDown()
+
+    def test_token_carries_status_and_generation(self):
+        user = add_user('test', 'test@test.com', 'test')
+        data = guard.extract_jwt_token(guard.encode_jwt_token(
+            user, override_access_lifespan=pendulum.Duration(seconds=60)))
+        self.assertIs(data['act'], True)
+        self.assertEqual(data['gen'], 0)
+
+    def test_authorized_from_claims_without_queries(self):
+        user = add_user('test', 'test@test.com', 'test', 'admin')
+        token = guard.encode_jwt_token(
+            user, override_access_lifespan=pendulum.Duration(seconds=60))
+        guard.extract_jwt_token(token)
+        db.session.remove()
+        with captured_statements() as statements:
+            data = guard.extract_jwt_token(token)
+        self.assertEqual(data['rls'], 'admin')
+        self.assertEqual(statements, [])
+
+    def test_role_or_status_change_rejects_issued_tokens(self):
+        user = add_user('test', 'test@test.com', 'test')
+        for change in ({'roles': 'admin'}, {'is_active': False}):
+            token = guard.encode_jwt_token(
+                user, override_access_lifespan=pendulum.Duration(seconds=60))
+            guard.extract_jwt_token(token)
+            user.update(**change)
+            self.assertRaises(
+                InvalidUserError, guard.extract_jwt_token, token)
+        self.assertEqual(user.token_generation, 2)
+
+    def test_set_roles_rejects_issued_tokens(self):
+        user = add_user('test', 'test@test.com', 'test', 'admin')
+        token = make_token(user)
+        self.assertEqual(get_url_with_token(
+            self.client, '/api/monitoring/pool', token).status_code, 200)
+        user.set_roles(None)
+        user.save()
+        self.assertEqual(user.token_generation, 1)
+        self.assertEqual(get_url_with_token(
+            self.client, '/api/monitoring/pool', token).status_code, 403)
+
+    def test_disabled_user_token_rejected(self):
+        add_user('test', 'test@test.com', 'test', 'admin')
+        add_user('test2', 'test2@test.com', 'test2')
+        with self.client:
+            token = make_token(User.lookup('test@test.com'))
+            token2 = make_token(User.lookup('test2@test.com'))
+            response = self.client.patch(
+                '/api/auth/disable',
+                headers={'Authorization': f'Bearer {token}'},
+                content_type='application/json',
+                data=json.dumps({'email': 'test2@test.com'}),
+                )
+            self.assertEqual(response.status_code, 200)
+            response = get_url_with_token(
+                self.client, '/api/auth/status', token2)
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 403)
+            self.assertEqual(data['error'], 'InvalidUserError')
+
+    def test_token_without_claims_rejected(self):
+        user = add_user('test', 'test@test.com', 'test')
+        guard.stateless = False
+        token = guard.encode_jwt_token(
+            user, override_access_lifespan=pendulum.Duration(seconds=60))
+        guard.stateless = True
+        self.assertRaises(MissingClaimError, guard.extract_jwt_token, token)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,14 @@
+import time
 import unittest
 
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 
 from service import db
-from service.api.models import User
+from service.api.models import RevokedToken, Role, User, backfill_roles, \
+    identity_cache, revocations, unique_violation
 from service.tests.base import BaseTestCase
-from service.tests.utils import add_user
+from service.tests.utils import add_user, captured_statements
 
 
 class TestUserModel(BaseTestCase):
@@ -54,6 +57,236 @@ class TestUserModel(BaseTestCase):
             )
         self.assertNotEqual(user_one.password, user_two.password)
 
+    def test_identify_is_cached(self):
+        user_id = add_user('testuser', 'test@test.com', 'test').id
+        db.session.remove()
+        self.assertEqual(User.identify(user_id).username, 'testuser')
+        db.session.remove()
+        cached = User.identify(user_id)
+        self.assertEqual(cached.username, 'testuser')
+        self.assertIs(User.get_by_id(user_id), cached)
+        stats = identity_cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+
+    def test_identify_cache_invalidated_on_update(self):
+        user_id = add_user('testuser', 'test@test.com', 'test').id
+        User.identify(user_id).update(is_active=False)
+        db.session.remove()
+        self.assertFalse(User.identify(user_id).is_active)
+        self.assertEqual(identity_cache.stats()['hits'], 0)
+
+    def test_insert_is_a_single_statement(self):
+        with captured_statements() as statements:
+            user = User.insert(
+                username='testuser', email='test@test.com', password='test')
+            self.assertTrue(user.id)
+            self.assertEqual(user.username, 'testuser')
+            self.assertTrue(user.is_active)
+            self.assertIsNone(user.roles)
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith('INSERT'))
+
+    def test_insert_unique_violation(self):
+        add_user('testuser', 'test@test.com', 'test')
+        with self.assertRaises(IntegrityError) as ctx:
+            User.insert(
+                username='testuser2', email='test@test.com', password='test')
+        self.assertEqual(unique_violation(ctx.exception), 'email')
+        with self.assertRaises(IntegrityError) as ctx:
+            User.insert(
+                username='testuser', email='test2@test.com', password='test')
+        self.assertEqual(unique_violation(ctx.exception), 'username')
+
+    def test_query_public_does_not_select_password(self):
+        add_user('testuser', 'test@test.com', 'test')
+        db.session.remove()
+        with captured_statements() as statements:
+            users = User.query_public().all()
+            self.assertEqual(users[0].username, 'testuser')
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('users.password', statements[0])
+
+    def test_identify_does_not_select_password(self):
+        user_id = add_user('testuser', 'test@test.com', 'test').id
+        db.session.remove()
+        with captured_statements() as statements:
+            user = User.identify(user_id)
+            self.assertEqual(user.rolenames, [])
+            self.assertTrue(user.is_valid())
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('users.password', statements[0])
+
+    def test_lookup_ignores_email_case(self):
+        add_user('testuser', 'Test@Test.com', 'test')
+        self.assertEqual(User.lookup('test@TEST.com').username, 'testuser')
+
+    def test_add_user_duplicate_email_case(self):
+        add_user('testuser', 'test@test.com', 'test')
+        with self.assertRaises(IntegrityError) as ctx:
+            User.insert(
+                username='testuser2', email='TEST@test.com', password='test')
+        self.assertEqual(unique_violation(ctx.exception), 'email')
+
+    def test_lookup_uses_email_index(self):
+        with captured_statements() as statements:
+            User.lookup('Test@Test.com')
+        [statement] = statements
+        plan = ' '.join(
+            str(row[-1]) for row in db.session.connection().execute(
+                f'EXPLAIN QUERY PLAN {statement}', 'Test@Test.com'))
+        self.assertIn('USING INDEX ix_users_email_lower', plan)
+
+
+class TestRoles(BaseTestCase):
+
+    def test_roles_string_sets_mask_and_assignments(self):
+        user = add_user('testuser', 'test@test.com', 'test', 'admin, ops')
+        self.assertEqual(
+            sorted(role.name for role in user.assigned_roles),
+            ['admin', 'ops'])
+        self.assertEqual(user.role_mask, 0b11)
+        self.assertEqual(user.rolenames, ['admin', 'ops'])
+        user.update(roles='ops')
+        self.assertEqual(user.rolenames, ['ops'])
+        self.assertEqual(
+            [role.name for role in user.assigned_roles], ['ops'])
+        self.assertEqual(Role.query.count(), 2)
+
+    def test_roles_stay_in_step_with_the_mask(self):
+        user = add_user('testuser', 'test@test.com', 'test', 'admin')
+        with self.assertRaises(AttributeError):
+            user.roles = 'ops'
+        self.assertEqual(user.roles, 'admin')
+        self.assertEqual(user.rolenames, ['admin'])
+        user.set_roles('ops')
+        db.session.commit()
+        self.assertEqual(user.roles, 'ops')
+        self.assertEqual(user.rolenames, ['ops'])
+        self.assertEqual(user.role_mask, 0b10)
+        with self.assertRaises(ValueError):
+            User.update_by_id(user.id, roles='admin')
+
+    def test_has_roles_is_a_bitwise_check(self):
+        user = add_user('testuser', 'test@test.com', 'test', 'admin,ops')
+        Role.get_or_create(['billing'])
+        db.session.refresh(user)
+        with captured_statements() as statements:
+            self.assertTrue(user.has_roles('admin'))
+            self.assertTrue(user.has_roles('admin', 'ops'))
+            self.assertFalse(user.has_roles('billing'))
+        self.assertEqual(statements, [])
+        self.assertFalse(user.has_roles('missing'))
+
+    def test_query_by_role_uses_index(self):
+        add_user('testuser', 'test@test.com', 'test', 'admin')
+        add_user('testuser2', 'test2@test.com', 'test', 'ops')
+        query = User.query_by_role('admin')
+        self.assertEqual([user.username for user in query], ['testuser'])
+        sql = str(query.statement.compile(
+            dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+        plan = ' '.join(
+            str(row[-1])
+            for row in db.session.execute(f'EXPLAIN QUERY PLAN {sql}'))
+        self.assertIn('ix_user_roles_role_id', plan)
+
+    def test_backfill_roles(self):
+        db.session.execute(User.__table__.insert(), [
+            {'username': f'user{i}', 'email': f'user{i}@test.com',
+             'password': 'x', 'admin': False, 'roles': roles,
+             'role_mask': None}
+            for i, roles in enumerate(['admin,ops', None, 'ops'])])
+        db.session.commit()
+        self.assertEqual(backfill_roles(batch_size=2), 3)
+        self.assertEqual(
+            [user.username for user in User.query_by_role('ops')],
+            ['user0', 'user2'])
+        self.assertEqual(
+            [user.role_mask for user in User.query.order_by(User.id)],
+            [0b11, 0, 0b10])
+        self.assertEqual(backfill_roles(), 0)
+
+
+class TestVersionedUpdates(BaseTestCase):
+
+    def test_update_by_id_is_one_update(self):
+        user_id = add_user('test', 'test@test.com', 'test').id
+        db.session.remove()
+        with captured_statements() as statements:
+            row = User.update_by_id(
+                user_id, version=1, returning=('username', 'version'),
+                admin=True)
+        self.assertEqual(tuple(row), (user_id, 'test', 2))
+        self.assertTrue(statements[0].startswith('UPDATE users SET'))
+        self.assertIn('users.version = ?', statements[0])
+        # sqlite has no RETURNING, the row is read back
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(User.query.get(user_id).admin)
+
+    def test_update_by_id_conflict(self):
+        user = add_user('test', 'test@test.com', 'test')
+        user.update(admin=True)
+        self.assertEqual(user.version, 2)
+        self.assertRaises(
+            StaleDataError, User.update_by_id, user.id, version=1,
+            is_active=False)
+        self.assertTrue(User.query.get(user.id).is_active)
+        self.assertIsNone(User.update_by_id(42, version=1, admin=True))
+
+    def test_update_by_id_forgets_cached_rows(self):
+        user_id = add_user('test', 'test@test.com', 'test').id
+        db.session.remove()
+        identity_cache.clear()
+        User.identify(user_id)
+        self.assertEqual(identity_cache.stats()['size'], 1)
+        User.update_by_id(user_id, is_active=False)
+        self.assertEqual(identity_cache.stats()['size'], 0)
+        user = User.identify(user_id)
+        self.assertFalse(user.is_active)
+        self.assertEqual(user.token_generation, 1)
+        self.assertEqual(user.version, 2)
+
+    def test_stale_instance_update_conflicts(self):
+        user = add_user('test', 'test@test.com', 'test')
+        User.update_by_id(user.id, admin=True, commit=False)
+        # the instance is expired, what it holds doesn't hide the change
+        self.assertEqual(user.version, 2)
+        db.session.commit()
+        stale = User.query.get(user.id)
+        db.session.query(User).filter_by(id=user.id).update(
+            {'version': 5}, synchronize_session=False)
+        stale.username = 'renamed'
+        self.assertRaises(StaleDataError, db.session.commit)
+
+
+class TestRevocationList(BaseTestCase):
+
+    def test_revoke(self):
+        revocations.revoke('a-jti', time.time() + 60)
+        self.assertTrue(revocations.is_revoked('a-jti'))
+        self.assertFalse(revocations.is_revoked('another-jti'))
+        self.assertEqual(RevokedToken.query.one().jti, 'a-jti')
+
+    def test_sync_picks_up_other_workers_revocations(self):
+        revocations.is_revoked('a-jti')
+        RevokedToken.insert(jti='a-jti', expires_at=int(time.time()) + 60)
+        RevokedToken.insert(jti='old-jti', expires_at=int(time.time()) - 1)
+        self.assertFalse(revocations.is_revoked('a-jti'))
+        with captured_statements() as statements:
+            self.assertTrue(revocations.is_revoked('another-jti') is False)
+        self.assertEqual(statements, [])
+        self.assertEqual(revocations.sync(), 1)
+        self.assertTrue(revocations.is_revoked('a-jti'))
+        self.assertFalse(revocations.is_revoked('old-jti'))
+
+    def test_prune(self):
+        revocations.revoke('a-jti', time.time() + 60)
+        revocations.revoke('old-jti', time.time() - 1)
+        self.assertEqual(revocations.prune(), 1)
+        revocations.sync()
+        self.assertEqual(revocations.stats()['size'], 1)
+        self.assertEqual(RevokedToken.query.one().jti, 'a-jti')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,15 @@
 import json
 import unittest
 
+import pendulum
+
 from service import db
+from service.api.extensions import guard
 from service.api.models import User
 from service.tests.base import BaseTestCase
-from service.tests.utils import add_user, get_user_token, get_url_with_token
+from service.api.models import identity_cache
+from service.tests.utils import add_user, captured_statements, \
+    get_user_token, get_url_with_token, make_token
 
 
 class TestUserService(BaseTestCase):
@@ -199,6 +204,64 @@ class TestUserService(BaseTestCase):
             self.assertIn('test_me', data['username'])
             self.assertIn('test_me@example.com', data['email'])
 
+    def test_read_endpoints_do_not_select_password(self):
+        """Ensure read endpoints never load the password hash."""
+        user = add_user('test_me', 'test_me@example.com', 'test')
+        with self.client:
+            token = make_token(User.lookup('test_me@example.com'))
+            for url in (f'/api/users/{user.id}', '/api/users/',
+                        '/api/auth/status'):
+                db.session.remove()
+                identity_cache.clear()
+                with captured_statements() as statements:
+                    response = get_url_with_token(self.client, url, token)
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(statements)
+                for statement in statements:
+                    self.assertNotIn('users.password', statement)
+
+    def test_single_user_etag(self):
+        """Ensure a current If-None-Match gets a 304 until the user changes."""
+        user = add_user('test_me', 'test_me@example.com', 'test')
+        token = guard.encode_jwt_token(
+            user, override_access_lifespan=pendulum.Duration(hours=1))
+        url = f'/api/users/{user.id}'
+        with self.client:
+            response = get_url_with_token(self.client, url, token)
+            etag = response.headers['ETag']
+            self.assertEqual(response.status_code, 200)
+
+            response = self.client.get(url, headers={
+                'Authorization': f'Bearer {token}', 'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+            self.assertEqual(response.headers['ETag'], etag)
+
+            User.query.get(user.id).update(admin=True)
+            response = self.client.get(url, headers={
+                'Authorization': f'Bearer {token}', 'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+            self.assertTrue(json.loads(response.data.decode())['admin'])
+
+    def test_status_etag(self):
+        """Ensure the status ETag names the user and its version."""
+        one = add_user('one', 'one@example.com', 'test')
+        two = add_user('two', 'two@example.com', 'test')
+        etags = set()
+        with self.client:
+            for user in (one, two):
+                token = guard.encode_jwt_token(
+                    user, override_access_lifespan=pendulum.Duration(hours=1))
+                response = get_url_with_token(
+                    self.client, '/api/auth/status', token)
+                etags.add(response.headers['ETag'])
+                response = self.client.get('/api/auth/status', headers={
+                    'Authorization': f'Bearer {token}',
+                    'If-None-Match': response.headers['ETag']})
+                self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(etags), 2)
+
     def test_single_user_no_id(self):
         """Ensure error is thrown if an id is not found."""
         add_user(
@@ -299,6 +362,96 @@ class TestUserService(BaseTestCase):
             self.assertTrue(data[1]['is_active'])
             self.assertFalse(data[1]['admin'])
 
+    def test_all_users_paginated(self):
+        """Ensure users are paged by id with a next cursor."""
+        for name in ('one', 'two', 'three'):
+            add_user(name, f'{name}@example.com', 'test')
+        with self.client:
+            token = make_token(User.lookup('one@example.com'))
+            response = get_url_with_token(
+                self.client, '/api/users/?limit=2', token)
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                [user['username'] for user in data], ['one', 'two'])
+            cursor = response.headers['X-Next-Cursor']
+            self.assertIn(f'cursor={cursor}', response.headers['Link'])
+
+            response = get_url_with_token(
+                self.client, f'/api/users/?limit=2&cursor={cursor}', token)
+            data = json.loads(response.data.decode())
+            self.assertEqual([user['username'] for user in data], ['three'])
+            self.assertNotIn('X-Next-Cursor', response.headers)
+
+    def test_all_users_etag(self):
+        """Ensure a page's ETag changes with any of its users."""
+        for name in ('one', 'two', 'three'):
+            add_user(name, f'{name}@example.com', 'test')
+        token = guard.encode_jwt_token(
+            User.query.get(1),
+            override_access_lifespan=pendulum.Duration(hours=1))
+        headers = {'Authorization': f'Bearer {token}'}
+        with self.client:
+            response = self.client.get('/api/users/?limit=2', headers=headers)
+            etag = response.headers['ETag']
+            response = self.client.get('/api/users/?limit=2', headers=dict(
+                headers, **{'If-None-Match': etag}))
+            self.assertEqual(response.status_code, 304)
+            # the last page is another page
+            response = self.client.get('/api/users/?limit=3', headers=dict(
+                headers, **{'If-None-Match': etag}))
+            self.assertEqual(response.status_code, 200)
+
+            User.query.get(2).update(is_active=False)
+            response = self.client.get('/api/users/?limit=2', headers=dict(
+                headers, **{'If-None-Match': etag}))
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_all_users_fields_mask(self):
+        """Ensure the users list honours X-Fields, with its own ETag."""
+        for name in ('one', 'two'):
+            add_user(name, f'{name}@example.com', 'test')
+        token = guard.encode_jwt_token(
+            User.query.get(1),
+            override_access_lifespan=pendulum.Duration(hours=1))
+        headers = {'Authorization': f'Bearer {token}'}
+        with self.client:
+            response = self.client.get('/api/users/', headers=headers)
+            etag = response.headers['ETag']
+            response = self.client.get('/api/users/', headers=dict(
+                headers, **{'X-Fields': 'id,username', 'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(json.loads(response.data.decode()), [
+            {'id': 1, 'username': 'one'}, {'id': 2, 'username': 'two'}])
+
+    def test_all_users_invalid_cursor(self):
+        add_user('one', 'one@example.com', 'test')
+        with self.client:
+            token = make_token(User.lookup('one@example.com'))
+            response = get_url_with_token(
+                self.client, '/api/users/?cursor=nope', token)
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('Invalid cursor: nope', data['message'])
+
+    def test_all_users_ndjson(self):
+        """Ensure the ndjson mode streams one user per line."""
+        for name in ('one', 'two', 'three'):
+            add_user(name, f'{name}@example.com', 'test')
+        with self.client:
+            token = make_token(User.lookup('one@example.com'))
+            response = get_url_with_token(
+                self.client, '/api/users/?format=ndjson', token)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            lines = response.data.decode().splitlines()
+            self.assertEqual(
+                [json.loads(line)['username'] for line in lines],
+                ['one', 'two', 'three'])
+            self.assertNotIn('password', json.loads(lines[0]))
+
     def test_add_user_invalid_json_keys_no_password(self):
         """
         Ensure error is thrown if the JSON object
@@ -327,6 +480,56 @@ class TestUserService(BaseTestCase):
                 "'password' is a required property", data['errors']['password']
                 )
 
+    def test_bulk_import(self):
+        add_user('test', 'test@test.com', 'test', 'admin')
+        with self.client:
+            token = make_token(User.lookup('test@test.com'))
+            response = self.client.post(
+                '/api/users/import',
+                data='username,email,password\n'
+                     'test_me,test_me@example.com,Downf0ryourRIGHTtoParty!\n'
+                     'test,test_two@example.com,Downf0ryourRIGHTtoParty!\n',
+                content_type='text/csv',
+                headers={'Authorization': f'Bearer {token}'}
+                )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['imported'], 1)
+            self.assertEqual(data['failed'], 1)
+            self.assertIn('Username already exists: test',
+                          data['errors'][0]['error'])
+
+    def test_bulk_import_too_many_rows(self):
+        admin = add_user('test', 'test@test.com', 'test', 'admin')
+        token = guard.encode_jwt_token(
+            admin, override_access_lifespan=pendulum.Duration(hours=1))
+        self.app.config['BULK_IMPORT_MAX_ROWS'] = 1
+        with self.client:
+            response = self.client.post(
+                '/api/users/import',
+                data='username,email,password\n'
+                     'one,one@example.com,Downf0ryourRIGHTtoParty!\n'
+                     'two,two@example.com,Downf0ryourRIGHTtoParty!\n',
+                content_type='text/csv',
+                headers={'Authorization': f'Bearer {token}'}
+                )
+            self.assertEqual(response.status_code, 413)
+            self.assertEqual(User.query.count(), 1)
+
+    def test_bulk_import_not_admin(self):
+        add_user('test', 'test@test.com', 'test')
+        with self.client:
+            token = make_token(User.lookup('test@test.com'))
+            response = self.client.post(
+                '/api/users/import',
+                data='username,email,password\n',
+                content_type='text/csv',
+                headers={'Authorization': f'Bearer {token}'}
+                )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 403)
+            self.assertEqual('MissingRoleError', data['error'])
+
     @unittest.skip("Not Implemented")
     def test_add_user_inactive(self):
         add_user('test', 'test@test.com', 'test')
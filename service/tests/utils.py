@@ -4,9 +4,13 @@ from service.api.extensions import guard
 from service.api.models import User
 
 import json
+from contextlib import contextmanager
 from datetime import date
 from datetime import datetime
 
+import pendulum
+from sqlalchemy import event
+
 
 class JsonExtendEncoder(json.JSONEncoder):
     """
@@ -33,12 +37,49 @@ def add_user(username, email, password, roles=None):
     baseline = {'username': username, 'email': email, 'password': password}
     user = User(**baseline)
     if roles:
-        user.roles = roles
+        user.set_roles(roles)
     db.session.add(user)
     db.session.commit()
     return user
 
 
+@contextmanager
+def captured_statements():
+    """Collect the SQL statements executed inside the with block"""
+    statements = []
+
+    def capture(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+
+
+@contextmanager
+def query_budget(budget):
+    """Fail if the with block runs more than ``budget`` SQL statements"""
+    with captured_statements() as statements:
+        yield statements
+    if len(statements) > budget:
+        raise AssertionError(
+            '{} statements over a budget of {}:\n{}'.format(
+                len(statements), budget, '\n'.join(statements)))
+
+
+def make_token(user):
+    """A token that stays valid for the test
+
+    TestingConfig's access lifespan is 0s, a token from a login expires on
+    the next second and can't be relied on across requests.
+    """
+    return guard.encode_jwt_token(
+        user, override_access_lifespan=pendulum.Duration(hours=1),
+        override_refresh_lifespan=pendulum.Duration(hours=2))
+
+
 def get_user_token(client, email, password):
     return login_user(client, email, password)['auth_token']
 
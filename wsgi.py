@@ -0,0 +1,22 @@
+# ./wsgi.py
+"""Production WSGI entry point
+
+Unlike manage.py this module does not start coverage tracing or pull in the
+flask cli, it only builds the app.  Serve it with ``gunicorn wsgi:app``.
+
+Behind a load balancer ``remote_addr`` is the balancer's address, with
+PROXY_FIX_X_FOR set the client's comes from the X-Forwarded-For entries added
+by that many proxies.
+"""
+import os
+
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from service import create_app
+
+
+app = create_app(
+    app_settings=os.getenv(
+        'APP_SETTINGS', 'service.config.ProductionConfig'))
+if app.config['PROXY_FIX_X_FOR']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])